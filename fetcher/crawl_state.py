@@ -0,0 +1,195 @@
+'''
+	what previous crawls fetched, so a refresh only downloads what's new or changed.
+
+	the state is a pickled dict of transcript filename (format_filename(url)) to
+
+		{
+			'url': url the transcript was fetched from,
+			'hash': md5 hex digest of the transcript file's contents,
+			'fetched': time (seconds since epoch) of the last fetch,
+			'etag', 'last_modified': HTTP validators of the last response, or None
+			'failures': number of fetches in a row that failed (couldn't be
+				fetched, parsed or had no transcript); missing in older states
+			'status': HTTP status of the last failure, or None
+			'failed': time of the last failure
+		}
+
+	a url that has never been fetched successfully has an entry too once it
+	fails, with 'hash' None. failed urls are retried after retry_delay, doubling
+	with every further failure, up to max_failures times.
+'''
+
+import os
+import time
+import hashlib
+import threading
+import cPickle
+
+
+class CrawlState(object):
+
+	'''
+		persistent crawl state (see above). safe to update from crawler threads.
+
+		Arguments:
+
+			path: pickle file holding the state; doesn't have to exist yet
+			retry_delay (float, default=1 day): seconds before a failed url is
+				tried again the first time
+			max_failures (int, default=5): failures in a row after which a url
+				isn't tried any more
+
+		Structures:
+
+			entries: map of filename to state entry
+			changed: filenames whose transcripts were new or changed in this run
+	'''
+
+	def __init__(self, path, retry_delay=24 * 3600, max_failures=5):
+
+		self.path = path
+		self.retry_delay = retry_delay
+		self.max_failures = max_failures
+		self.entries = {}
+		if os.path.exists(path):
+			with open(path, 'rb') as f:
+				self.entries = cPickle.load(f)
+		self.changed = set()
+		self._lock = threading.Lock()
+
+	def __contains__(self, filename):
+		return filename in self.entries
+
+	def is_due(self, filename, now=None):
+
+		'''
+			whether filename should be fetched (again): it's new, its last fetch
+			worked, or it failed and its retry time has come.
+		'''
+
+		with self._lock:
+			entry = self.entries.get(filename, None)
+			if entry is None or entry.get('failures', 0) == 0:
+				return True
+			if entry['failures'] >= self.max_failures:
+				return False
+			if now is None:
+				now = time.time()
+			return now >= entry['failed'] + self.retry_delay * 2 ** (entry['failures'] - 1)
+
+	def retry_urls(self, now=None):
+
+		'''
+			returns the urls of transcripts that have never been fetched
+			successfully and are due to be tried again (see is_due).
+		'''
+
+		return [entry['url'] for filename, entry in self.entries.items()
+				if entry['hash'] is None and entry.get('failures', 0) > 0
+				and self.is_due(filename, now)]
+
+	def record_failure(self, filename, url, status=None):
+
+		'''
+			records that filename couldn't be fetched, parsed or written. the
+			transcript it had, if any, is kept.
+		'''
+
+		with self._lock:
+			entry = self.entries.get(filename, None)
+			if entry is None:
+				entry = self.entries[filename] = {'url': url, 'hash': None, 'fetched': None,
+											'etag': None, 'last_modified': None}
+			entry['failures'] = entry.get('failures', 0) + 1
+			entry['status'] = status
+			entry['failed'] = time.time()
+
+	def conditional_headers(self, filename):
+
+		'''
+			returns request headers that let the server answer 304 if the page
+			hasn't changed since it was last fetched.
+		'''
+
+		entry = self.entries.get(filename, None)
+		headers = {}
+		if entry is not None:
+			if entry['etag']:
+				headers['If-None-Match'] = entry['etag']
+			if entry['last_modified']:
+				headers['If-Modified-Since'] = entry['last_modified']
+		return headers
+
+	def is_changed(self, filename, content):
+
+		'''
+			whether content (a transcript file's contents) is new or differs from
+			the last fetch, i.e. the transcript file needs (re)writing.
+		'''
+
+		with self._lock:
+			entry = self.entries.get(filename, None)
+			return entry is None or hashlib.md5(content).hexdigest() != entry['hash']
+
+	def update(self, filename, url, response_headers, content=None):
+
+		'''
+			records a fetch of filename. content is the transcript file's contents,
+			or None if the server said the page is unchanged (a 304). since the
+			state then says the file is current, call this only once the file
+			has been written.
+
+			Returns:
+
+				True if content is new or differs from the last fetch.
+		'''
+
+		with self._lock:
+			entry = self.entries.get(filename, None)
+			if entry is None:
+				entry = self.entries[filename] = {'url': url, 'hash': None,
+											'etag': None, 'last_modified': None}
+			entry['fetched'] = time.time()
+			entry['failures'] = 0
+
+			if content is None:
+				# a 304 need not repeat the validators; keep the ones it leaves out
+				if 'etag' in response_headers:
+					entry['etag'] = response_headers['etag']
+				if 'last-modified' in response_headers:
+					entry['last_modified'] = response_headers['last-modified']
+				return False
+
+			entry['etag'] = response_headers.get('etag', None)
+			entry['last_modified'] = response_headers.get('last-modified', None)
+			content_hash = hashlib.md5(content).hexdigest()
+			if content_hash == entry['hash']:
+				return False
+			entry['url'] = url
+			entry['hash'] = content_hash
+			self.changed.add(filename)
+			return True
+
+	def save(self):
+
+		'''
+			writes the state to path. the old state is only replaced once the new
+			one is completely written.
+		'''
+
+		with self._lock:
+			tmp_path = self.path + '.tmp'
+			with open(tmp_path, 'wb') as f:
+				cPickle.dump(self.entries, f, cPickle.HIGHEST_PROTOCOL)
+			os.rename(tmp_path, self.path)
+
+	def write_changed(self, path):
+
+		'''
+			writes the filenames in changed to path, one per line, for whatever
+			builds on the transcript files to update.
+		'''
+
+		with open(path, 'w') as f:
+			for filename in sorted(self.changed):
+				f.write(filename + '\n')
@@ -0,0 +1,255 @@
+'''
+	concurrent page fetching for the transcript crawl.
+
+	pages are fetched by a pool of worker threads. each host gets a small pool of
+	persistent (keep-alive) connections, and requests to the same host are spaced
+	out by at least host_delay seconds however many workers there are. failed
+	requests are retried with exponential backoff; whatever still goes wrong is
+	recorded as a dict, so a crawl can be inspected and resumed afterwards.
+'''
+
+import httplib
+import socket
+import threading
+import time
+import traceback
+import urlparse
+import Queue
+from multiprocessing.pool import ThreadPool
+
+USER_AGENT = 'whitehouse-transcripts crawler'
+MAX_REDIRECTS = 5
+
+# status codes worth trying again
+RETRY_STATUSES = set([429, 500, 502, 503, 504])
+
+
+class FetchError(Exception):
+
+	'''
+		raised when a page can't be fetched. status is the last HTTP status, or
+		None if the request never got a response.
+	'''
+
+	def __init__(self, url, message, status=None, attempts=1):
+		Exception.__init__(self, '%s: %s' % (url, message))
+		self.url = url
+		self.status = status
+		self.attempts = attempts
+
+
+class Response(object):
+
+	'''
+		a fetched page. url is where it ended up after redirects; headers is a
+		dict with lowercased names.
+	'''
+
+	def __init__(self, url, status, headers, body):
+		self.url = url
+		self.status = status
+		self.headers = headers
+		self.body = body
+
+
+class Crawler(object):
+
+	'''
+		fetches pages concurrently, politely and with retries.
+
+		Arguments:
+
+			num_workers (int, default=8): number of worker threads
+			host_delay (float, default=1.0): minimum number of seconds between the
+				starts of two requests to the same host
+			max_retries (int, default=3): times a request is retried after a
+				connection error or a 429/5xx response
+			backoff (float, default=1.0): seconds to wait before the first retry;
+				doubles with each retry after that
+			timeout (float, default=30): socket timeout in seconds
+
+		Structures:
+
+			errors: list of dicts, one per url that map couldn't handle:
+				{'url', 'stage' ('fetch' or 'handle'), 'error', 'status',
+				'attempts', 'traceback', 'time'}
+	'''
+
+	def __init__(self, num_workers=8, host_delay=1.0, max_retries=3, backoff=1.0, timeout=30):
+
+		self.num_workers = num_workers
+		self.host_delay = host_delay
+		self.max_retries = max_retries
+		self.backoff = backoff
+		self.timeout = timeout
+
+		self.errors = []
+
+		self._lock = threading.Lock()
+		# (scheme, host) -> Queue of idle connections
+		self._connections = {}
+		# host -> earliest time the next request to it may start
+		self._next_slot = {}
+
+	def _wait_turn(self, host):
+
+		with self._lock:
+			now = time.time()
+			slot = max(now, self._next_slot.get(host, 0))
+			self._next_slot[host] = slot + self.host_delay
+		if slot > now:
+			time.sleep(slot - now)
+
+	def _idle_connections(self, scheme, host):
+
+		with self._lock:
+			idle = self._connections.get((scheme, host), None)
+			if idle is None:
+				idle = self._connections[(scheme, host)] = Queue.Queue()
+		return idle
+
+	def _get_connection(self, scheme, host):
+
+		try:
+			return self._idle_connections(scheme, host).get_nowait()
+		except Queue.Empty:
+			if scheme == 'https':
+				return httplib.HTTPSConnection(host, timeout=self.timeout)
+			return httplib.HTTPConnection(host, timeout=self.timeout)
+
+	def _request(self, url, headers):
+
+		# one request, no retries or redirects. returns a Response.
+
+		parts = urlparse.urlsplit(url)
+		path = parts.path or '/'
+		if parts.query:
+			path += '?' + parts.query
+
+		request_headers = {'User-Agent': USER_AGENT}
+		request_headers.update(headers)
+
+		self._wait_turn(parts.netloc)
+		conn = self._get_connection(parts.scheme, parts.netloc)
+		try:
+			conn.request('GET', path, headers=request_headers)
+			response = conn.getresponse()
+			body = response.read()
+		except:
+			conn.close()
+			raise
+
+		response_headers = dict((name.lower(), value) for name, value in response.getheaders())
+		if response.will_close:
+			conn.close()
+		else:
+			self._idle_connections(parts.scheme, parts.netloc).put(conn)
+		return Response(url, response.status, response_headers, body)
+
+	def fetch(self, url, headers={}):
+
+		'''
+			fetches url, following redirects and retrying failures.
+
+			Arguments:
+
+				url: page to fetch
+				headers: extra request headers
+
+			Returns:
+
+				Response; its status is 200, or 304 if headers made the request conditional.
+
+			Raises FetchError if the page can't be fetched.
+		'''
+
+		attempt = 0
+		redirects = 0
+		while True:
+			attempt += 1
+			try:
+				response = self._request(url, headers)
+			except (socket.error, httplib.HTTPException), e:
+				if attempt > self.max_retries:
+					raise FetchError(url, repr(e), attempts=attempt)
+				time.sleep(self.backoff * 2 ** (attempt - 1))
+				continue
+
+			if response.status in (301, 302, 303, 307, 308) and 'location' in response.headers:
+				redirects += 1
+				if redirects > MAX_REDIRECTS:
+					raise FetchError(url, 'too many redirects', response.status, attempt)
+				url = urlparse.urljoin(url, response.headers['location'])
+				continue
+			if response.status in RETRY_STATUSES and attempt <= self.max_retries:
+				time.sleep(self.backoff * 2 ** (attempt - 1))
+				continue
+			if response.status not in (200, 304):
+				raise FetchError(url, 'HTTP status %d' % response.status, response.status, attempt)
+			return response
+
+	def _error(self, url, stage, e):
+
+		return {
+				'url': url,
+				'stage': stage,
+				'error': repr(e),
+				'status': getattr(e, 'status', None),
+				'attempts': getattr(e, 'attempts', 1),
+				'traceback': traceback.format_exc(),
+				'time': time.time()
+			}
+
+	def _handle(self, args):
+
+		handler, url, headers = args
+		try:
+			response = self.fetch(url, headers)
+		except Exception, e:
+			return url, None, self._error(url, 'fetch', e)
+		try:
+			return url, handler(url, response), None
+		except Exception, e:
+			return url, None, self._error(url, 'handle', e)
+
+	def map(self, handler, urls, headers_for=None):
+
+		'''
+			fetches urls with the worker pool and calls handler(url, response) on
+			each page, in the worker thread that fetched it.
+
+			headers_for, if given, is called with each url and returns extra request
+			headers for it (e.g. to make the request conditional).
+
+			Returns:
+
+				generator yielding (url, result of handler) as pages finish, in no
+					particular order. urls that couldn't be fetched or whose handler
+					raised are left out and added to errors instead.
+		'''
+
+		if headers_for is None:
+			headers_for = lambda url: {}
+
+		pool = ThreadPool(self.num_workers)
+		try:
+			for url, result, error in pool.imap_unordered(self._handle,
+					[(handler, url, headers_for(url)) for url in urls]):
+				if error is not None:
+					self.errors.append(error)
+				else:
+					yield url, result
+		finally:
+			pool.terminate()
+
+	def close(self):
+
+		'''
+			closes the idle connections.
+		'''
+
+		with self._lock:
+			for idle in self._connections.itervalues():
+				while not idle.empty():
+					idle.get_nowait().close()
+			self._connections = {}
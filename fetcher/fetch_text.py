@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, UnicodeDammit
+from bs4.dammit import EntitySubstitution
+from bs4.builder import builder_registry
+import HTMLParser
 from datetime import datetime
 import tldextract
 import urllib2
 import os
+import sys
 import re
 import string
 import cPickle
+from crawler import Crawler
+from crawl_state import CrawlState
 
 testurl0 = 'http://www.whitehouse.gov/the-press-office/2014/10/03/remarks-president-town-hall-manufacturing'
 testurl1 = 'http://www.whitehouse.gov/the_press_office/Remarks-by-the-President-at-a-fundraiser-for-Senator-Harry-Reid-5/26/2009'
@@ -24,8 +30,13 @@ ROOT_ADDR = 'http://www.whitehouse.gov'
 OUTPUT_DIR = "/NLP/creativity/work/pres_addrs/whitehouse_texts/transcripts"
 #OUTPUT_DIR = "/NLP/creativity/work/pres_addrs/whitehouse_texts/press_briefings"
 DEBUG_DIR = "/NLP/creativity/work/pres_addrs/whitehouse_texts/debug"
+# what's been fetched into OUTPUT_DIR so far; see crawl_state.py
+CRAWL_STATE = "/NLP/creativity/work/pres_addrs/whitehouse_texts/crawl_state.pk"
 #NUM_PAGES = 327
 NUM_PAGES = 130
+NUM_WORKERS = 8
+# seconds between requests to whitehouse.gov
+HOST_DELAY = 0.5
 
 CONTENT_DIV_CLASS = 'extend-page body-text clearfix clear press-article node-content'
 INPUT_TIMEFORMAT = '%B %d, %Y'
@@ -35,10 +46,11 @@ DATE_RE = r'(\w+ \d\d?, \d\d\d\d)'
 PUNCTUATION = { 0x2018:0x27, 0x2019:0x27, 0x201C:0x22, 0x201D:0x22 }
 PUNCT_TOREAD = '.?!-:"'
 END = 'END'
+# tree builder BeautifulSoup(html) uses: lxml if it's installed, else html.parser
+SOUP_BUILDER = builder_registry.lookup('html').NAME
+
+def parse_listing(html):
 
-def fetch_urls_from_listing(url):
-	
-	html = urllib2.urlopen(url).read()
 	soup = BeautifulSoup(html)
 	
 	entry_list = soup.find('ul', class_='entry-list')
@@ -50,6 +62,11 @@ def fetch_urls_from_listing(url):
 		speech_urls.append(ROOT_ADDR + l['href'])
 	return speech_urls
 
+def fetch_urls_from_listing(url):
+	
+	html = urllib2.urlopen(url).read()
+	return parse_listing(html)
+
 def format_filename(url):
 
 	return '_'.join(url.split('/')[4:])
@@ -57,10 +74,17 @@ def format_filename(url):
 def format_date(datestring):
 	return datetime.strptime(datestring.strip(),INPUT_TIMEFORMAT).strftime(DISPLAY_TIMEFORMAT)
 
+PAREN_RE = re.compile(r'\([^)]*\)')
+TIME_PATTERN = re.compile(TIME_RE)
+DATE_PATTERN = re.compile(DATE_RE)
+# characters of markup fed to the streaming parser at a time
+PARSE_CHUNK = 8192
+ASCII_SPACES = dict((ord(c), None) for c in u'\x20\x0a\x09\x0c\x0d')
+
 def cleanup_text(text):
 
 	if not text.isspace():
-		return re.sub(r'\([^)]*\)', '', unicode(text)).translate(PUNCTUATION)\
+		return PAREN_RE.sub('', unicode(text)).translate(PUNCTUATION)\
 		.replace('--  --','').strip()
 	else:
 		return '\n'
@@ -73,40 +97,35 @@ def start_reading(text):
 		#doesn't want to pull annoying weekly address summary, or HH:MM A.M.
 		#but we're assuming everything with punct at the end is otherwise a real paragraph.
 		return ('WASHINGTON' not in no_spaces 
-			and not re.findall(TIME_RE, text) 
+			and not TIME_PATTERN.search(text) 
 			and 'Washington' not in no_spaces
 			and no_spaces[-1] in PUNCT_TOREAD)
 	else:
 		return False
 
-def fetch_transcript(url):
+def read_text(all_text):
 
-	html = urllib2.urlopen(url).read()
-	soup = BeautifulSoup(html)
+	'''
+		picks the transcript out of the text nodes of a page's content, up to END.
 
-	title = soup.find('title').contents[0].split('|')[0].encode('utf8')
-	date = None
-	text = []
+		Returns:
 
-	content = soup.find('div', class_ = 'legacy-content')
+			(text date, text): text date is the first date (as in the page) found
+				in the text, or None.
+	'''
 
-	if not content:
-		# not legacy
-		content = soup.find('div', class_=CONTENT_DIV_CLASS).find('div',attrs={'id':'content'})
-		date_raw = content.find('div',class_='date')
-		if date_raw:
-			date = format_date(date_raw.contents[0])
-	all_text = content.findAll(text = True)
+	text_date = None
+	text = []
 
 	read = False
 	for x in all_text:
 		clean = cleanup_text(x)
 		if END in clean:
 			break
-		if not date:
-			date_searched = re.search(DATE_RE, clean)
+		if not text_date:
+			date_searched = DATE_PATTERN.search(clean)
 			if date_searched:
-				date = format_date(date_searched.group(1))
+				text_date = date_searched.group(1)
 
 		if read:
 			if clean.isspace():
@@ -119,48 +138,416 @@ def fetch_transcript(url):
 			if read:
 				text.append(clean)
 
-	filename = format_filename(url)
-	towrite = ''.join(text).encode('utf8')
+	return text_date, text
+
+class Unsupported(Exception):
+	# page that the streaming parser can't be sure to read like BeautifulSoup
+	pass
+
+class TranscriptParser(HTMLParser.HTMLParser):
+
+	'''
+		streaming version of what parse_soup_transcript reads from a page: the first
+		child of the title, the text nodes of the content div and the first child of
+		its date div. text nodes come out as BeautifulSoup's html.parser tree builder
+		would make them (adjacent data and entities joined, comments on their own).
+		raises Unsupported for anything out of the ordinary.
+
+		Arguments:
+
+			legacy (bool): whether to look for the legacy-content div
+			encoding: encoding the page was decoded from (used for &#NNN; like
+				BeautifulSoup does)
+	'''
+
+	def __init__(self, legacy, encoding):
+
+		HTMLParser.HTMLParser.__init__(self)
+		self.legacy = legacy
+		self.encoding = encoding
+
+		self.title = None
+		self.date_text = None
+		# whether the date div has been found (or can't be anymore)
+		self.date_settled = legacy
+		# text nodes of the content div found so far
+		self.nodes = []
+
+		# 'outer' -> ('wrapper' ->) 'content' -> 'done'
+		self.stage = 'outer'
+		self._depth = 0
+		self._data = []
+		self._in_title = False
+		self._title_seen = False
+		self._in_date = False
+
+	def _collecting(self):
+		return self._in_title or self._in_date or self.stage == 'content'
+
+	def _flush(self, first_child_ok=False):
+
+		# ends the current text node; called on every event other than data
+		text = u''.join(self._data)
+		self._data = []
+		# BeautifulSoup boils down whitespace-only strings
+		if text and not text.translate(ASCII_SPACES):
+			text = u'\n' if u'\n' in text else u' '
+
+		if self._in_title:
+			if not text or not first_child_ok:
+				raise Unsupported('title does not start with text')
+			self.title = text
+			self._in_title = False
+		if self._in_date:
+			if not text:
+				raise Unsupported('date does not start with text')
+			self.date_text = text
+			self._in_date = False
+			self.date_settled = True
+		if text and self.stage == 'content':
+			self.nodes.append(text)
+
+	def handle_starttag(self, tag, attrs):
+
+		self._flush()
+
+		if tag == 'title' and not self._title_seen:
+			self._title_seen = True
+			self._in_title = True
+		if tag != 'div':
+			return
+
+		attrs = dict(attrs)
+		classes = (attrs.get('class', None) or '').split()
+		if self.stage == 'outer':
+			if self.legacy and 'legacy-content' in classes:
+				self.stage = 'content'
+				self._depth = 0
+			elif not self.legacy and ' '.join(classes) == CONTENT_DIV_CLASS:
+				self.stage = 'wrapper'
+				self._depth = 0
+		elif self.stage == 'wrapper':
+			if attrs.get('id', None) == 'content':
+				self.stage = 'content'
+				self._depth = 0
+			else:
+				self._depth += 1
+		elif self.stage == 'content':
+			self._depth += 1
+			if not self.date_settled and 'date' in classes:
+				self._in_date = True
+
+	def handle_endtag(self, tag):
+
+		self._flush(first_child_ok=True)
+		if tag != 'div' or self.stage not in ('wrapper', 'content'):
+			return
+		if self._depth > 0:
+			self._depth -= 1
+		elif self.stage == 'wrapper':
+			raise Unsupported('no content div')
+		else:
+			self.stage = 'done'
+			self.date_settled = True
+
+	def handle_startendtag(self, tag, attrs):
+
+		if tag in ('div', 'title'):
+			raise Unsupported('self-closing %s' % tag)
+		self._flush()
+
+	def handle_data(self, data):
+		if self._collecting():
+			self._data.append(data)
+
+	def handle_entityref(self, name):
+
+		character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+		if character is not None:
+			self.handle_data(character)
+		else:
+			self.handle_data(u'&%s' % name)
+
+	def handle_charref(self, name):
+
+		if name[0] in 'xX':
+			code = int(name[1:], 16)
+		else:
+			code = int(name)
+		data = None
+		if code < 256:
+			for encoding in (self.encoding, 'windows-1252'):
+				if encoding:
+					try:
+						data = bytearray([code]).decode(encoding)
+					except UnicodeDecodeError:
+						pass
+		if not data:
+			try:
+				data = unichr(code)
+			except (ValueError, OverflowError):
+				pass
+		self.handle_data(data or u'\N{REPLACEMENT CHARACTER}')
+
+	def handle_comment(self, data):
+
+		if self._in_title or self._in_date:
+			raise Unsupported('comment as first child')
+		self._flush()
+		if self.stage == 'content':
+			self.nodes.append(data)
+
+	def handle_decl(self, decl):
+		if self._collecting():
+			raise Unsupported('declaration in content')
+
+	def handle_pi(self, data):
+		if self._collecting():
+			raise Unsupported('processing instruction in content')
+
+	def unknown_decl(self, data):
+		if self._collecting():
+			raise Unsupported('declaration in content')
+
+def parse_soup_transcript(html):
+
+	'''
+		parse_transcript, building the whole BeautifulSoup tree with whatever
+		builder it picks (see SOUP_BUILDER).
+	'''
+
+	soup = BeautifulSoup(html)
+
+	title = soup.find('title').contents[0].split('|')[0].encode('utf8')
+	date = None
+
+	content = soup.find('div', class_ = 'legacy-content')
+
+	if not content:
+		# not legacy
+		content = soup.find('div', class_=CONTENT_DIV_CLASS).find('div',attrs={'id':'content'})
+		date_raw = content.find('div',class_='date')
+		if date_raw:
+			date = format_date(date_raw.contents[0])
+	all_text = content.findAll(text = True)
+
+	text_date, text = read_text(all_text)
+	if not date and text_date:
+		date = format_date(text_date)
+
+	return title, date, ''.join(text).encode('utf8')
+
+def parse_stream_transcript(html):
+
+	'''
+		parse_transcript, with TranscriptParser. parsing stops once the content
+		div is read up to END. raises Unsupported if the page is out of the ordinary.
+	'''
+
+	dammit = UnicodeDammit(html, is_html=True)
+	markup = dammit.unicode_markup
+	parser = TranscriptParser('legacy-content' in markup, dammit.original_encoding)
+
+	def feed():
+		# feeds the next chunk; False once the markup is used up
+		if feed.pos >= len(markup):
+			return False
+		parser.feed(markup[feed.pos:feed.pos + PARSE_CHUNK])
+		feed.pos += PARSE_CHUNK
+		if feed.pos >= len(markup):
+			parser.close()
+			parser._flush(first_child_ok=True)
+		return True
+	feed.pos = 0
+
+	def stream_nodes():
+		consumed = 0
+		while True:
+			while consumed < len(parser.nodes):
+				yield parser.nodes[consumed]
+				consumed += 1
+			if parser.stage == 'done' or not feed():
+				return
+
+	text_date, text = read_text(stream_nodes())
+
+	# title and date div may still be to come
+	while (parser.title is None or not parser.date_settled) and parser.stage != 'done':
+		if not feed():
+			break
+	if parser.stage in ('outer', 'wrapper') or parser.title is None:
+		raise Unsupported('no title or content')
+
+	title = parser.title.split('|')[0].encode('utf8')
+	date = None
+	if parser.date_text:
+		date = format_date(parser.date_text)
+	if not date and text_date:
+		date = format_date(text_date)
+
+	return title, date, ''.join(text).encode('utf8')
+
+def parse_transcript(html):
+
+	'''
+		returns (title, date, text) of a transcript page, utf8 encoded.
+		date is None if the page doesn't have one.
+
+		pages are streamed through TranscriptParser, which reads only as far as
+		it needs to; the few it can't handle go through BeautifulSoup. so does
+		every page if BeautifulSoup builds its trees with something other than
+		html.parser (lxml, if it's installed), since TranscriptParser reads pages
+		the way html.parser does and lxml repairs broken markup differently.
+	'''
+
+	if SOUP_BUILDER == 'html.parser':
+		try:
+			return parse_stream_transcript(html)
+		except (Unsupported, HTMLParser.HTMLParseError):
+			pass
+	return parse_soup_transcript(html)
+
+def write_transcript(url, title, date, towrite, state=None, response_headers={}):
+
+	'''
+		writes a parsed transcript to OUTPUT_DIR. returns False (and writes nothing)
+		if anything is missing.
+
+		with a CrawlState, the file is only rewritten if the transcript is new or
+		changed, and the fetch is recorded in it once the file is written.
+	'''
 
 	if title and date and not towrite.isspace():
 
-		with open(os.path.join(OUTPUT_DIR, filename), 'w') as f:
-			f.write(title + '\n')
-			f.write(date + '\n')
-			f.write(towrite)
-		return 'success'
+		content = title + '\n' + date + '\n' + towrite
+		filename = format_filename(url)
+		if state is None or state.is_changed(filename, content):
+			with open(os.path.join(OUTPUT_DIR, filename), 'w') as f:
+				f.write(content)
+		if state is not None:
+			state.update(filename, url, response_headers, content)
+		return True
+
+	else:
+		return False
+
+def fetch_transcript(url):
 
+	html = urllib2.urlopen(url).read()
+	if write_transcript(url, *parse_transcript(html)):
+		return 'success'
 	else:
 		return url
 
+def fetch_listings(crawler, num_pages, state=None):
+
+	'''
+		returns the transcript urls on the first num_pages listing pages.
+
+		with a CrawlState, pages are read newest first and reading stops at the
+		first page with nothing new on it. urls that failed before aren't new
+		(see CrawlState.retry_urls for those).
+	'''
+
+	listing_urls = [LISTING_ROOT_ADDR + str(i) for i in range(num_pages)]
+	read_listing = lambda url, response: parse_listing(response.body)
+
+	urls = []
+	if state is None:
+		for listing_url, speech_urls in crawler.map(read_listing, listing_urls):
+			print 'fetched listing ' + listing_url
+			urls.extend(speech_urls)
+		return urls
+
+	for listing_url in listing_urls:
+		for listing_url, speech_urls in crawler.map(read_listing, [listing_url]):
+			print 'fetched listing ' + listing_url
+			new_urls = [url for url in speech_urls if format_filename(url) not in state]
+			urls.extend(new_urls)
+			if len(new_urls) == 0:
+				return urls
+	return urls
+
+def crawl(crawler, num_pages=NUM_PAGES, state=None, refresh=False):
+
+	'''
+		fetches the transcripts linked from the first num_pages listing pages.
+
+		Arguments:
+
+			crawler: Crawler to fetch pages with
+			state: CrawlState of previous crawls, or None to fetch everything
+			refresh (bool, default=False): with state, whether to also check
+				transcripts fetched before for changes (with conditional requests).
+				otherwise only new transcripts are fetched. either way, urls that
+				failed before are only tried again once they're due (see
+				CrawlState), and failures are recorded in state.
+
+		Returns:
+
+			(failures, crashes): urls of pages that were fetched but had no
+				transcript, and dicts describing pages that couldn't be fetched or
+				parsed (see Crawler.errors)
+	'''
+
+	if state is not None and refresh:
+		urls = [url for url in fetch_listings(crawler, num_pages)
+				if state.is_due(format_filename(url))]
+		headers_for = lambda url: state.conditional_headers(format_filename(url))
+	else:
+		urls = fetch_listings(crawler, num_pages, state)
+		headers_for = None
+	if state is not None:
+		# failed urls that are due again, wherever they are in the listings
+		listed = set(urls)
+		urls += [url for url in state.retry_urls() if url not in listed]
+
+	def read_transcript(url, response):
+		if response.status == 304:
+			state.update(format_filename(url), url, response.headers)
+			return True
+		title, date, towrite = parse_transcript(response.body)
+		return write_transcript(url, title, date, towrite, state, response.headers)
+
+	failures = []
+	for url, written in crawler.map(read_transcript, urls, headers_for):
+		if not written:
+			print url + ' fail '
+			failures.append(url)
+			if state is not None:
+				state.record_failure(format_filename(url), url)
+
+	crashes = list(crawler.errors)
+	transcript_urls = set(urls)
+	for crash in crashes:
+		print crash['url'] + ' crash '
+		if state is not None and crash['url'] in transcript_urls:
+			state.record_failure(format_filename(crash['url']), crash['url'], crash['status'])
+	return failures, crashes
+
 ##############################################
 
+if __name__ == '__main__':
 
-failures = []
-crashes = []
+	# pass --refresh to check every transcript for changes, not just look for new ones
+	refresh = '--refresh' in sys.argv[1:]
 
-print fetch_transcript('http://www.whitehouse.gov/the-press-office/2013/02/12/remarks-president-state-union-address')
-'''for i in range(NUM_PAGES):
+	crawler = Crawler(num_workers=NUM_WORKERS, host_delay=HOST_DELAY)
+	state = CrawlState(CRAWL_STATE)
+	try:
+		failures, crashes = crawl(crawler, state=state, refresh=refresh)
+	finally:
+		crawler.close()
+		state.save()
 
-	print 'fetching from listing '+str(i) + '...'
+	print str(len(state.changed)) + ' new or changed transcripts'
+	state.write_changed(os.path.join(DEBUG_DIR, 'changed.txt'))
 
-	urls = fetch_urls_from_listing(LISTING_ROOT_ADDR + str(i))
+	print str(len(failures)) + ' failures'
+	print str(len(crashes)) + ' crashes'
 
-	for url in urls:
-		try:
-			result = fetch_transcript(url)
-			if result is not 'success':
-				print url + ' fail '
-				failures.append(url)
-		except:
-			print url + ' crash '
-			crashes.append(url)
-
-print str(len(failures)) + ' failures'
-print str(len(crashes)) + ' crashes'
-
-with open(os.path.join(DEBUG_DIR,'failures.pk'), 'wb') as f:
-	cPickle.dump(failures, f)
-
-with open(os.path.join(DEBUG_DIR,'crashes.pk'), 'wb') as f:
-	cPickle.dump(crashes, f)'''
\ No newline at end of file
+	with open(os.path.join(DEBUG_DIR,'failures.pk'), 'wb') as f:
+		cPickle.dump(failures, f)
+
+	with open(os.path.join(DEBUG_DIR,'crashes.pk'), 'wb') as f:
+		cPickle.dump(crashes, f)
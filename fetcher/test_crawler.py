@@ -0,0 +1,353 @@
+'''
+	tests for crawler.py, and for fetch_text.crawl with a CrawlState, against a
+	local HTTP server serving fixture pages.
+
+	run from this directory with
+
+		python -m unittest discover -p 'test_*.py'
+'''
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+import fetch_text as ft
+from crawler import Crawler, FetchError
+from crawl_state import CrawlState
+
+# seconds the server takes to answer /slow pages
+SLOW_DELAY = 0.3
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+	daemon_threads = True
+	allow_reuse_address = True
+	# the default backlog of 5 makes the 6th simultaneous connection wait for a SYN retry
+	request_queue_size = 32
+
+	def __init__(self):
+
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+		self._lock = threading.Lock()
+		# path -> list of times requests for it came in
+		self.requests = {}
+		# path -> number of requests answered with 503 before a 200
+		self.failures = {}
+		# path -> body of a page to serve
+		self.pages = {}
+		self.active = 0
+		self.max_active = 0
+
+	def record(self, path):
+
+		with self._lock:
+			self.requests.setdefault(path, []).append(time.time())
+			self.active += 1
+			self.max_active = max(self.max_active, self.active)
+			return len(self.requests[path])
+
+	def done(self):
+		with self._lock:
+			self.active -= 1
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	# keep-alive, like the real server
+	protocol_version = 'HTTP/1.1'
+
+	def _send(self, status, body='', headers={}):
+
+		self.send_response(status)
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+
+		server = self.server
+		count = server.record(self.path)
+		try:
+			if self.path in server.pages:
+				self._send(200, server.pages[self.path])
+			elif self.path.startswith('/slow'):
+				time.sleep(SLOW_DELAY)
+				self._send(200, 'slow page ' + self.path)
+			elif self.path.startswith('/flaky'):
+				if count <= server.failures.get(self.path, 0):
+					self._send(503, 'try again')
+				else:
+					self._send(200, 'flaky page')
+			elif self.path == '/down':
+				self._send(503, 'down')
+			elif self.path == '/redirect':
+				self._send(302, headers={'Location': '/page/target'})
+			elif self.path.startswith('/page'):
+				self._send(200, 'page ' + self.path, {'ETag': '"v1"'})
+			else:
+				self._send(404, 'not found')
+		finally:
+			server.done()
+
+	def log_message(self, *args):
+		pass
+
+
+class _ServerTest(unittest.TestCase):
+
+	# runs a _Server for each test
+
+	def setUp(self):
+
+		self.server = _Server()
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		self.port = self.server.server_address[1]
+
+	def tearDown(self):
+
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+
+	def url(self, path, host='127.0.0.1'):
+		return 'http://%s:%d%s' % (host, self.port, path)
+
+
+class CrawlerTest(_ServerTest):
+
+	def test_fetch(self):
+
+		crawler = Crawler(num_workers=1, host_delay=0)
+		response = crawler.fetch(self.url('/page/1'))
+		self.assertEqual(response.status, 200)
+		self.assertEqual(response.body, 'page /page/1')
+		self.assertEqual(response.headers['etag'], '"v1"')
+		crawler.close()
+
+	def test_redirect(self):
+
+		crawler = Crawler(num_workers=1, host_delay=0)
+		response = crawler.fetch(self.url('/redirect'))
+		self.assertEqual(response.body, 'page /page/target')
+		self.assertEqual(response.url, self.url('/page/target'))
+		crawler.close()
+
+	def test_concurrency(self):
+
+		# with no delay between requests, the workers fetch in parallel
+		urls = [self.url('/slow/%d' % k) for k in range(8)]
+		crawler = Crawler(num_workers=8, host_delay=0)
+		start = time.time()
+		results = dict(crawler.map(lambda url, response: response.body, urls))
+		elapsed = time.time() - start
+
+		self.assertEqual(sorted(results), sorted(urls))
+		for url, body in results.items():
+			self.assertEqual(body, 'slow page ' + url[url.index('/slow'):])
+		self.assertEqual(crawler.errors, [])
+		self.assertGreater(self.server.max_active, 1)
+		self.assertLess(elapsed, SLOW_DELAY * len(urls) / 2)
+		crawler.close()
+
+	def test_host_delay(self):
+
+		# however many workers there are, requests to one host are spaced out...
+		host_delay = 0.2
+		urls = [self.url('/page/%d' % k) for k in range(5)]
+		crawler = Crawler(num_workers=5, host_delay=host_delay)
+		results = list(crawler.map(lambda url, response: response.status, urls))
+		self.assertEqual(len(results), len(urls))
+
+		times = sorted(t for path, path_times in self.server.requests.items()
+						for t in path_times)
+		for earlier, later in zip(times, times[1:]):
+			self.assertGreaterEqual(later - earlier, host_delay * 0.9)
+		crawler.close()
+
+	def test_host_delay_per_host(self):
+
+		# ...but requests to different hosts aren't held up by each other
+		host_delay = 1.0
+		urls = [self.url('/page/a'), self.url('/page/b', host='localhost')]
+		crawler = Crawler(num_workers=2, host_delay=host_delay)
+		start = time.time()
+		results = list(crawler.map(lambda url, response: response.status, urls))
+		self.assertEqual(len(results), 2)
+		self.assertLess(time.time() - start, host_delay)
+		crawler.close()
+
+	def test_retry_backoff(self):
+
+		self.server.failures['/flaky'] = 2
+		backoff = 0.1
+		crawler = Crawler(num_workers=1, host_delay=0, max_retries=3, backoff=backoff)
+		response = crawler.fetch(self.url('/flaky'))
+		self.assertEqual(response.status, 200)
+		self.assertEqual(response.body, 'flaky page')
+
+		# waits of backoff, then twice that
+		times = self.server.requests['/flaky']
+		self.assertEqual(len(times), 3)
+		self.assertGreaterEqual(times[1] - times[0], backoff * 0.9)
+		self.assertGreaterEqual(times[2] - times[1], 2 * backoff * 0.9)
+		crawler.close()
+
+	def test_retries_run_out(self):
+
+		crawler = Crawler(num_workers=1, host_delay=0, max_retries=2, backoff=0.01)
+		with self.assertRaises(FetchError) as context:
+			crawler.fetch(self.url('/down'))
+		self.assertEqual(context.exception.status, 503)
+		self.assertEqual(context.exception.attempts, 3)
+		self.assertEqual(len(self.server.requests['/down']), 3)
+		crawler.close()
+
+	def test_no_retry_on_404(self):
+
+		crawler = Crawler(num_workers=1, host_delay=0, max_retries=2, backoff=0.01)
+		with self.assertRaises(FetchError) as context:
+			crawler.fetch(self.url('/missing'))
+		self.assertEqual(context.exception.status, 404)
+		self.assertEqual(context.exception.attempts, 1)
+		crawler.close()
+
+	def test_failure_records(self):
+
+		def handler(url, response):
+			if url.endswith('/page/bad'):
+				raise ValueError('unparseable')
+			return response.body
+
+		urls = [self.url('/page/good'), self.url('/down'), self.url('/missing'),
+				self.url('/page/bad')]
+		crawler = Crawler(num_workers=4, host_delay=0, max_retries=1, backoff=0.01)
+		results = dict(crawler.map(handler, urls))
+		self.assertEqual(results, {self.url('/page/good'): 'page /page/good'})
+
+		errors = dict((error['url'], error) for error in crawler.errors)
+		self.assertEqual(sorted(errors), sorted(urls[1:]))
+		for error in crawler.errors:
+			self.assertEqual(sorted(error), sorted(['url', 'stage', 'error', 'status',
+								'attempts', 'traceback', 'time']))
+
+		down = errors[self.url('/down')]
+		self.assertEqual((down['stage'], down['status'], down['attempts']), ('fetch', 503, 2))
+		missing = errors[self.url('/missing')]
+		self.assertEqual((missing['stage'], missing['status'], missing['attempts']),
+						('fetch', 404, 1))
+		bad = errors[self.url('/page/bad')]
+		self.assertEqual((bad['stage'], bad['status']), ('handle', None))
+		self.assertIn('unparseable', bad['error'])
+		self.assertIn('ValueError', bad['traceback'])
+		crawler.close()
+
+	def test_connection_refused(self):
+
+		# nothing listens once the server is closed
+		url = self.url('/page/1')
+		self.server.shutdown()
+		self.server.server_close()
+		self.server = None
+		crawler = Crawler(num_workers=1, host_delay=0, max_retries=1, backoff=0.01)
+		results = list(crawler.map(lambda url, response: response.body, [url]))
+		self.assertEqual(results, [])
+		self.assertEqual(len(crawler.errors), 1)
+		self.assertEqual(crawler.errors[0]['status'], None)
+		self.assertEqual(crawler.errors[0]['attempts'], 2)
+		crawler.close()
+
+
+class CrawlTest(_ServerTest):
+
+	# fetch_text.crawl with a CrawlState, against listing pages on the local server
+
+	def setUp(self):
+
+		_ServerTest.setUp(self)
+		self.output_dir = tempfile.mkdtemp()
+		self.state = CrawlState(os.path.join(self.output_dir, 'state.pk'))
+		self.real_addrs = ft.ROOT_ADDR, ft.LISTING_ROOT_ADDR, ft.OUTPUT_DIR
+		ft.ROOT_ADDR = self.url('')
+		ft.LISTING_ROOT_ADDR = self.url('/listing?page=')
+		ft.OUTPUT_DIR = self.output_dir
+
+		with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+								'fixtures', 'modern.html')) as f:
+			transcript = f.read()
+		# page 0 links a transcript and a broken link, page 1 an older transcript
+		self.listing([('/a/b/new', transcript), ('/a/b/broken', None)], 0)
+		self.listing([('/a/b/old', transcript)], 1)
+
+	def tearDown(self):
+
+		ft.ROOT_ADDR, ft.LISTING_ROOT_ADDR, ft.OUTPUT_DIR = self.real_addrs
+		shutil.rmtree(self.output_dir)
+		_ServerTest.tearDown(self)
+
+	def listing(self, links, page):
+
+		items = ''.join('<li><a href="%s">x</a></li>' % path for path, body in links)
+		self.server.pages['/listing?page=%d' % page] = (
+				'<html><body><ul class="entry-list">%s</ul></body></html>' % items)
+		for path, body in links:
+			if body is not None:
+				self.server.pages[path] = body
+
+	def crawl(self):
+
+		crawler = Crawler(num_workers=2, host_delay=0, max_retries=0)
+		try:
+			return ft.crawl(crawler, num_pages=2, state=self.state)
+		finally:
+			crawler.close()
+
+	def test_failures_recorded(self):
+
+		failures, crashes = self.crawl()
+		self.assertEqual([crash['url'] for crash in crashes], [self.url('/a/b/broken')])
+		self.assertEqual(sorted(os.listdir(self.output_dir)), ['b_new', 'b_old'])
+		entry = self.state.entries['b_broken']
+		self.assertEqual((entry['hash'], entry['failures'], entry['status']), (None, 1, 404))
+
+		# the broken link isn't new: paging stops at page 0, and it isn't due yet
+		self.server.requests.clear()
+		self.crawl()
+		self.assertEqual(sorted(self.server.requests), ['/listing?page=0'])
+
+		# once it's due, it's tried again, and then later and later
+		self.state.retry_delay = 0
+		self.server.requests.clear()
+		self.crawl()
+		self.assertEqual(sorted(self.server.requests), ['/a/b/broken', '/listing?page=0'])
+		self.assertEqual(self.state.entries['b_broken']['failures'], 2)
+		self.assertFalse(self.state.is_due('b_broken', time.time() - 1))
+
+		# and given up on after max_failures
+		self.state.entries['b_broken']['failures'] = self.state.max_failures
+		self.assertFalse(self.state.is_due('b_broken', time.time() + 10**9))
+		self.assertEqual(self.state.retry_urls(), [])
+
+	def test_success_resets_failures(self):
+
+		self.crawl()
+		self.server.pages['/a/b/broken'] = self.server.pages['/a/b/new']
+		self.state.retry_delay = 0
+		self.crawl()
+		entry = self.state.entries['b_broken']
+		self.assertEqual(entry['failures'], 0)
+		self.assertTrue(entry['hash'] is not None)
+		self.assertIn('b_broken', os.listdir(self.output_dir))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,103 @@
+'''
+	tests that the streaming transcript parser reads the fixture pages in
+	fixtures/ exactly as the BeautifulSoup one does (with html.parser, which
+	is what it's used with).
+
+	run from this directory with
+
+		python -m unittest discover -p 'test_*.py'
+'''
+
+import os
+import unittest
+
+import fetch_text as ft
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def _fixture(name):
+	with open(os.path.join(FIXTURE_DIR, name)) as f:
+		return f.read()
+
+
+class ParseTranscriptTest(unittest.TestCase):
+
+	def assertSameParse(self, name):
+
+		html = _fixture(name)
+		soup_result = ft.parse_soup_transcript(html)
+		self.assertEqual(ft.parse_stream_transcript(html), soup_result)
+		self.assertEqual(ft.parse_transcript(html), soup_result)
+		return soup_result
+
+	def test_modern(self):
+
+		title, date, text = self.assertSameParse('modern.html')
+		self.assertEqual(title, 'Remarks by the President at a Town Hall on Manufacturing ')
+		self.assertEqual(date, '2014-10-03 00:00')
+		self.assertTrue(text.startswith('THE PRESIDENT:  Hello, Indiana!'))
+		# entities, comments and nested divs
+		self.assertIn("It's good to be back & it's good", text)
+		self.assertIn('pull quote\n"We make things here."\n', text)
+		self.assertIn("we've got a lot of work to do.\xc2\xa0 But we're", text)
+		# nothing after END
+		self.assertNotIn('after the end', text)
+
+	def test_legacy(self):
+
+		title, date, text = self.assertSameParse('legacy.html')
+		self.assertEqual(date, '2009-05-26 00:00')
+		self.assertTrue(text.startswith('THE PRESIDENT:  Thank you.'))
+		self.assertNotIn('WASHINGTON', text)
+
+	def test_windows_1252(self):
+
+		title, date, text = self.assertSameParse('cp1252.html')
+		self.assertEqual(date, '2014-10-04 00:00')
+		self.assertIn("That's the longest streak on record \xe2\x80\x93 and we're not done.", text)
+
+	def test_legacy_mention(self):
+
+		# 'legacy-content' in the markup, but not as a div's class: the streaming
+		# parser looks for a legacy div that isn't there and hands the page over
+		# to BeautifulSoup, which reads it as a modern page.
+		html = _fixture('legacy_mention.html')
+		self.assertIn('legacy-content', html)
+		self.assertRaises(ft.Unsupported, ft.parse_stream_transcript, html)
+		self.assertEqual(ft.parse_transcript(html), ft.parse_soup_transcript(html))
+		self.assertEqual(ft.parse_transcript(html), ft.parse_soup_transcript(_fixture('modern.html')))
+
+	def test_default_soup_builder(self):
+
+		# the soup paths build their trees like before, with bs4's default builder
+		features = []
+		real_soup = ft.BeautifulSoup
+		def soup(markup, *args, **kwargs):
+			features.append(args[0] if args else kwargs.get('features', None))
+			return real_soup(markup, *args, **kwargs)
+
+		ft.BeautifulSoup = soup
+		try:
+			ft.parse_soup_transcript(_fixture('modern.html'))
+		finally:
+			ft.BeautifulSoup = real_soup
+		self.assertEqual(features, [None])
+
+	def test_other_soup_builder(self):
+
+		# with lxml as the default builder, pages skip the streaming parser
+		def stream(html):
+			raise AssertionError('streamed with %s as the soup builder' % ft.SOUP_BUILDER)
+
+		real_builder, real_stream = ft.SOUP_BUILDER, ft.parse_stream_transcript
+		ft.SOUP_BUILDER, ft.parse_stream_transcript = 'lxml', stream
+		try:
+			html = _fixture('modern.html')
+			self.assertEqual(ft.parse_transcript(html), ft.parse_soup_transcript(html))
+		finally:
+			ft.SOUP_BUILDER, ft.parse_stream_transcript = real_builder, real_stream
+
+
+if __name__ == '__main__':
+	unittest.main()
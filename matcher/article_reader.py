@@ -1,9 +1,35 @@
 import gzip, os
+import hashlib
+import urlparse
 import datetime as dt 
 from matcher import QuoteMatcher
+from match_store import MatchStore
+from spinn3r_decoder import Spinn3rRecord
+from read_ahead import ReadAhead, PipelineStats
 import cPickle
 
-NEWS_TIMEFORMAT = "%Y-%m-%d %H:%M:%S"
+
+def article_key(url, content):
+
+	'''
+		key under which ArticleReader stores an article: md5 digest of its url and
+		content, normalized so that re-crawled copies of an article get the same key
+		(scheme and host lowercased, fragment and trailing slash dropped from the url,
+		whitespace in the content collapsed).
+	'''
+
+	parts = urlparse.urlsplit(url.strip())
+	url = urlparse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), 
+							parts.path.rstrip('/'), parts.query, ''))
+	content = ' '.join(content.split())
+
+	digest = hashlib.md5()
+	for text in (url, content):
+		if isinstance(text, unicode):
+			text = text.encode('utf-8')
+		digest.update(text)
+		digest.update('\0')
+	return digest.digest()
 
 class ArticleReader(object):
 
@@ -15,9 +41,14 @@ class ArticleReader(object):
 
 			quote_matcher: QuoteMatcher object 
 			verbose (boolean, default=True)
+			batch_size (int, default=None): if given, the quotes of this many articles
+				with quotes at a time are matched together (see QuoteMatcher.match_quotes)
+				instead of one by one. the results are the same.
 
 		Structures:
 
+			pipeline_stats: PipelineStats of read_spinn3r_files, i.e. how long was
+				spent reading, decompressing, decoding and matching.
 			articles are formatted as dicts. important fields:
 				{
 					'url',
@@ -28,10 +59,13 @@ class ArticleReader(object):
 					'date' (as datetime)
 				}
 
-			article_to_idx: map of (article url, article content) to 
-					index in idx_to_article
-			idx_to_article: map of index to article 
-			matches: array of matches, where each match is of the following format:
+			article_to_idx: map of article key (md5 digest of normalized url and
+					content; see article_key) to index in idx_to_article
+			article_dates: map of index to the earliest date the article was seen with
+			idx_to_article: map of index to article (its earliest version)
+			updated_articles: set of indices of articles in idx_to_article that
+					were replaced by an earlier version
+			matches: MatchStore of matches, which reads like a list of dicts of the following format:
 				{
 					'quote': quote text,
 					'url': source url,
@@ -50,21 +84,26 @@ class ArticleReader(object):
 					}
 	'''
 
-	def __init__(self, quote_matcher, verbose=False):
+	def __init__(self, quote_matcher, verbose=False, batch_size=None):
 
 		self.qm = quote_matcher
 
 		self.verbose = verbose
+		self.batch_size = batch_size
 
 		self._next_article_idx = 0
 
 		self.article_to_idx = {}
+		self.article_dates = {}
 		self.idx_to_article = {}
+		self.updated_articles = set()
 
-		self.matches = []
+		self.matches = MatchStore()
 
 		self.errors = []
 
+		self.pipeline_stats = PipelineStats()
+
 	def read_spinn3r_file(self, filename):
 
 		'''
@@ -79,51 +118,172 @@ class ArticleReader(object):
 			print 'Reading ' + filename
 
 		with gzip.open(filename, 'rb') as f:
+			self._read_records(self._load_article(line) for line in f)
 
-			for line in f:
+	def read_spinn3r_files(self, filenames):
 
-				article = self._load_article(line)
-				self._read_article(article)
+		'''
+			processes all articles in several spinn3r data files. the files are
+			read, decompressed and decoded ahead in a background thread (see
+			read_ahead) while the articles already decoded are matched.
 
+			Arguments:
 
-	def _load_article(self, line):
+				filenames: spinn3r data files, in the order they should be read
 
-		article_dict = eval(line)
+			Returns:
 
-		strdate = article_dict['date']
-		article_dict['date'] = dt.datetime.strptime(strdate, NEWS_TIMEFORMAT)
+				generator yielding each filename once its articles are processed.
+		'''
 
-		quotes = []
+		read_ahead = ReadAhead(filenames, self._load_article, stats=self.pipeline_stats)
+		for filename, records in read_ahead:
+			if self.verbose:
+				print 'Reading ' + filename
+			self._read_records(records)
+			yield filename
 
-		onsets = []
+	def _read_records(self, records):
 
-		raw_quote_list = article_dict['quotes']
-		for elem in raw_quote_list:
-			quotes.append(elem['quote'])
-			onsets.append(elem['onset'])
+		if self.batch_size is None:
+			for article in records:
+				self._read_article(article)
+			return
+
+		batch = []
+		for article in records:
+			if len(article['quotes']) == 0:
+				continue
+			batch.append(article.materialize())
+			if len(batch) == self.batch_size:
+				self._read_batch(batch)
+				batch = []
+		if len(batch) > 0:
+			self._read_batch(batch)
 
-		article_dict['quotes'] = tuple(quotes)
-		article_dict['onsets'] = tuple(onsets)
+	def _load_article(self, line):
+
+		# fields are decoded as they're used; see _read_article.
+		return Spinn3rRecord(line, self.pipeline_stats)
+
+	def merge(self, matches, idx_to_article, errors):
+
+		'''
+			adds the results of another ArticleReader, which started out empty and
+			read the files following the ones this reader has read. afterwards this 
+			reader is in the same state as if it had read those files itself.
+
+			Arguments:
+
+				matches, idx_to_article, errors: the other reader's structures
+		'''
 
-		return article_dict
+		first_new_idx = self._next_article_idx
+
+		# articles we already have are dropped along with their matches; 
+			# the rest get the next indices, in order.
+		new_idx = {}
+		for other_idx in sorted(idx_to_article):
+			article = idx_to_article[other_idx]
+			article_key = self._article_key(article)
+			article_idx = self.article_to_idx.get(article_key, None)
+			if article_idx is not None:
+				self._keep_earliest(article_idx, article)
+			else:
+				new_idx[other_idx] = self._next_article_idx
+				self._store_article(article_key, article)
+
+		for match in matches:
+			if match['article_idx'] in new_idx:
+				match = dict(match)
+				match['article_idx'] = new_idx[match['article_idx']]
+				self.matches.append(match)
+
+		# we wouldn't have matched (and hit errors in) articles we already had.
+		for error in errors:
+			article_idx = self.article_to_idx.get(self._article_key(error['article']), None)
+			if article_idx is None or article_idx >= first_new_idx:
+				self.errors.append(error)
+
+	def _article_key(self, article):
+
+		return article_key(article['url'], article['content'])
+
+	def _store_article(self, article_key, article):
+
+		article_idx = self._next_article_idx
+		self.article_to_idx[article_key] = article_idx
+		self.article_dates[article_idx] = article['date']
+		self.idx_to_article[article_idx] = article
+		self._next_article_idx += 1
+
+	def _keep_earliest(self, article_idx, article):
+
+		# save earliest version of article
+		if article['date'] < self.article_dates[article_idx]:
+			self.article_dates[article_idx] = article['date']
+			self.idx_to_article[article_idx] = article
+			self.updated_articles.add(article_idx)
+
+	def _read_batch(self, articles):
+
+		# articles are materialized and all have quotes. their quotes are matched
+			# together, then the articles are stored in order as in _read_article.
+
+		to_match = [article for article in articles 
+					if self._article_key(article) not in self.article_to_idx]
+		batch = [(quote, article['date']) for article in to_match for quote in article['quotes']]
+		try:
+			batch_results = self.qm.match_quotes(batch)
+		except:
+			# some quote can't be matched; let _add_article match them one by one
+				# so the error is recorded against that quote.
+			batch_results = None
+
+		article_results = {}
+		if batch_results is not None:
+			start = 0
+			for article in to_match:
+				end = start + len(article['quotes'])
+				article_results[id(article)] = batch_results[start:end]
+				start = end
+
+		for article in articles:
+			self._add_article(article, article_results.get(id(article), None))
 
 	def _read_article(self, article):
 
-		article_key = (article['url'], article['content'], article['date'])
+		# no quotes, nothing to match (and it can't be an article we stored), so
+			# we don't bother decoding the rest of it. the same goes for articles we
+			# already have, unless this is an earlier version.
+		if len(article['quotes']) == 0:
+			return
+		article_idx = self.article_to_idx.get(self._article_key(article), None)
+		if article_idx is not None:
+			if article['date'] < self.article_dates[article_idx]:
+				self._keep_earliest(article_idx, article.materialize())
+			return
+		self._add_article(article.materialize())
+
+	def _add_article(self, article, match_results=None):
+
+		# match_results, if given, are the results of match_quote for the article's quotes.
+
+		article_key = self._article_key(article)
 		article_idx = self.article_to_idx.get(article_key, None)
 
-		if article_idx:
-			# save earliest version of article
-			stored_date = self.idx_to_article[article_idx]['date']
-			if article['date'] < stored_date:
-				self.idx_to_article[article_idx] = article
+		if article_idx is not None:
+			self._keep_earliest(article_idx, article)
 		else:
 
 			has_matching_quote = False
 
-			for quote in article['quotes']:
+			for quote_idx, quote in enumerate(article['quotes']):
 				try:
-					match_result = self.qm.match_quote(quote, article['date'])
+					if match_results is not None:
+						match_result = match_results[quote_idx]
+					else:
+						match_result = self.qm.match_quote(quote, article['date'])
 					if match_result is not None:
 						has_matching_quote = True
 						self.matches.append({'quote': quote,
@@ -145,7 +305,4 @@ class ArticleReader(object):
 			if has_matching_quote is True:
 
 				#only save to article base if we found a quote
-				this_article_idx = self._next_article_idx
-				self.article_to_idx[article_key] = this_article_idx
-				self.idx_to_article[this_article_idx] = article
-				self._next_article_idx += 1
\ No newline at end of file
+				self._store_article(article_key, article)
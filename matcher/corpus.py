@@ -0,0 +1,324 @@
+'''
+	compiled, memory-mapped form of a transcript collection.
+
+	build_corpus turns the output of load_transcript_collection into a directory of
+	flat numpy arrays (token ids plus offsets) and a small pickled table of words,
+	transcript names, dates, titles and speakers. Corpus opens that directory with
+	mmap, so it loads in milliseconds and processes reading the same corpus share
+	its pages through the page cache. the k-gram hashes and word postings used by
+	NgramIndex and WordIndex are stored too, so those indexes don't need building.
+
+	corpus_dir layout:
+
+		meta.pk: {'words', 'names', 'dates', 'titles', 'speakers', 'gram_k', 'source'}
+		(source: see source_signature)
+		match_tokens.npy, para_offsets.npy: token ids of paragraph['match'] arrays,
+			concatenated, and the position of each paragraph's first token
+			(with an extra entry at the end)
+		display_tokens.npy, display_offsets.npy: same for paragraph['display']
+		word_tokens.npy, word_offsets.npy: same for paragraph['words'], sorted by id
+		para_speakers.npy: index into speakers of each paragraph's speaker
+		transcript_offsets.npy: number of first paragraph of each transcript
+			(with an extra entry at the end)
+		posting_paras.npy, posting_offsets.npy: paragraph numbers containing each
+			word, grouped by word id
+		gram_hashes.npy, gram_positions.npy: see NgramIndex
+
+	transcripts and paragraphs are in chronological order throughout, and
+	paragraphs are numbered consecutively over the whole corpus.
+
+	a corpus is written to a temporary directory and renamed into place once
+	complete, so a build that dies halfway leaves no corpus_dir behind.
+'''
+
+import os
+import shutil
+import hashlib
+import cPickle
+import numpy as np
+from ngram_index import NgramIndex
+from transcript_utils import Paragraph
+
+META_FILENAME = 'meta.pk'
+ARRAY_NAMES = ['match_tokens', 'para_offsets', 'display_tokens', 'display_offsets',
+				'word_tokens', 'word_offsets', 'para_speakers', 'transcript_offsets',
+				'posting_paras', 'posting_offsets', 'gram_hashes', 'gram_positions']
+
+
+def source_signature(path):
+
+	'''
+		returns (mtime, size, md5 hex digest) of the file a corpus was built from.
+	'''
+
+	file_stat = os.stat(path)
+	md5 = hashlib.md5()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(2**20), ''):
+			md5.update(block)
+	return (file_stat.st_mtime, file_stat.st_size, md5.hexdigest())
+
+
+def corpus_is_current(corpus_dir, source_path):
+
+	'''
+		whether corpus_dir holds a complete corpus built from source_path as it is
+		now. a touched file counts as changed only if its contents did.
+	'''
+
+	meta_path = os.path.join(corpus_dir, META_FILENAME)
+	if not os.path.exists(meta_path):
+		return False
+	with open(meta_path, 'rb') as f:
+		source = cPickle.load(f).get('source', None)
+	if source is None:
+		return False
+
+	file_stat = os.stat(source_path)
+	if (file_stat.st_mtime, file_stat.st_size) == tuple(source[:2]):
+		return True
+	return file_stat.st_size == source[1] and source_signature(source_path)[2] == source[2]
+
+
+def build_corpus(transcript_order, transcript_collection, corpus_dir, k=3, source_path=None):
+
+	'''
+		writes a transcript collection to corpus_dir, replacing any corpus there.
+
+		Arguments:
+			transcript_order, transcript_collection: output of load_transcript_collection
+			k (int, default=3): length of word grams in the k-gram index
+			source_path (default=None): file the collection was loaded from; its
+				signature is stored so corpus_is_current can tell when it changes.
+	'''
+
+	# leftovers of a build that died
+	build_dir = corpus_dir.rstrip(os.sep) + '.building'
+	if os.path.exists(build_dir):
+		shutil.rmtree(build_dir)
+	os.makedirs(build_dir)
+
+	names = [x[0] for x in transcript_order]
+	dates = [x[1] for x in transcript_order]
+
+	# match tokens and k-gram hashes are exactly what NgramIndex builds
+	ngram_index = NgramIndex(names, transcript_collection, k)
+	vocab = dict(ngram_index.vocab)
+	words = list(ngram_index.words)
+
+	def token_id(word):
+		word_id = vocab.get(word, None)
+		if word_id is None:
+			word_id = vocab[word] = len(words)
+			words.append(word)
+		return word_id
+
+	speaker_ids = {}
+	speakers = []
+
+	display_tokens = []
+	display_offsets = [0]
+	word_tokens = []
+	word_offsets = [0]
+	para_speakers = []
+	titles = []
+
+	for name in names:
+		transcript = transcript_collection[name]
+		titles.append(transcript['title'])
+		for paragraph in transcript['paragraphs']:
+			display_tokens.extend(token_id(word) for word in paragraph['display'])
+			display_offsets.append(len(display_tokens))
+			word_tokens.extend(sorted(token_id(word) for word in paragraph['words']))
+			word_offsets.append(len(word_tokens))
+
+			speaker = paragraph['speaker']
+			if speaker not in speaker_ids:
+				speaker_ids[speaker] = len(speakers)
+				speakers.append(speaker)
+			para_speakers.append(speaker_ids[speaker])
+
+	arrays = {
+			'match_tokens': ngram_index.tokens,
+			'para_offsets': ngram_index.para_offsets,
+			'display_tokens': np.array(display_tokens, dtype=np.int32),
+			'display_offsets': np.array(display_offsets, dtype=np.int64),
+			'word_tokens': np.array(word_tokens, dtype=np.int32),
+			'word_offsets': np.array(word_offsets, dtype=np.int64),
+			'para_speakers': np.array(para_speakers, dtype=np.int32),
+			'transcript_offsets': np.array(ngram_index.transcript_offsets, dtype=np.int64),
+			'gram_hashes': ngram_index.gram_hashes,
+			'gram_positions': ngram_index.gram_positions
+		}
+
+	# postings: paragraph numbers grouped by word; a stable sort keeps them ascending
+	num_paras = len(para_speakers)
+	word_paras = np.repeat(np.arange(num_paras, dtype=np.int32),
+						np.diff(arrays['word_offsets']))
+	posting_order = np.argsort(arrays['word_tokens'], kind='mergesort')
+	arrays['posting_paras'] = word_paras[posting_order]
+	arrays['posting_offsets'] = np.searchsorted(arrays['word_tokens'][posting_order],
+						np.arange(len(words) + 1)).astype(np.int64)
+
+	for array_name in ARRAY_NAMES:
+		np.save(os.path.join(build_dir, array_name + '.npy'), arrays[array_name])
+
+	meta = {
+			'words': words,
+			'names': names,
+			'dates': dates,
+			'titles': titles,
+			'speakers': speakers,
+			'gram_k': k,
+			'source': source_signature(source_path) if source_path is not None else None
+		}
+	with open(os.path.join(build_dir, META_FILENAME), 'wb') as f:
+		cPickle.dump(meta, f, cPickle.HIGHEST_PROTOCOL)
+
+	# a directory can't be renamed over a non-empty one, so move the old one aside first
+	old_dir = corpus_dir.rstrip(os.sep) + '.old'
+	if os.path.exists(old_dir):
+		shutil.rmtree(old_dir)
+	if os.path.exists(corpus_dir):
+		os.rename(corpus_dir, old_dir)
+	os.rename(build_dir, corpus_dir)
+	if os.path.exists(old_dir):
+		shutil.rmtree(old_dir)
+
+
+class Corpus(object):
+
+	'''
+		a corpus written by build_corpus, opened with mmap.
+
+		Arguments:
+
+			corpus_dir: directory written by build_corpus
+
+		Structures:
+
+			words: list of words, indexed by token id
+			vocab: map of word to token id
+			names, dates, titles, speakers: tables from meta.pk
+			transcripts: read-only view of the corpus in the format of
+				load_transcript_collection; can be handed to QuoteMatcher.
+			plus one (memory-mapped) array per entry of ARRAY_NAMES.
+	'''
+
+	def __init__(self, corpus_dir):
+
+		with open(os.path.join(corpus_dir, META_FILENAME), 'rb') as f:
+			meta = cPickle.load(f)
+		self.words = meta['words']
+		self.names = meta['names']
+		self.dates = meta['dates']
+		self.titles = meta['titles']
+		self.speakers = meta['speakers']
+		self.gram_k = meta['gram_k']
+
+		self.vocab = dict((word, word_id) for word_id, word in enumerate(self.words))
+
+		# plain ndarray views of the memmaps index much faster, and still share their pages
+		for array_name in ARRAY_NAMES:
+			mapped = np.load(os.path.join(corpus_dir, array_name + '.npy'), mmap_mode='r')
+			setattr(self, array_name, mapped.view(np.ndarray))
+
+		self.transcripts = CorpusTranscripts(self)
+
+	def order(self):
+
+		'''
+			returns list of (transcript filename, date) in chronological order
+		'''
+
+		return zip(self.names, self.dates)
+
+	def _words(self, tokens, offsets, para_num):
+		words = self.words
+		return [words[word_id] for word_id in tokens[offsets[para_num]:offsets[para_num+1]].tolist()]
+
+	def paragraph(self, para_num):
+
+		'''
+			returns paragraph para_num (counted over the whole corpus) as a
+			Paragraph; see load_transcript_collection for its format.
+		'''
+
+		match_array = self._words(self.match_tokens, self.para_offsets, para_num)
+		return Paragraph(' '.join(match_array),
+				self._words(self.display_tokens, self.display_offsets, para_num),
+				match_array,
+				frozenset(self._words(self.word_tokens, self.word_offsets, para_num)),
+				self.speakers[self.para_speakers[para_num]])
+
+
+class CorpusTranscripts(object):
+
+	'''
+		dict-like view of a Corpus: transcript filename ->
+			{'title', 'date', 'paragraphs'}
+		paragraphs are built from the arrays when they're read.
+	'''
+
+	def __init__(self, corpus):
+
+		self.corpus = corpus
+		self._transcript_ids = dict((name, i) for i, name in enumerate(corpus.names))
+
+	def __getitem__(self, name):
+
+		transcript_idx = self._transcript_ids[name]
+		return {
+				'title': self.corpus.titles[transcript_idx],
+				'date': self.corpus.dates[transcript_idx],
+				'paragraphs': CorpusParagraphs(self.corpus, transcript_idx)
+			}
+
+	def __contains__(self, name):
+		return name in self._transcript_ids
+
+	def __len__(self):
+		return len(self._transcript_ids)
+
+	def __iter__(self):
+		return iter(self.corpus.names)
+
+	def keys(self):
+		return list(self.corpus.names)
+
+	def get(self, name, default=None):
+		if name in self._transcript_ids:
+			return self[name]
+		return default
+
+	def iteritems(self):
+		for name in self.corpus.names:
+			yield name, self[name]
+
+
+class CorpusParagraphs(object):
+
+	'''
+		list-like view of the paragraphs of one transcript in a Corpus.
+	'''
+
+	def __init__(self, corpus, transcript_idx):
+
+		self.corpus = corpus
+		self.first_para = int(corpus.transcript_offsets[transcript_idx])
+		self.num_paras = int(corpus.transcript_offsets[transcript_idx+1]) - self.first_para
+
+	def __len__(self):
+		return self.num_paras
+
+	def __getitem__(self, k):
+
+		if k < 0:
+			k += self.num_paras
+		if k < 0 or k >= self.num_paras:
+			raise IndexError('paragraph index out of range')
+		return self.corpus.paragraph(self.first_para + k)
+
+	def __iter__(self):
+		for k in range(self.num_paras):
+			yield self[k]
@@ -0,0 +1,134 @@
+import sys
+import collections
+
+
+_CONTAINER_TYPES = (tuple, list, set, frozenset)
+_SCALAR_TYPES = (int, long, float, bool, type(None))
+
+
+def estimate_size(obj):
+
+	'''
+		rough size of an object in bytes, following tuples, lists, sets and dicts.
+		shared objects are counted every time they appear, so this overestimates.
+		numbers inside containers only count as the container's pointer to them.
+	'''
+
+	size = sys.getsizeof(obj)
+	if isinstance(obj, _CONTAINER_TYPES):
+		for elem in obj:
+			if not isinstance(elem, _SCALAR_TYPES):
+				size += estimate_size(elem)
+	elif isinstance(obj, dict):
+		for key, value in obj.iteritems():
+			size += estimate_size(key) + estimate_size(value)
+	return size
+
+
+def alignment_entry_size(key, value):
+
+	'''
+		size of a seg_para or seg_transcript cache entry (see QuoteMatcher), as
+		estimate_size would count it but without walking the alignment: the key is
+		a tuple of ints, and the value a tuple of an alignment (tuple of ints, or
+		None) and numbers.
+	'''
+
+	size = sys.getsizeof(key) + sys.getsizeof(value)
+	if value[0] is not None:
+		size += sys.getsizeof(value[0])
+	return size
+
+
+class LRUCache(object):
+
+	'''
+		dict-like cache which evicts the least recently used entries once the
+		estimated size of its keys and values goes over a byte budget.
+
+		Arguments:
+
+			max_bytes: byte budget
+			sizefn (function, optional): takes (key, value) and returns size of
+				the entry in bytes. defaults to estimate_size of both.
+
+		Structures:
+
+			hits, misses: number of lookups which did and didn't find their key
+			evictions: number of entries dropped to stay within budget
+	'''
+
+	def __init__(self, max_bytes, sizefn=None):
+
+		self.max_bytes = max_bytes
+		if sizefn is None:
+			sizefn = lambda key, value: estimate_size(key) + estimate_size(value)
+		self.sizefn = sizefn
+
+		self.num_bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+		# key -> (value, size); least recently used first
+		self._entries = collections.OrderedDict()
+
+	def get(self, key, default=None):
+
+		entry = self._entries.pop(key, None)
+		if entry is None:
+			self.misses += 1
+			return default
+		self.hits += 1
+		self._entries[key] = entry
+		return entry[0]
+
+	def __getitem__(self, key):
+
+		entry = self._entries.get(key, None)
+		if entry is None:
+			raise KeyError(key)
+		return self.get(key)
+
+	def __setitem__(self, key, value):
+
+		size = self.sizefn(key, value)
+		old_entry = self._entries.pop(key, None)
+		if old_entry is not None:
+			self.num_bytes -= old_entry[1]
+		self._entries[key] = (value, size)
+		self.num_bytes += size
+
+		while self.num_bytes > self.max_bytes and len(self._entries) > 0:
+			evicted_key, evicted_entry = self._entries.popitem(last=False)
+			self.num_bytes -= evicted_entry[1]
+			self.evictions += 1
+
+	def __contains__(self, key):
+		return key in self._entries
+
+	def __len__(self):
+		return len(self._entries)
+
+	def clear(self):
+
+		self._entries.clear()
+		self.num_bytes = 0
+
+	def stats(self):
+
+		'''
+			returns dict of counters:
+				{'hits', 'misses', 'evictions', 'hit_rate', 'entries', 'bytes', 'max_bytes'}
+		'''
+
+		lookups = self.hits + self.misses
+		return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'hit_rate': self.hits / float(lookups) if lookups > 0 else None,
+				'entries': len(self._entries),
+				'bytes': self.num_bytes,
+				'max_bytes': self.max_bytes
+			}
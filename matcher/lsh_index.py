@@ -0,0 +1,242 @@
+from __future__ import division
+import bisect
+import zlib
+import numpy as np
+import match_utils as mu
+
+
+MINHASH_PRIME = (1 << 31) - 1
+
+
+def _word_hash(word):
+
+	# crc32 of the word's utf-8 bytes, so a word hashes the same whether it's a
+	# str or unicode (crc32 can't take non-ascii unicode)
+	if isinstance(word, unicode):
+		word = word.encode('utf-8')
+	return zlib.crc32(word) & 0xffffffff
+
+
+class LSHIndex(object):
+
+	'''
+		MinHash/LSH index over windows of paragraph content words, for finding the
+		paragraphs a segment could fuzzily match without looking at the word sets
+		of all paragraphs in the time window.
+
+		each paragraph's non-stopwords (in order) are cut into overlapping windows of
+		window_size words. every window gets a MinHash signature of num_bands * band_rows
+		values, and each band of band_rows values is hashed into a sorted table, as in
+		NgramIndex. a segment is cut into windows the same way, and paragraphs sharing
+		a band hash with any of them are the candidates.
+
+		a window whose word set has Jaccard similarity J with a segment window is found
+		with probability 1 - (1 - J**band_rows)**num_bands; more bands or fewer rows
+		per band means better recall and more candidates. see measure_recall.
+
+		Arguments:
+
+			transcript_names: transcript filenames in chronological order
+				(i.e. QuoteMatcher.order)
+			transcript_collection: dict of transcript filename to transcript data,
+				as returned by load_transcript_collection
+			stopword_set: set of stopwords (should be the same as the matcher's)
+			window_size (int, default=8): words per window
+			num_bands (int, default=16), band_rows (int, default=2): see above
+			seed (int, default=0): seed for the MinHash permutations
+
+		Structures:
+
+			paragraphs are numbered consecutively over the whole collection, in
+				chronological order.
+			transcript_offsets: number of first paragraph of each transcript;
+				has an extra entry at the end.
+			band_hashes: per band, sorted hashes of that band of every window signature
+			band_paras: per band, paragraph number of the window with the matching hash
+	'''
+
+	def __init__(self, transcript_names, transcript_collection, stopword_set,
+		window_size=8, num_bands=16, band_rows=2, seed=0):
+
+		self.transcript_names = transcript_names
+		self.transcripts = transcript_collection
+		self.stopwords = stopword_set
+		self.window_size = window_size
+		self.num_bands = num_bands
+		self.band_rows = band_rows
+
+		random_state = np.random.RandomState(seed)
+		num_perm = num_bands * band_rows
+		self.perm_a = random_state.randint(1, MINHASH_PRIME, num_perm).astype(np.int64)
+		self.perm_b = random_state.randint(0, MINHASH_PRIME, num_perm).astype(np.int64)
+
+		windows = []
+		window_paras = []
+		self.transcript_offsets = [0]
+		para_num = 0
+		for name in transcript_names:
+			for paragraph in transcript_collection[name]['paragraphs']:
+				for window in self._windows(paragraph['match']):
+					windows.append(window)
+					window_paras.append(para_num)
+				para_num += 1
+			self.transcript_offsets.append(para_num)
+
+		band_keys = self._band_keys(windows)
+		window_paras = np.array(window_paras, dtype=np.int32)
+		self.band_hashes = []
+		self.band_paras = []
+		for band in range(num_bands):
+			# stable sort keeps paragraphs ascending within each hash
+			order = np.argsort(band_keys[:, band], kind='mergesort')
+			self.band_hashes.append(band_keys[order, band])
+			self.band_paras.append(window_paras[order])
+
+	def _windows(self, word_array):
+
+		# hashes of the non-stopwords of word_array, cut into overlapping windows.
+		# windows are padded to window_size by repeating their first word, which
+		# doesn't change their minhashes.
+
+		hashes = [_word_hash(word) for word in word_array
+					if word not in self.stopwords]
+		if len(hashes) == 0:
+			return []
+		size = self.window_size
+		if len(hashes) <= size:
+			return [hashes + [hashes[0]] * (size - len(hashes))]
+		step = max(1, size // 2)
+		starts = range(0, len(hashes) - size + 1, step)
+		if starts[-1] != len(hashes) - size:
+			starts.append(len(hashes) - size)
+		return [hashes[start:start+size] for start in starts]
+
+	def _band_keys(self, windows):
+
+		# (number of windows, num_bands) array of band hashes of the windows' signatures
+
+		if len(windows) == 0:
+			return np.zeros((0, self.num_bands), dtype=np.int64)
+		word_hashes = np.array(windows, dtype=np.int64)
+		signatures = np.empty((len(windows), len(self.perm_a)), dtype=np.int64)
+		for k in range(len(self.perm_a)):
+			signatures[:, k] = ((self.perm_a[k] * word_hashes + self.perm_b[k])
+								% MINHASH_PRIME).min(axis=1)
+		keys = np.zeros((len(windows), self.num_bands), dtype=np.int64)
+		for row in range(self.band_rows):
+			keys = keys * MINHASH_PRIME + signatures[:, row::self.band_rows]
+		return keys
+
+	def candidates(self, segment_arr, earliest, latest, word_ratio):
+
+		'''
+			finds paragraphs of transcripts earliest..latest (indices into the
+			chronological order) that segment_arr likely matches fuzzily, i.e. which
+			contain at least word_ratio of the segment's non-stopwords. only
+			paragraphs the LSH tables turn up are checked, so some may be missed.
+
+			Returns:
+
+				dict of transcript index to list of (paragraph index, overlap count),
+					sorted by paragraph index, as in WordIndex.candidates.
+		'''
+
+		segment_words = set(segment_arr) - self.stopwords
+		windows = self._windows(segment_arr)
+		if len(windows) == 0:
+			return {}
+
+		start = self.transcript_offsets[earliest]
+		end = self.transcript_offsets[latest + 1]
+
+		para_nums = set()
+		band_keys = self._band_keys(windows)
+		for band in range(self.num_bands):
+			hashes = self.band_hashes[band]
+			keys = np.unique(band_keys[:, band])
+			lo = np.searchsorted(hashes, keys, 'left')
+			hi = np.searchsorted(hashes, keys, 'right')
+			for k in np.nonzero(lo < hi)[0].tolist():
+				paras = self.band_paras[band][lo[k]:hi[k]]
+				para_nums.update(paras[(paras >= start) & (paras < end)].tolist())
+
+		result = {}
+		transcript_idx = earliest
+		num_words = len(segment_words)
+		for para_num in sorted(para_nums):
+			while para_num >= self.transcript_offsets[transcript_idx + 1]:
+				transcript_idx += 1
+			para_idx = para_num - self.transcript_offsets[transcript_idx]
+			paragraph = self.transcripts[self.transcript_names[transcript_idx]]['paragraphs'][para_idx]
+			overlap = len(segment_words & paragraph['words'])
+			if overlap / num_words >= word_ratio:
+				result.setdefault(transcript_idx, []).append((para_idx, overlap))
+		return result
+
+
+def measure_recall(quote_matcher, quotes, lsh_index=None):
+
+	'''
+		measures how many fuzzy candidates an LSHIndex misses on some quotes,
+		compared to the exact word_ratio filter.
+
+		Arguments:
+
+			quote_matcher: QuoteMatcher built with use_index=True
+			quotes: list of (quote text, timestamp)
+			lsh_index: LSHIndex to measure; defaults to quote_matcher.lsh_index
+
+		Returns:
+
+			dict with
+				'segments': number of segments long enough to match fuzzily
+				'exact': number of (segment, paragraph) pairs passing the exact filter
+				'lsh': number of those the LSH index found
+				'recall': lsh / exact
+				'lsh_candidates': number of pairs the LSH index returned
+	'''
+
+	if lsh_index is None:
+		lsh_index = quote_matcher.lsh_index
+	qm = quote_matcher
+
+	stats = {'segments': 0, 'exact': 0, 'lsh': 0, 'lsh_candidates': 0}
+	for quote, timestamp in quotes:
+		latest = bisect.bisect_left(qm.times, timestamp) - 1
+		earliest = bisect.bisect_left(qm.times, timestamp - qm.MAX_INTERVAL)
+		if latest < 0 or earliest >= len(qm.times):
+			continue
+		for segment in mu.segment_quote(quote):
+			segment_words = set(segment) - qm.stopwords
+			if len(segment) < qm.MIN_FUZZ_LEN or len(segment_words) == 0:
+				continue
+			stats['segments'] += 1
+
+			exact = set()
+			word_candidates = qm.word_index.candidates(segment, earliest, latest,
+									qm.MIN_FUZZ_LEN, qm.word_ratio)
+			if word_candidates is None:
+				# the word index can't narrow this one down; check every paragraph
+				word_candidates = {}
+				for transcript_idx in range(earliest, latest + 1):
+					paragraphs = qm.transcripts[qm.order[transcript_idx]]['paragraphs']
+					word_candidates[transcript_idx] = [
+							(para_idx, len(segment_words & paragraph['words']))
+							for para_idx, paragraph in enumerate(paragraphs)]
+			for transcript_idx, para_list in word_candidates.iteritems():
+				for para_idx, overlap in para_list:
+					if overlap / len(segment_words) >= qm.word_ratio:
+						exact.add((transcript_idx, para_idx))
+
+			found = set()
+			for transcript_idx, para_list in lsh_index.candidates(segment, earliest, latest,
+									qm.word_ratio).iteritems():
+				for para_idx, overlap in para_list:
+					found.add((transcript_idx, para_idx))
+
+			stats['exact'] += len(exact)
+			stats['lsh'] += len(exact & found)
+			stats['lsh_candidates'] += len(found)
+
+	stats['recall'] = stats['lsh'] / stats['exact'] if stats['exact'] > 0 else 1.0
+	return stats
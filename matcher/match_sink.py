@@ -0,0 +1,207 @@
+'''
+	incremental, append-only output for matching runs.
+
+	after each spinn3r file, the new matches, articles and errors of an ArticleReader
+	are appended as one record to the current shard, and the file is logged as done.
+	a restarted run reloads the articles from the shards, skips files that are done
+	and carries on with the same article numbering.
+
+	output_dir layout:
+
+		shard_NNNNN.pk: pickled records, one after the other, one per input file:
+			{
+				'filename': input file,
+				'matches': matches found in the file,
+				'articles': dict of article index to article, for articles that were
+					added or replaced while reading the file,
+				'errors': errors hit in the file
+			}
+		done.txt: one line per finished input file, tab separated:
+			filename, shard number, size of shard after its record was written
+'''
+
+import os
+import cPickle
+from match_store import MatchStore
+
+DONE_FILENAME = 'done.txt'
+SHARD_FORMAT = 'shard_%05d.pk'
+
+
+def _read_done_log(output_dir):
+
+	done = []
+	done_path = os.path.join(output_dir, DONE_FILENAME)
+	if os.path.exists(done_path):
+		with open(done_path, 'r') as f:
+			for line in f:
+				# a crash while writing the log can leave half a line, which could
+					# still look like a (wrong) entry; only finished lines count
+				if not line.endswith('\n'):
+					break
+				fields = line[:-1].split('\t')
+				if len(fields) == 3 and fields[1].isdigit() and fields[2].isdigit():
+					done.append((fields[0], int(fields[1]), int(fields[2])))
+	return done
+
+
+def iter_records(output_dir):
+
+	'''
+		yields the records of all finished input files, in the order they were written.
+	'''
+
+	shard = None
+	f = None
+	try:
+		for filename, shard_num, end_offset in _read_done_log(output_dir):
+			if shard_num != shard:
+				if f is not None:
+					f.close()
+				f = open(os.path.join(output_dir, SHARD_FORMAT % shard_num), 'rb')
+				shard = shard_num
+			yield cPickle.load(f)
+	finally:
+		if f is not None:
+			f.close()
+
+
+def load_output(output_dir):
+
+	'''
+		reassembles a run's output in the format ArticleReader keeps it in.
+
+		Returns:
+
+			(matches, idx_to_article, errors); matches is a MatchStore.
+	'''
+
+	matches = MatchStore()
+	idx_to_article = {}
+	errors = []
+	for record in iter_records(output_dir):
+		matches.extend(record['matches'])
+		idx_to_article.update(record['articles'])
+		errors.extend(record['errors'])
+	return matches, idx_to_article, errors
+
+
+class MatchSink(object):
+
+	'''
+		writes the results of an ArticleReader to output_dir as it goes (see above).
+
+		Arguments:
+
+			output_dir: directory for shards and the done log; is created if needed.
+				results already there are kept and added to.
+			shard_bytes (int, default=1GB): a new shard is started once the
+				current one is bigger than this.
+	'''
+
+	def __init__(self, output_dir, shard_bytes=2**30):
+
+		self.output_dir = output_dir
+		self.shard_bytes = shard_bytes
+
+		if not os.path.exists(output_dir):
+			os.makedirs(output_dir)
+
+		done = _read_done_log(output_dir)
+		self.done = set(filename for filename, shard_num, end_offset in done)
+
+		# rewrite the log in case it ends with half a line; into a new file that
+			# replaces the old one, so a crash here can't lose the entries
+		done_path = os.path.join(output_dir, DONE_FILENAME)
+		with open(done_path + '.tmp', 'w') as f:
+			for filename, shard_num, end_offset in done:
+				f.write('%s\t%d\t%d\n' % (filename, shard_num, end_offset))
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(done_path + '.tmp', done_path)
+
+		if len(done) > 0:
+			self._shard, self._offset = done[-1][1:]
+		else:
+			self._shard, self._offset = 0, 0
+
+		# anything past the last logged record is from a run that died mid-write
+		shard_path = self._shard_path(self._shard)
+		if os.path.exists(shard_path):
+			with open(shard_path, 'r+b') as f:
+				f.truncate(self._offset)
+		later_shard = self._shard + 1
+		while os.path.exists(self._shard_path(later_shard)):
+			os.remove(self._shard_path(later_shard))
+			later_shard += 1
+
+		# articles with index below this are in the shards already
+		self._next_article_idx = 0
+
+	def _shard_path(self, shard_num):
+		return os.path.join(self.output_dir, SHARD_FORMAT % shard_num)
+
+	def is_done(self, filename):
+		return filename in self.done
+
+	def restore(self, article_reader):
+
+		'''
+			loads the keys and dates of the articles written so far into an empty
+			article_reader, so it recognizes articles it has already seen and numbers
+			new ones where the last run left off.
+		'''
+
+		# later records hold earlier versions, so the last date seen is the earliest
+		for record in iter_records(self.output_dir):
+			for article_idx, article in record['articles'].iteritems():
+				article_reader.article_to_idx[article_reader._article_key(article)] = article_idx
+				article_reader.article_dates[article_idx] = article['date']
+		if len(article_reader.article_dates) > 0:
+			article_reader._next_article_idx = max(article_reader.article_dates) + 1
+		self._next_article_idx = article_reader._next_article_idx
+
+	def flush(self, article_reader, filename):
+
+		'''
+			writes everything article_reader found since the last flush, and logs
+			filename as done. matches, errors and articles are then cleared from
+			article_reader; duplicates are spotted with article_to_idx and
+			article_dates, which are kept.
+		'''
+
+		new_articles = {}
+		for article_idx in range(self._next_article_idx, article_reader._next_article_idx):
+			new_articles[article_idx] = article_reader.idx_to_article[article_idx]
+		for article_idx in article_reader.updated_articles:
+			new_articles[article_idx] = article_reader.idx_to_article[article_idx]
+
+		record = {
+				'filename': filename,
+				'matches': list(article_reader.matches),
+				'articles': new_articles,
+				'errors': list(article_reader.errors)
+			}
+
+		if self._offset > self.shard_bytes:
+			self._shard += 1
+			self._offset = 0
+
+		# the record is on disk before the log says it is
+		with open(self._shard_path(self._shard), 'ab') as f:
+			cPickle.dump(record, f, cPickle.HIGHEST_PROTOCOL)
+			f.flush()
+			os.fsync(f.fileno())
+			self._offset = f.tell()
+
+		with open(os.path.join(self.output_dir, DONE_FILENAME), 'a') as f:
+			f.write('%s\t%d\t%d\n' % (filename, self._shard, self._offset))
+			f.flush()
+			os.fsync(f.fileno())
+		self.done.add(filename)
+
+		self._next_article_idx = article_reader._next_article_idx
+		article_reader.matches.clear()
+		del article_reader.errors[:]
+		article_reader.idx_to_article.clear()
+		article_reader.updated_articles.clear()
@@ -0,0 +1,261 @@
+'''
+	columnar storage for matches.
+
+	instead of one dict per match, a MatchStore keeps one flat array per field.
+	quote texts, urls and transcript names are stored once each and referred to by
+	id, and the per-segment paragraphs and alignments of all matches are
+	concatenated, with offsets marking where each match's (or segment's) entries
+	start. the store still reads like a list of match dicts (see ArticleReader
+	for their format), so code written for those keeps working.
+
+	store_dir layout:
+
+		meta.pk: {'quotes', 'urls', 'transcript_names'}
+		one .npy file per entry of COLUMNS:
+			quote_ids, url_ids, article_idx, transcript_ids, similarity: one entry
+				per match
+			seg_offsets: position of each match's first segment in paragraphs and
+				align_offsets (with an extra entry at the end)
+			paragraphs: paragraph matched by each segment
+			align_offsets, align_values: alignments of all segments, concatenated,
+				and the position of each segment's first entry (with an extra
+				entry at the end)
+'''
+
+import os
+import pickle
+import cPickle
+from array import array
+import numpy as np
+
+META_FILENAME = 'meta.pk'
+
+# column name -> array typecode
+COLUMNS = [
+		('quote_ids', 'i'),
+		('url_ids', 'i'),
+		('article_idx', 'i'),
+		('transcript_ids', 'i'),
+		('similarity', 'd'),
+		('seg_offsets', 'l'),
+		('paragraphs', 'i'),
+		('align_offsets', 'l'),
+		('align_values', 'i')
+	]
+
+
+def _to_numpy(column, typecode):
+
+	# numpy array with the contents of an array.array, without going through a list
+	if len(column) == 0:
+		return np.zeros(0, dtype=np.dtype(typecode))
+	return np.frombuffer(column, dtype=np.dtype(typecode))
+
+
+class _Table(object):
+
+	# list of distinct strings plus the reverse map
+
+	def __init__(self, values=()):
+
+		self.values = list(values)
+		self.ids = dict((value, value_id) for value_id, value in enumerate(self.values))
+
+	def intern(self, value):
+
+		value_id = self.ids.get(value, None)
+		if value_id is None:
+			value_id = self.ids[value] = len(self.values)
+			self.values.append(value)
+		return value_id
+
+
+class MatchStore(object):
+
+	'''
+		list-like, columnar store of match dicts (see above).
+
+		supports append, extend, len, indexing, iteration and clear. indexing and
+		iteration build the match dicts on the fly: 'paragraph' comes out as a
+		list of ints and 'alignment' as a list of tuples, one per segment.
+
+		Structures:
+
+			quotes, urls, transcript_names: tables of the distinct strings
+			plus one array per entry of COLUMNS; array.arrays while matches are
+				appended, (memory-mapped) numpy arrays after load.
+	'''
+
+	def __init__(self):
+
+		self._quotes = _Table()
+		self._urls = _Table()
+		self._transcript_names = _Table()
+		for name, typecode in COLUMNS:
+			setattr(self, name, array(typecode))
+		self.seg_offsets.append(0)
+		self.align_offsets.append(0)
+
+	@property
+	def quotes(self):
+		return self._quotes.values
+
+	@property
+	def urls(self):
+		return self._urls.values
+
+	@property
+	def transcript_names(self):
+		return self._transcript_names.values
+
+	def _make_appendable(self):
+
+		# a loaded store holds numpy arrays; copy them into array.arrays before appending
+
+		for name, typecode in COLUMNS:
+			column = getattr(self, name)
+			if not isinstance(column, array):
+				setattr(self, name, array(typecode, column.tolist()))
+
+	def append(self, match):
+
+		'''
+			adds a match dict. raises TypeError, and leaves the store as it was, if
+			a paragraph or alignment isn't made of ints.
+		'''
+
+		if not isinstance(self.quote_ids, array):
+			self._make_appendable()
+
+		# converted first, so a bad match can't leave the columns out of step
+		paragraphs = array('i', match['paragraph'])
+		alignments = [array('i', alignment) for alignment in match['alignment']]
+		article_idx = int(match['article_idx'])
+		similarity = float(match['similarity'])
+
+		self.quote_ids.append(self._quotes.intern(match['quote']))
+		self.url_ids.append(self._urls.intern(match['url']))
+		self.article_idx.append(article_idx)
+		self.transcript_ids.append(self._transcript_names.intern(match['transcript_name']))
+		self.similarity.append(similarity)
+
+		for paragraph, alignment in zip(paragraphs, alignments):
+			self.paragraphs.append(paragraph)
+			self.align_values.extend(alignment)
+			self.align_offsets.append(len(self.align_values))
+		self.seg_offsets.append(len(self.paragraphs))
+
+	def extend(self, matches):
+		for match in matches:
+			self.append(match)
+
+	def clear(self):
+
+		'''
+			removes all matches, and the quotes, urls and transcript names they
+			referred to, so a store that's cleared after every file (see
+			MatchSink) stays small.
+		'''
+
+		self._quotes = _Table()
+		self._urls = _Table()
+		self._transcript_names = _Table()
+		for name, typecode in COLUMNS:
+			setattr(self, name, array(typecode))
+		self.seg_offsets.append(0)
+		self.align_offsets.append(0)
+
+	def __len__(self):
+		return len(self.quote_ids)
+
+	def __getitem__(self, k):
+
+		if k < 0:
+			k += len(self)
+		if k < 0 or k >= len(self):
+			raise IndexError('match index out of range')
+
+		seg_start = self.seg_offsets[k]
+		seg_end = self.seg_offsets[k+1]
+		align_offsets = self.align_offsets[seg_start:seg_end+1].tolist()
+		alignment = [tuple(self.align_values[align_offsets[j]:align_offsets[j+1]].tolist())
+					for j in range(seg_end - seg_start)]
+
+		return {
+				'quote': self._quotes.values[self.quote_ids[k]],
+				'url': self._urls.values[self.url_ids[k]],
+				'article_idx': int(self.article_idx[k]),
+				'transcript_name': self._transcript_names.values[self.transcript_ids[k]],
+				'paragraph': self.paragraphs[seg_start:seg_end].tolist(),
+				'alignment': alignment,
+				'similarity': float(self.similarity[k])
+			}
+
+	def __iter__(self):
+		for k in range(len(self)):
+			yield self[k]
+
+	def save(self, store_dir):
+
+		'''
+			writes the store to store_dir (created if needed).
+		'''
+
+		if not os.path.exists(store_dir):
+			os.makedirs(store_dir)
+
+		for name, typecode in COLUMNS:
+			column = getattr(self, name)
+			if isinstance(column, array):
+				column = _to_numpy(column, typecode)
+			np.save(os.path.join(store_dir, name + '.npy'), column)
+
+		meta = {
+				'quotes': self._quotes.values,
+				'urls': self._urls.values,
+				'transcript_names': self._transcript_names.values
+			}
+		with open(os.path.join(store_dir, META_FILENAME), 'wb') as f:
+			cPickle.dump(meta, f, cPickle.HIGHEST_PROTOCOL)
+
+	def save_list(self, path, batch_size=1000):
+
+		'''
+			writes the matches to path as a pickled list of match dicts, which
+			cPickle.load reads back just like a pickle of list(store). the dicts
+			are built and pickled one at a time, never all at once.
+		'''
+
+		# the opcodes cPickle writes for a list: an empty list, then its items in
+			# batches (MARK, items, APPENDS). each item is pickled on its own, minus
+			# its PROTO and STOP; its memo entries only need to last while it's read.
+		with open(path, 'wb') as f:
+			f.write(pickle.PROTO + chr(2) + pickle.EMPTY_LIST)
+			for start in range(0, len(self), batch_size):
+				f.write(pickle.MARK)
+				for k in range(start, min(start + batch_size, len(self))):
+					f.write(cPickle.dumps(self[k], 2)[2:-1])
+				f.write(pickle.APPENDS)
+			f.write(pickle.STOP)
+
+	@classmethod
+	def load(cls, store_dir, mmap=True):
+
+		'''
+			opens a store written by save. with mmap, the arrays are memory-mapped
+			rather than read in. appending to a loaded store copies them into memory first.
+		'''
+
+		store = cls.__new__(cls)
+		with open(os.path.join(store_dir, META_FILENAME), 'rb') as f:
+			meta = cPickle.load(f)
+		store._quotes = _Table(meta['quotes'])
+		store._urls = _Table(meta['urls'])
+		store._transcript_names = _Table(meta['transcript_names'])
+
+		for name, typecode in COLUMNS:
+			column = np.load(os.path.join(store_dir, name + '.npy'),
+							mmap_mode='r' if mmap else None)
+			# plain ndarray views of the memmaps index much faster (see Corpus)
+			setattr(store, name, column.view(np.ndarray))
+		return store
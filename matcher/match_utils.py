@@ -29,9 +29,21 @@ NUM_MAP = {'0':'zero', '1': 'one', '2':'two','3':'three','4':'four',
 PUNCTUATION = '"&\'()+,-./:;<=>@[\\]^_`{|}~'
 
 
+# anything standardize_formatting would change; phrases without any of these are
+	# already in standard format
+_FORMAT_TRIGGER_RE = re.compile('|'.join([re.escape(x) for x in HYPHEN_TYPES]
+			+ [re.escape(x) for x in ['\xe2\x80\xa6', '\xc2\xa0', ' per cent ', ' usd ', '%']]
+			+ [r'\d dollars']))
+_DOLLARS_RE = re.compile(r'\d+ dollars')
+
+# words seen by _convert_word, and what they convert to
+_WORD_CACHE_SIZE = 500000
+_word_cache = {}
+
+
 def _no_punct(phrase):
 	#retains % and $
-	return ' '.join(phrase.translate(string.maketrans("",""),PUNCTUATION).split())
+	return ' '.join(phrase.translate(None, PUNCTUATION).split())
 
 def _handle_hyphens(phrase):
 	#sort of valiant attempt to manage hyphens
@@ -45,12 +57,16 @@ def standardize_formatting(phrase):
 		Converts texts to standard format.
 		Currently this tries to match format in speech transcripts.
 	'''
+	# one scan to see if there's anything to do. the replacements below can
+		# create matches for each other, so they still run in order when there is.
+	if not _FORMAT_TRIGGER_RE.search(phrase):
+		return phrase
 	formatted_phrase = _handle_hyphens(phrase)
 	formatted_phrase = formatted_phrase.replace('\xe2\x80\xa6', '... ').replace('\xc2\xa0', '')
 	formatted_phrase = formatted_phrase.replace(' per cent ', ' percent ')
 	formatted_phrase = formatted_phrase.replace(' usd ', ' $')
 	formatted_phrase = formatted_phrase.replace('%',' percent')
-	formatted_phrase = re.sub(r'\d+ dollars', lambda x: '$'+x.group(0).split()[0], formatted_phrase)
+	formatted_phrase = _DOLLARS_RE.sub(lambda x: '$'+x.group(0).split()[0], formatted_phrase)
 	return formatted_phrase
 
 def convert_to_display_array(phrase, formatfn = lambda x: x):
@@ -69,12 +85,15 @@ def _convert_word(word):
 	
 	#Strips capitalization and punctuation from word;
 	#also converts numerals to words if < 10.
+	#results are cached, since the same words come up over and over.
 
-	converted = word
-	num_equiv = NUM_MAP.get(word, None)
-	if num_equiv is not None:
-		converted = num_equiv
-	return _no_punct(converted).lower()
+	converted = _word_cache.get(word, None)
+	if converted is None:
+		if len(_word_cache) >= _WORD_CACHE_SIZE:
+			_word_cache.clear()
+		converted = _no_punct(NUM_MAP.get(word, word)).lower()
+		_word_cache[word] = converted
+	return converted
 
 def convert_to_match_array(phrase, display_array=None, formatfn = lambda x: x):
 	'''
@@ -115,6 +134,34 @@ def segment_quote(quote):
 	return [tuple(seg) for seg in processed_segments]
 
 
+def tokenize_quotes(quotes, vocab=None):
+
+	'''
+		segments many quotes at once (see segment_quote), each distinct text only
+		once, and looks up the token ids of their words.
+
+		Arguments:
+			quotes: list of quote texts
+			vocab: map of word to token id, e.g. NgramIndex.vocab; it isn't
+				added to, words not in it get -1.
+
+		Returns:
+			dict of quote text to (segments, token ids), where token ids is a tuple
+				of token ids for each segment, or None if there's no vocab.
+	'''
+
+	tokenized = {}
+	for quote in quotes:
+		if quote in tokenized:
+			continue
+		segment_arr = segment_quote(quote)
+		token_arr = None
+		if vocab is not None:
+			token_arr = [tuple([vocab.get(word, -1) for word in seg]) for seg in segment_arr]
+		tokenized[quote] = (segment_arr, token_arr)
+	return tokenized
+
+
 def _subarray_search(small_array, big_array, startindex):
 
 	for i in range(startindex, len(big_array) - len(small_array) + 1):
@@ -137,7 +184,7 @@ def align_verbatim(quote_array, transcript_array):
 			if snip_match_result:
 				if (transcript_array[snip_match_result[0]-1].endswith(quote_array[0]) 
                     and transcript_array[snip_match_result[-1]+1].startswith(quote_array[-1])):
-					return tuple(range(snip_match_result[0]-1, snip_match_result[-1]+2)), 0
+					return tuple(range(snip_match_result[0]-1, snip_match_result[-1]+2))
 				else:
 					startindex = snip_match_result[0] + 1
 			else:
@@ -154,7 +201,20 @@ def load_stopword_set(stopword_filename = 'mysql_stop.txt'):
 	return stopword_set
 
 def match_segment_to_paragraph(segment_arr, paragraph_dict, stopword_set,
-								min_fuzz_len, word_ratio):
+								min_fuzz_len, word_ratio, min_score = None, backend = 'nw'):
+	'''
+		Matches a segment to a paragraph: verbatim if possible, otherwise by
+		alignment if enough of its words are in the paragraph.
+
+		Arguments:
+			min_score (float, optional): see align_paraphrase
+			backend ('nw' or 'bits', default='nw'): with 'bits', the score is first
+				worked out by score_paraphrase, and only segments scoring at least
+				min_score are aligned. those below come out as (None, score).
+
+		Returns:
+			(alignment, score); (None, None) if the segment can't match.
+	'''
 	segment_arr = list(segment_arr)
 	raw_text = ' '.join(segment_arr)
 	alignment = None
@@ -182,39 +242,196 @@ def match_segment_to_paragraph(segment_arr, paragraph_dict, stopword_set,
 
 	if intersect_ratio >= word_ratio:
 
-		alignment, score = align_paraphrase(segment_arr, paragraph_dict['match'])
+		if backend == 'bits':
+			score = score_paraphrase(segment_arr, paragraph_dict['match'])
+			if min_score is not None and score < min_score:
+				return (None, score)
+		alignment, score = align_paraphrase(segment_arr, paragraph_dict['match'],
+								min_score = min_score)
 		return (alignment, score)
 	else:
 		return (None, None)
 
-def align_paraphrase(quote_array, transcript_array, sub_pen = -1, gap_pen = -1):
+def _edit_distance_bits(quote_array, transcript_array):
+
+	# Myers' bit-vector algorithm, for the word edit distance between the quote and
+	# its best matching substring of the transcript. bit i of each vector is row i+1
+	# of a column of the (distance) DP matrix; python ints make any quote length work.
+	# Pv/Mv: rows where the column goes up/down by one from the row above.
+
+	m = len(quote_array)
+	if m == 0:
+		return 0
+	mask = (1 << m) - 1
+	top = 1 << (m - 1)
+
+	# bits of the quote positions holding each word
+	peq = {}
+	for i, word in enumerate(quote_array):
+		peq[word] = peq.get(word, 0) | (1 << i)
+	peq_get = peq.get
+
+	pv = mask
+	mv = 0
+	dist = m
+	best = m
+	for word in transcript_array:
+		eq = peq_get(word, 0)
+		xv = eq | mv
+		xh = (((eq & pv) + pv) ^ pv) | eq
+		ph = mv | (~(xh | pv) & mask)
+		mh = pv & xh
+		if ph & top:
+			dist += 1
+		elif mh & top:
+			dist -= 1
+			if dist < best:
+				best = dist
+		# the first row is all zeros (the match can start anywhere), so nothing 
+			# is shifted in at the bottom
+		ph = (ph << 1) & mask
+		mh = (mh << 1) & mask
+		pv = mh | (~(xv | ph) & mask)
+		mv = ph & xv
+	return best
+
+def score_paraphrase(quote_array, transcript_array):
 	'''
-		Uses Needleman-Wunsch to align a quote to a transcript, returning tuple (alignment, similarity score).
-
-		Note this is a modified version of NW to deal with aligning a short string to a substring of a longer string.
+		Returns just the similarity score align_paraphrase would give (with the default
+		penalties of -1), without building the alignment matrix.
 
-		In particular, gaps before and after the occurrence of the substring are not penalized.
+		With unit penalties the score is minus the word edit distance between quote and 
+		the closest substring of transcript, divided by the quote length; that's computed
+		with a bit-parallel algorithm (Myers) in time linear in the transcript length.
 	'''
-		# initialization 
-	sseq = [''] + list(quote_array)
-	bseq = [''] + transcript_array
-	slen = len(sseq)
-	blen = len(bseq)
+	return -_edit_distance_bits(quote_array, transcript_array) / len(quote_array)
+
+def _encode_tokens(quote_array, transcript_array):
+
+	# maps words to integer ids, local to this quote. transcript words that 
+	# never occur in the quote all share the id -1, since they can never match.
+
+	vocab = {}
+	quote_ids = np.array([vocab.setdefault(word, len(vocab)) for word in quote_array],
+						dtype=np.int32)
+	transcript_ids = np.array([vocab.get(word, -1) for word in transcript_array],
+						dtype=np.int32)
+	return quote_ids, transcript_ids
+
+def _nw_matrix(quote_ids, transcript_ids, sub_pen, gap_pen):
+
+	# fills the NW matrix one row at a time. the diagonal and vertical moves only
+	# depend on the previous row; the horizontal moves are a running max, since
+	# nw[i,j] = max over k <= j of (cand[k] + gap_pen * (j-k)).
+
+	slen = len(quote_ids) + 1
+	blen = len(transcript_ids) + 1
 	nw_matrix = np.zeros((slen, blen))
-	nw_matrix[:,0] = gap_pen * np.array(range(0, slen))
+	nw_matrix[:,0] = gap_pen * np.arange(slen)
+	gap_steps = gap_pen * np.arange(blen)
 
-	# score
-	#return nw_matrix
+	cand = np.empty(blen)
+	for i in range(1, slen):
+		prev = nw_matrix[i-1]
+		subcost = np.where(transcript_ids == quote_ids[i-1], 0, sub_pen)
+		cand[0] = nw_matrix[i,0]
+		np.maximum(prev[:-1] + subcost, prev[1:] + gap_pen, out=cand[1:])
+		nw_matrix[i] = np.maximum.accumulate(cand - gap_steps) + gap_steps
+	return nw_matrix
+
+def _nw_matrix_banded(quote_ids, transcript_ids, sub_pen, gap_pen, min_score):
+
+	# like _nw_matrix, but gives up on any cell that can no longer lead to a score
+	# of min_score. penalties are never positive, so scores only fall along a path,
+	# and a cell below min_score * len(quote) can't be on an acceptable alignment.
+	# such cells are set to -inf, and each row is only filled between the first and
+	# last cells of the row above that are still in play (plus how far a run of
+	# horizontal gaps could get). returns None as soon as a row has no cells in play.
+	#
+	# cells that stay in play only ever come from cells in play, so they (and any
+	# alignment that passes) are exactly as in _nw_matrix.
+
+	slen = len(quote_ids) + 1
+	blen = len(transcript_ids) + 1
+	# a hair below the threshold, so rounding can't throw out a passing alignment
+	floor = min_score * (slen - 1) - 1e-6
+
+	# each quote word left without a matching transcript word costs at least this
+	min_cost = min(-sub_pen, -gap_pen)
+
+	# counting words, at most sum(min(count in quote, count in transcript)) quote
+	# words can be matched; often the rest is already too many.
+	# ids are local (see _encode_tokens) or global, with -1 for transcript words
+	# the caller knows aren't in the quote; both counts cover every id in either.
+	num_ids = max(quote_ids.max(), transcript_ids.max() if blen > 1 else -1) + 2
+	quote_counts = np.bincount(quote_ids, minlength=num_ids)
+	transcript_counts = np.bincount(transcript_ids + 1, minlength=num_ids + 1)[1:]
+	unmatched = len(quote_ids) - np.minimum(quote_counts, transcript_counts).sum()
+	if -min_cost * unmatched < floor:
+		return None
+
+	# quote words that aren't in the transcript at all can't be matched either,
+	# so a cell also has to leave room for those still to come in later rows.
+	missing = transcript_counts[quote_ids] == 0
+	missing_after = np.append(np.cumsum(missing[::-1])[::-1], 0)
+	floors = floor + min_cost * missing_after
+
+	nw_matrix = np.empty((slen, blen))
+	nw_matrix[0] = 0
+	nw_matrix[1:] = -np.inf
+	gap_steps = gap_pen * np.arange(blen)
+
+	lo, hi = 0, blen - 1
 	for i in range(1, slen):
-		for j in range(1, blen):
-			subcost = 0 if sseq[i]==bseq[j] else sub_pen
-			nw_matrix[i,j] = max(nw_matrix[i-1,j-1]+subcost, 
-                                nw_matrix[i-1,j]+ gap_pen, 
-                                nw_matrix[i,j-1] + gap_pen)
+		prev = nw_matrix[i-1]
+		row = nw_matrix[i]
+		row_floor = floors[i]
+		if gap_pen * i >= row_floor:
+			row[0] = gap_pen * i
+
+		if hi + 1 < blen:
+			if gap_pen < 0:
+				reach = int((prev[lo:hi+1].max() - row_floor) / -gap_pen) + 1
+			else:
+				reach = blen
+			end = min(blen - 1, hi + 1 + reach)
+		else:
+			end = blen - 1
+		start = max(lo, 1)
+
+		if start <= end:
+			subcost = np.where(transcript_ids[start-1:end] == quote_ids[i-1], 0, sub_pen)
+			cand = np.empty(end - start + 2)
+			cand[0] = row[start-1]
+			np.maximum(prev[start-1:end] + subcost, prev[start:end+1] + gap_pen, out=cand[1:])
+			steps = gap_steps[:len(cand)]
+			cells = (np.maximum.accumulate(cand - steps) + steps)[1:]
+			out_of_play = cells < row_floor
+			cells[out_of_play] = -np.inf
+			row[start:end+1] = cells
+			in_play = np.flatnonzero(~out_of_play)
+		else:
+			in_play = ()
+
+		if len(in_play) > 0:
+			lo = 0 if row[0] > -np.inf else start + in_play[0]
+			hi = start + in_play[-1]
+		elif row[0] > -np.inf:
+			lo = hi = 0
+		else:
+			return None
+	return nw_matrix
+
+def _nw_traceback(nw_matrix, quote_ids, transcript_ids, sub_pen, gap_pen):
+
+	# walks back from the best cell of the last row. ties are broken in favour of
+	# the rightmost end cell, then horizontal gaps, then vertical gaps.
+
+	slen, blen = nw_matrix.shape
 	max_ind_rev = np.argmax(nw_matrix[-1,:][::-1])
 	max_ind = blen - max_ind_rev - 1
 	max_score = nw_matrix[-1, max_ind]
-	weighted_score = max_score/len(quote_array)
+	weighted_score = max_score/(slen-1)
 	align_vect = [0] * (slen-1)
 	i = slen - 1
 	j = max_ind
@@ -225,8 +442,45 @@ def align_paraphrase(quote_array, transcript_array, sub_pen = -1, gap_pen = -1):
 			align_vect[i-1] = -1
 			i -= 1
 		else:
-			subcost = 0 if sseq[i]==bseq[j] else sub_pen
+			subcost = 0 if quote_ids[i-1]==transcript_ids[j-1] else sub_pen
 			align_vect[i-1] = -1 if subcost < 0 else j-1
 			i -= 1
 			j -= 1
-	return tuple(align_vect), weighted_score
\ No newline at end of file
+	return tuple(align_vect), weighted_score
+
+def align_paraphrase_ids(quote_ids, transcript_ids, sub_pen = -1, gap_pen = -1, 
+						min_score = None):
+	'''
+		Same as align_paraphrase, but takes quote and transcript as arrays of integer 
+		token ids rather than lists of words. ids are non-negative, except that
+		transcript words known not to be in the quote may all be -1.
+	'''
+	quote_ids = np.asarray(quote_ids, dtype=np.int32)
+	transcript_ids = np.asarray(transcript_ids, dtype=np.int32)
+	if min_score is None or sub_pen > 0 or gap_pen > 0:
+		nw_matrix = _nw_matrix(quote_ids, transcript_ids, sub_pen, gap_pen)
+	else:
+		nw_matrix = _nw_matrix_banded(quote_ids, transcript_ids, sub_pen, gap_pen, min_score)
+		if nw_matrix is None:
+			return (None, -np.inf)
+	return _nw_traceback(nw_matrix, quote_ids, transcript_ids, sub_pen, gap_pen)
+
+def align_paraphrase(quote_array, transcript_array, sub_pen = -1, gap_pen = -1,
+						min_score = None):
+	'''
+		Uses Needleman-Wunsch to align a quote to a transcript, returning tuple (alignment, similarity score).
+
+		Note this is a modified version of NW to deal with aligning a short string to a substring of a longer string.
+
+		In particular, gaps before and after the occurrence of the substring are not penalized.
+
+		Words are mapped to integer ids first, and the matrix is filled a row at a time with numpy.
+
+		Arguments:
+			min_score (float, optional): lowest similarity the caller has any use for.
+				alignment stops as soon as it can't be reached, and only the cells that
+				can still reach it are filled. alignments scoring at least min_score
+				come out exactly the same; anything below may come out as (None, -inf).
+	'''
+	quote_ids, transcript_ids = _encode_tokens(quote_array, transcript_array)
+	return align_paraphrase_ids(quote_ids, transcript_ids, sub_pen, gap_pen, min_score)
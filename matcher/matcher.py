@@ -2,6 +2,12 @@ from __future__ import division
 import datetime as dt 
 import os, string, collections, cPickle, bisect
 import match_utils as mu 
+from word_index import WordIndex
+from ngram_index import NgramIndex
+from lsh_index import LSHIndex
+from prefilter import QuotePrefilter
+from persistent_cache import PersistentCache, quote_digest
+from lru_cache import LRUCache, alignment_entry_size
 
 
 
@@ -14,8 +20,19 @@ class QuoteMatcher:
 	SUB_PEN = -1
 	ACCEPT_THRESHOLD = -.1
 
+	# byte budget of each cache; override any of them with the cache_bytes argument
+	CACHE_BYTES = {
+		'segment_ids': 64 * 2**20,
+		'seg_para': 256 * 2**20,
+		'seg_transcript': 128 * 2**20,
+		'quote_transcript': 256 * 2**20,
+		'quote_window': 256 * 2**20
+	}
+
 	def __init__(self, transcript_order, transcript_collection,
-		stopword_file = 'mysql_stop.txt', sim_tolerance = -.4, word_ratio = .75, verbose = 0):
+		stopword_file = 'mysql_stop.txt', sim_tolerance = -.4, word_ratio = .75, verbose = 0,
+		use_index = True, cache_bytes = None, align_backend = 'bits', candidate_index = 'exact',
+		lsh_params = None, use_prefilter = True, persistent_cache = None):
 
 		self.order = [x[0] for x in transcript_order]
 
@@ -29,26 +46,397 @@ class QuoteMatcher:
 
 		self.verbose = verbose
 
-		# (segment as tup, transcriptname, paragraph num) -> {alignment, similarity}
-		self.seg_para_cache = {}
+		# how segments are scored against paragraphs; see mu.match_segment_to_paragraph
+		self.align_backend = align_backend
+
+		# word -> paragraphs, so we only align segments to paragraphs that could match,
+		# and k-gram -> positions, so we can find verbatim matches without scanning
+		# (a compiled Corpus has them built in already.)
+		corpus = getattr(transcript_collection, 'corpus', None)
+		if use_index and corpus is not None:
+			self.word_index = WordIndex.from_corpus(corpus, self.stopwords)
+			self.ngram_index = NgramIndex.from_corpus(corpus)
+		elif use_index:
+			self.word_index = WordIndex(self.order, self.transcripts, self.stopwords)
+			self.ngram_index = NgramIndex(self.order, self.transcripts)
+		else:
+			self.word_index = None
+			self.ngram_index = None
+
+		# optionally, fuzzy candidates come from an LSH index instead, trading some
+			# recall for speed on big collections (see lsh_index.measure_recall)
+		self.lsh_index = None
+		if use_index and candidate_index == 'lsh':
+			self.lsh_index = LSHIndex(self.order, self.transcripts, self.stopwords,
+									**(lsh_params or {}))
+
+		# Bloom filters of each transcript's (and week's) words and k-grams, to throw out
+			# quotes that can't match anything in their window before searching it.
+		# they're filled from the n-gram index's token arrays (built just for this if
+			# use_index is off).
+		self.prefilter = None
+		if use_prefilter:
+			ngram_index = self.ngram_index
+			if ngram_index is None and corpus is not None:
+				ngram_index = NgramIndex.from_corpus(corpus)
+			elif ngram_index is None:
+				ngram_index = NgramIndex(self.order, self.transcripts)
+			self.prefilter = QuotePrefilter(self.times, ngram_index, self.stopwords,
+								self.MIN_FUZZ_LEN, self.word_ratio)
+
+		# caches are LRU, each with its own byte budget. transcripts are referred to
+			# by their index in self.order and segments by an interned id.
+		budgets = dict(self.CACHE_BYTES)
+		if cache_bytes is not None:
+			budgets.update(cache_bytes)
+
+		# segment as tup -> segment id
+		self.segment_ids = LRUCache(budgets['segment_ids'])
+		self._next_segment_id = 0
+
+		# (segment id, transcript idx, paragraph num) -> (alignment, similarity)
+		# these two are filled on every alignment, so entry sizes come from their shape
+		self.seg_para_cache = LRUCache(budgets['seg_para'], alignment_entry_size)
+
+		# (segment id, transcript idx) -> (alignment, paragraphnum, similarity)
+		self.seg_transcript_cache = LRUCache(budgets['seg_transcript'], alignment_entry_size)
+
+		# (quote text, transcript idx) -> {alignment, paragraphnum, similarity}
+		self.quote_transcript_cache = LRUCache(budgets['quote_transcript'])
+
+		# (quote text, earliest transcript idx, latest transcript idx) ->
+			# {paragraph, alignment, similarity, transcript_name}
+		# keyed on the window of transcripts searched rather than the article's 
+			# timestamp, so a quote repeated across articles is matched once per window.
+		self.quote_window_cache = LRUCache(budgets['quote_window'])
+
+		# optionally, quote_transcript_cache is backed by a database file shared
+			# between runs (and processes), keyed by the settings that affect results.
+		self.persistent_cache = None
+		if persistent_cache is not None:
+			params = {
+					'sim_tolerance': self.tol,
+					'word_ratio': self.word_ratio,
+					'min_fuzz_len': self.MIN_FUZZ_LEN,
+					'gap_pen': self.GAP_PEN,
+					'sub_pen': self.SUB_PEN,
+					'stopwords': sorted(self.stopwords),
+					'align_backend': self.align_backend,
+					'candidate_index': candidate_index,
+					'lsh_params': sorted((lsh_params or {}).items())
+				}
+			self.persistent_cache = PersistentCache(persistent_cache, self.order, 
+										self.transcripts, params)
+
+	def cache_stats(self):
+
+		'''
+			returns dict of cache name to hit/miss/eviction counters (see LRUCache.stats)
+		'''
+
+		return {
+				'segment_ids': self.segment_ids.stats(),
+				'seg_para': self.seg_para_cache.stats(),
+				'seg_transcript': self.seg_transcript_cache.stats(),
+				'quote_transcript': self.quote_transcript_cache.stats(),
+				'quote_window': self.quote_window_cache.stats(),
+				'persistent': self.persistent_cache.stats() if self.persistent_cache is not None else None
+			}
+
+	def flush_persistent_cache(self):
+
+		'''
+			writes buffered results to the persistent cache, if there is one.
+		'''
+
+		if self.persistent_cache is not None:
+			self.persistent_cache.flush()
+
+	def _segment_id(self, segment):
+
+		# ids are never reused, so cache entries of an evicted segment just go stale.
+
+		seg_id = self.segment_ids.get(segment, None)
+		if seg_id is None:
+			seg_id = self._next_segment_id
+			self._next_segment_id += 1
+			self.segment_ids[segment] = seg_id
+		return seg_id
+
+	def _candidate_paragraphs(self, curr_seg, earliest_transcript_index, latest_transcript_index,
+		token_ids = None):
+
+		# returns (candidates, verbatim): paragraphs in the window that the segment 
+		# could match, and paragraphs it occurs in verbatim, per transcript index.
+		# None means we have to look at everything. token_ids is the segment as
+		# token ids of the n-gram index, if we have them already.
+
+		if self.word_index is None:
+			return None, None
+
+		hits = self.ngram_index.lookup(curr_seg, earliest_transcript_index, 
+						latest_transcript_index, token_ids)
+		verbatim = None
+		if hits is not None:
+			verbatim = {}
+			for transcript_idx, para_idx, offset, trimmed in hits:
+				para_list = verbatim.setdefault(transcript_idx, [])
+				if len(para_list) == 0 or para_list[-1] != para_idx:
+					para_list.append(para_idx)
+
+		# the LSH index only stands in for the fuzzy part, so verbatim matches have to
+			# come from the k-gram index.
+		if (self.lsh_index is not None and verbatim is not None
+				and len(curr_seg) >= self.MIN_FUZZ_LEN):
+			candidates = self.lsh_index.candidates(curr_seg, earliest_transcript_index,
+							latest_transcript_index, self.word_ratio)
+			for transcript_idx, para_list in verbatim.iteritems():
+				fuzzy_list = candidates.get(transcript_idx, [])
+				fuzzy_paras = set(para_idx for para_idx, overlap in fuzzy_list)
+				candidates[transcript_idx] = sorted(fuzzy_list
+					+ [(para_idx, None) for para_idx in para_list if para_idx not in fuzzy_paras])
+			return candidates, verbatim
+
+		candidates = self.word_index.candidates(curr_seg, earliest_transcript_index,
+						latest_transcript_index, self.MIN_FUZZ_LEN, self.word_ratio)
+		return candidates, verbatim
+
+	def _match_segment_to_transcript(self, curr_seg, seg_id, transcript_idx, paragraph_nums, 
+		verbatim_nums = (), paragraphs = None):
+
+		'''
+			finds the paragraph of a transcript that best matches a segment.
+			only the paragraphs in paragraph_nums are checked, in that order.
+
+			verbatim_nums are paragraphs the segment is known to occur in verbatim;
+			they are tried first since an exact match ends the search.
+
+			paragraphs are the transcript's paragraphs, if the caller already has them.
+
+			returns (alignment, paragraph num, similarity)
+		'''
+
+		if paragraphs is None:
+			paragraphs = self.transcripts[self.order[transcript_idx]]['paragraphs']
+
+		# the first exact match wins, and every exact match is in verbatim_nums.
+		for k in verbatim_nums:
+			align, score = mu.match_segment_to_paragraph(curr_seg,
+								paragraphs[k], self.stopwords, self.MIN_FUZZ_LEN,
+								self.word_ratio, self.tol, self.align_backend)
+			if score == 0:
+				return align, k, score
+
+		# keep track of the best seg -> para align.
+		best_para_align = None
+		best_para = None
+		best_para_score = None
+
+		for k in paragraph_nums:
+			
+
+			# we check the cache first
+			cached_para_result = self.seg_para_cache.get((seg_id, transcript_idx, k), None)
+			if cached_para_result is not None:
+
+				cached_align, cached_score = cached_para_result
+
+				# if exact match, then we found the best paragraph so quit
+				if cached_score == 0:
+					best_para_align = cached_align
+					best_para = k
+					best_para_score = 0
+					break
+
+				# definitely not a match
+				elif cached_score < self.tol:
+					continue
 
-		# (segment as tup, transcriptname) -> {alignment, paragraphnum, similarity}
-		self.seg_transcript_cache = {}
+				# we beat the current best, so take note
+				elif cached_score >= best_para_score:
 
-		# (quote text, transcriptname) -> {alignment, paragraphnum, similarity}
-		self.quote_transcript_cache = {}
+					best_para_align = cached_align
+					best_para = k
+					best_para_score = cached_score
+			
+			else:
+				# we are forced to work now
+				curr_para = paragraphs[k]
+				# alignments below tol are of no use, so they can be cut short
+				align, score = mu.match_segment_to_paragraph(curr_seg,
+									curr_para, self.stopwords, self.MIN_FUZZ_LEN,
+									self.word_ratio, self.tol, self.align_backend)
+
+				# cache result
+				self.seg_para_cache[(seg_id, transcript_idx, k)] = (align, score)
+
+				# we hit a perfect match! so we don't have to look at any more paras.
+				if score == 0:
+					best_para_align = align
+					best_para = k
+					best_para_score = score
+					
+					break
+				# we beat the record, so take note.
+				elif score >= self.tol and score >= best_para_score:
+					best_para_align = align
+					best_para = k
+					best_para_score = score
+
+		return best_para_align, best_para, best_para_score
+
+	def _quote_window(self, timestamp):
 
-		# (quote text, timestamp) -> {paragraph, alignment, similarity, transcript_name}
-		self.quote_time_cache = {}
+		# (earliest, latest) indices of the transcripts a quote from timestamp could
+		# come from, or None if there are none.
+
+		latest_transcript_index = bisect.bisect_left(self.times, timestamp) - 1
+		earliest_transcript_index = bisect.bisect_left(self.times, timestamp - self.MAX_INTERVAL)
+
+		# (the last is for quotes with no transcript in the MAX_INTERVAL before them)
+		if (latest_transcript_index < 0 or earliest_transcript_index >= len(self.times)
+				or earliest_transcript_index > latest_transcript_index):
+			return None
+		return earliest_transcript_index, latest_transcript_index
+
+	def _match_quote_to_transcript(self, quote, segment_arr, seg_ids, i, seg_candidates,
+		seg_windows, paragraphs = None, seg_tokens = None):
+
+		'''
+			matches every segment of a quote to transcript i (or finds one that doesn't
+			match), using and filling the caches, including the persistent one.
+
+			seg_candidates is a map of segment id -> result of _candidate_paragraphs,
+			filled in as needed over the window seg_windows[segment id]. paragraphs
+			are the transcript's paragraphs, if the caller already has them, and
+			seg_tokens a map of segment id -> the segment's token ids, if it has those.
+
+			returns the quote_transcript_cache entry:
+				{alignment, paragraph, similarity}, or {similarity: None} if some
+				segment doesn't match.
+		'''
+
+		# first, see if we already matched quote to this transcript
+		cached_quote_result = self.quote_transcript_cache.get((quote, i), None)
+		if cached_quote_result is not None:
+			return cached_quote_result
+
+		# maybe in an earlier run
+		if self.persistent_cache is not None:
+			quote_key = quote_digest(segment_arr)
+			result = self.persistent_cache.get(quote_key, i)
+			if result is not None:
+				self.quote_transcript_cache[(quote, i)] = result
+				return result
+
+		result = self._match_segments_to_transcript(segment_arr, seg_ids, i, seg_candidates,
+					seg_windows, paragraphs, seg_tokens)
+		self.quote_transcript_cache[(quote, i)] = result
+		if self.persistent_cache is not None:
+			self.persistent_cache.put(quote_key, i, result)
+		return result
+
+	def _match_segments_to_transcript(self, segment_arr, seg_ids, i, seg_candidates,
+		seg_windows, paragraphs, seg_tokens = None):
+
+		# does the work for _match_quote_to_transcript
+
+		curr_align = [None] * len(segment_arr)
+		curr_paras = [None] * len(segment_arr)
+		min_seg_score = None
+
+		# check if we already cached some segments to this transcript
+		for j in range(len(segment_arr)):
+			cached_seg_result = self.seg_transcript_cache.get((seg_ids[j], i), None)
+			if cached_seg_result is not None:
+				cached_align, cached_para, cached_score = cached_seg_result
+
+				# if we see seg with low tol then the entire quote can't match the transcript
+				if cached_score < self.tol:
+					return {'similarity': None}
+
+				# keep track of the cached segment
+				curr_align[j] = cached_align
+				curr_paras[j] = cached_para
+				if min_seg_score is None or cached_score < min_seg_score:
+					min_seg_score = cached_score 
+
+		# now we make the effort to find all uncached segments.
+
+		for j in range(len(segment_arr)):
+
+			# but of course we don't do anything for things we already cached!
+			if curr_align[j] is not None:
+				continue 
+
+			curr_seg = segment_arr[j]
+			seg_id = seg_ids[j]
+
+			# only look at paragraphs that could possibly match.
+			if seg_id not in seg_candidates:
+				earliest_transcript_index, latest_transcript_index = seg_windows[seg_id]
+				token_ids = None
+				if seg_tokens is not None:
+					token_ids = seg_tokens.get(seg_id, None)
+				seg_candidates[seg_id] = self._candidate_paragraphs(curr_seg, 
+										earliest_transcript_index, latest_transcript_index,
+										token_ids)
+			candidates, verbatim = seg_candidates[seg_id]
+			if candidates is None:
+				if paragraphs is None:
+					paragraphs = self.transcripts[self.order[i]]['paragraphs']
+				paragraph_nums = range(len(paragraphs))
+			else:
+				paragraph_nums = [k for k, overlap in candidates.get(i, ())]
+			if verbatim is None:
+				verbatim_nums = ()
+			else:
+				verbatim_nums = verbatim.get(i, ())
+
+			best_para_align, best_para, best_para_score = self._match_segment_to_transcript(
+										curr_seg, seg_id, i, paragraph_nums, verbatim_nums,
+										paragraphs)
+
+			# we finished checking seg against the transcript! let's see what we've found...
+
+			# keep track of the alignment score. recall this is the min of 
+				# each indiv segs score.
+			if min_seg_score is None or best_para_score < min_seg_score:
+
+				min_seg_score = best_para_score
+
+			self.seg_transcript_cache[(seg_id, i)] = (best_para_align, best_para, 
+					best_para_score)
+			if best_para_score >= self.tol:
+				curr_align[j] = best_para_align
+				curr_paras[j] = best_para
+			else:
+				# the entire quote cannot match the transcript.
+				return {'similarity': None}
+
+		# now we've finally matched all segments.
+
+		return {
+				'alignment': curr_align,
+				'paragraph': curr_paras,
+				'similarity': min_seg_score
+			}
 
 	def match_quote(self, quote, timestamp): # decomposition: who does that?
 		if quote[0] == '?':
 			# spinn3r doesn't unicode?!?
 			return None
 
+		# get timespan
+		window = self._quote_window(timestamp)
+		if window is None:
+			return None
+		earliest_transcript_index, latest_transcript_index = window
+
 		#search cache
 
-		cached_quote_result = self.quote_time_cache.get((quote,timestamp), None)
+		window_key = (quote, earliest_transcript_index, latest_transcript_index)
+		cached_quote_result = self.quote_window_cache.get(window_key, None)
 
 		if cached_quote_result is not None:
 			if cached_quote_result['similarity'] >= self.tol:
@@ -59,218 +447,215 @@ class QuoteMatcher:
 
 		# check len req
 		if max([len(x) for x in segment_arr]) < self.MIN_LEN:
-			self.quote_time_cache[(quote, timestamp)] = {'similarity': None}
+			self.quote_window_cache[window_key] = {'similarity': None}
 			return None
-		# get timespan
-		latest_transcript_index = bisect.bisect_left(self.times, timestamp) - 1
-		earliest_transcript_index = bisect.bisect_left(self.times, timestamp - self.MAX_INTERVAL)
-
-		if latest_transcript_index < 0 or earliest_transcript_index >= len(self.times):
-			self.quote_time_cache[(quote, timestamp)] = {'similarity': None}
+		if self.prefilter is not None and not self.prefilter.plausible(segment_arr, 
+				earliest_transcript_index, latest_transcript_index):
+			self.quote_window_cache[window_key] = {'similarity': None}
 			return None
+		seg_ids = [self._segment_id(seg) for seg in segment_arr]
 
 		# now that we know quote satisfies basic time and len, search thru transcripts...
 
 		search_range = range(latest_transcript_index, earliest_transcript_index - 1, -1)
-		best_align = None
-		best_paras = None
-		best_score = None
-		best_transcript = None
+		best = _QuoteSearch()
+
+		# segment id -> candidate paragraphs in the window, filled in as needed
+		seg_candidates = {}
+		seg_windows = dict((seg_id, window) for seg_id in seg_ids)
 		
 		for i in search_range:
+			transcript_result = self._match_quote_to_transcript(quote, segment_arr, seg_ids, i,
+										seg_candidates, seg_windows)
+			# we definitely have a match with this transcript, so we don't
+				# need to look at any other transcripts.
+			if best.update(self.order[i], transcript_result, self.tol, self.ACCEPT_THRESHOLD):
+				break
 
-			curr_tname = self.order[i]
-
-			curr_align = None
-			curr_paras = None
-
-			# first, see if we already matched quote to this transcript
-			cached_quote_result = self.quote_transcript_cache.get((quote,curr_tname), None)
-			if cached_quote_result is not None:
-				curr_score = cached_quote_result['similarity']
-
-				# definitely a match
-				if curr_score >= self.ACCEPT_THRESHOLD:
-					result_dict = {}
-					result_dict['transcript'] = curr_tname
-					result_dict['paragraph'] = cached_quote_result['paragraph']
-					result_dict['alignment'] = cached_quote_result['alignment']
-					result_dict['similarity'] = curr_score
-
-					self.quote_time_cache[(quote, timestamp)] = result_dict
-
-					return result_dict
-
-				# it beats the current record...
-				elif curr_score >= best_score and curr_score >= self.tol:
-					best_score = curr_score
-					best_align = cached_quote_result['alignment']
-					best_paras = cached_quote_result['paragraph']
-					best_transcript = curr_tname
-				continue
-
-			# now we make the effort to match each segment.
-			transcript = self.transcripts[curr_tname]
-
-			curr_align = [None] * len(segment_arr)
-			curr_paras = [None] * len(segment_arr)
-			min_seg_score = None
-
-			# check if we already cached some segments to this transcript
-			seg_break = False
-			for j in range(len(segment_arr)):
-				curr_seg = segment_arr[j]
-				cached_seg_result = self.seg_transcript_cache.get((curr_seg, curr_tname), None)
-				if cached_seg_result is not None:
-					cached_score =  cached_seg_result['similarity']
-
-					# if we see seg with low tol then the entire quote can't match the transcript
-					if cached_score < self.tol:
-						seg_break = True
-						break  
-					else:
-
-						# keep track of the cached segment
-						curr_align[j] = cached_seg_result['alignment']
-						curr_paras[j] = cached_seg_result['paragraph']
-						if min_seg_score is None or cached_score < min_seg_score:
-							min_seg_score = cached_score 
-			# move on!
-			if seg_break:
-				self.quote_transcript_cache[(quote, curr_tname)] = {'similarity': None}
-				continue
+		# and now we're done with the entire set of transcripts. let's see what we find ...
+		result_dict = best.result()
+		self.quote_window_cache[window_key] = result_dict
+		if best.score >= self.tol:
+			return result_dict
+		else:
+			return None
 
-			# now we make the effort to find all uncached segments.
-			paragraphs = transcript['paragraphs']
+	def match_quotes(self, batch):
 
-			for j in range(len(segment_arr)):
+		'''
+			matches many quotes at once; the result for each quote is the same as
+			match_quote's.
 
-				# but of course we don't do anything for things we already cached!
-				if curr_align[j] is not None:
-					continue 
+			instead of searching the window of each quote in turn, the transcripts are
+			walked once, newest first, and each one is matched against all the quotes
+			whose window it is in and which haven't been matched yet. a quote repeated
+			in the batch (with the same window) is only searched once, and candidate
+			paragraphs are looked up once per distinct segment in the batch. the
+			quotes are segmented together, each text once, straight into the token
+			ids the prefilter and n-gram index look them up by (see tokenize_quotes).
 
-				curr_seg = segment_arr[j]
+			Arguments:
 
-				# keep track of the best seg -> para align.
-				best_para_align = None
-				best_para = None
-				best_para_score = None
+				batch: list of (quote text, timestamp)
 
-				for k in range(len(paragraphs)):
-					
+			Returns:
 
-					# we check the cache first
-					cached_para_result = self.seg_para_cache.get((curr_seg, curr_tname, k), None)
-					if cached_para_result is not None:
+				list with the result of match_quote for each entry of batch.
+		'''
 
-						cached_score = cached_para_result['similarity']
+		results = [None] * len(batch)
 
-						# if exact match, then we found the best paragraph so quit
-						if cached_score == 0:
-							best_para_align = cached_para_result['alignment']
-							best_para = k
-							best_para_score = 0
-							break
+		# window key -> positions in batch, for quotes that aren't cached
+		new_quotes = collections.OrderedDict()
 
-						# definitely not a match
-						elif cached_score < self.tol:
-							continue
+		for pos, (quote, timestamp) in enumerate(batch):
+			if quote[0] == '?':
+				continue
+			window = self._quote_window(timestamp)
+			if window is None:
+				continue
 
-						# we beat the current best, so take note
-						elif cached_score >= best_para_score:
+			window_key = (quote,) + window
+			positions = new_quotes.get(window_key, None)
+			if positions is not None:
+				positions.append(pos)
+				continue
 
-							best_para_align = cached_para_result['alignment']
-							best_para = k
-							best_para_score = cached_score
-					
-					else:
-						# we are forced to work now
-						curr_para = paragraphs[k]
-						align, score = mu.match_segment_to_paragraph(curr_seg,
-											curr_para, self.stopwords, self.MIN_FUZZ_LEN,
-											self.word_ratio)
-
-						# cache result
-						# or not...this is a gigantic memory hog!
-						'''self.seg_para_cache[(curr_seg, curr_tname, k)] = {
-											'alignment': align,
-											'similarity': score
-											}'''
-
-						# we hit a perfect match! so we don't have to look at any more paras.
-						if score == 0:
-							best_para_align = align
-							best_para = k
-							best_para_score = score
-							
-							break
-						# we beat the record, so take note.
-						elif score >= self.tol and score >= best_para_score:
-							best_para_align = align
-							best_para = k
-							best_para_score = score		
-
-				# we finished checking seg against the transcript! let's see what we've found...
-
-				# keep track of the alignment score. recall this is the min of 
-					# each indiv segs score.
-				if min_seg_score is None or best_para_score < min_seg_score:
-
-					min_seg_score = best_para_score
-
-				# for memory purposes we probably shouldn't.
-				'''self.seg_transcript_cache[(curr_seg, curr_tname)] = {
-						'alignment': best_para_align,
-						'paragraph': best_para,
-						'similarity': best_para_score
-					}'''
-				if best_para_score >= self.tol:
-					curr_align[j] = best_para_align
-					curr_paras[j] = best_para
-				else:
-					# the entire quote cannot match the transcript.
-					seg_break = True
-					break 
-
-
-			# we give up on this transcript. move on.
-			if seg_break:
-				self.quote_transcript_cache[(quote, curr_tname)] = {'similarity': None}
+			cached_quote_result = self.quote_window_cache.get(window_key, None)
+			if cached_quote_result is not None:
+				if cached_quote_result['similarity'] >= self.tol:
+					results[pos] = cached_quote_result
+				continue
+			new_quotes[window_key] = [pos]
+
+		vocab = None
+		if self.ngram_index is not None:
+			vocab = self.ngram_index.vocab
+		elif self.prefilter is not None:
+			vocab = self.prefilter.vocab
+		tokenized = mu.tokenize_quotes([window_key[0] for window_key in new_quotes], vocab)
+
+		# window key -> quote being searched for
+		searches = collections.OrderedDict()
+		seg_windows = {}
+		seg_tokens = {}
+
+		for window_key, positions in new_quotes.iteritems():
+			quote = window_key[0]
+			window = window_key[1:]
+			segment_arr, token_arr = tokenized[quote]
+			if max([len(x) for x in segment_arr]) < self.MIN_LEN:
+				self.quote_window_cache[window_key] = {'similarity': None}
+				continue
+			if self.prefilter is not None and not self.prefilter.plausible(segment_arr, 
+					window[0], window[1], token_arr):
+				self.quote_window_cache[window_key] = {'similarity': None}
 				continue
 
-			# now we've finally matched all segments.
+			search = searches[window_key] = _QuoteSearch(quote, window, segment_arr,
+									[self._segment_id(seg) for seg in segment_arr])
+			search.positions.extend(positions)
+
+			# candidates of a segment are looked up over all the windows it's in
+			for j, seg_id in enumerate(search.seg_ids):
+				seg_window = seg_windows.get(seg_id, window)
+				seg_windows[seg_id] = (min(seg_window[0], window[0]), max(seg_window[1], window[1]))
+				if token_arr is not None:
+					seg_tokens[seg_id] = token_arr[j]
+
+		if len(searches) > 0:
+			seg_candidates = {}
+			pending = searches.values()
+			latest = max(search.window[1] for search in pending)
+			earliest = min(search.window[0] for search in pending)
+
+			for i in range(latest, earliest - 1, -1):
+				paragraphs = None
+				still_pending = []
+				for search in pending:
+					if i > search.window[1]:
+						still_pending.append(search)
+						continue
+					if paragraphs is None:
+						paragraphs = self.transcripts[self.order[i]]['paragraphs']
+						if not isinstance(paragraphs, list):
+							# e.g. a Corpus builds paragraphs as they're read
+							paragraphs = _ParagraphMemo(paragraphs)
+					transcript_result = self._match_quote_to_transcript(search.quote,
+											search.segment_arr, search.seg_ids, i,
+											seg_candidates, seg_windows, paragraphs, seg_tokens)
+					accepted = search.update(self.order[i], transcript_result, 
+											self.tol, self.ACCEPT_THRESHOLD)
+					if not accepted and i > search.window[0]:
+						still_pending.append(search)
+				pending = still_pending
+
+		for window_key, search in searches.iteritems():
+			result_dict = search.result()
+			self.quote_window_cache[window_key] = result_dict
+			if search.score >= self.tol:
+				for pos in search.positions:
+					results[pos] = result_dict
+
+		return results
+
+
+class _QuoteSearch(object):
+
+	# the best transcript found so far for a quote (see match_quote), plus what
+	# match_quotes needs to carry on the search.
+
+	def __init__(self, quote = None, window = None, segment_arr = None, seg_ids = None):
+
+		self.quote = quote
+		self.window = window
+		self.segment_arr = segment_arr
+		self.seg_ids = seg_ids
+		self.positions = []
+
+		self.align = None
+		self.paras = None
+		self.score = None
+		self.transcript = None
+
+	def update(self, transcript_name, transcript_result, tol, accept_threshold):
+
+		# takes in the result of matching the quote to one more transcript; returns
+		# True if it's good enough to stop searching.
+
+		curr_score = transcript_result['similarity']
+		if curr_score >= tol and curr_score > self.score:
+			self.align = transcript_result['alignment']
+			self.paras = transcript_result['paragraph']
+			self.score = curr_score
+			self.transcript = transcript_name
+		return curr_score >= accept_threshold
+
+	def result(self):
+
+		return {
+				'alignment': self.align,
+				'paragraph': self.paras,
+				'similarity': self.score,
+				'transcript': self.transcript
+			}
 
-			self.quote_transcript_cache[(quote, curr_tname)] = {
-					'alignment': curr_align,
-					'paragraph': curr_paras,
-					'similarity': min_seg_score
-				}
-			
-			if min_seg_score >= self.tol and min_seg_score > best_score:
 
-				best_align = curr_align
-				best_paras = curr_paras
-				best_transcript = curr_tname
-				best_score = min_seg_score
+class _ParagraphMemo(object):
 
-			# we definitely have a match with this transcript, so we don't
-				# need to look at any other transcripts.
-			if min_seg_score >= self.ACCEPT_THRESHOLD:
-				break
-		# and now we're done with the entire set of transcripts. let's see what we find ...
-		result_dict = {
-				'alignment': best_align,
-				'paragraph': best_paras,
-				'similarity': best_score,
-				'transcript': best_transcript
-			}
-		self.quote_time_cache[(quote, timestamp)] = result_dict
-		if best_score >= self.tol:
-			return result_dict
-		else:
-			return None
+	# paragraphs of a transcript, each built only once
 
+	def __init__(self, paragraphs):
 
+		self.paragraphs = paragraphs
+		self.built = {}
 
+	def __len__(self):
+		return len(self.paragraphs)
 
+	def __getitem__(self, k):
 
+		paragraph = self.built.get(k, None)
+		if paragraph is None:
+			paragraph = self.built[k] = self.paragraphs[k]
+		return paragraph
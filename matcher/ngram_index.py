@@ -0,0 +1,204 @@
+import numpy as np
+
+
+HASH_BASE = np.uint64(1000003)
+
+
+class NgramIndex(object):
+
+	'''
+		hash index of the word k-grams in all transcript paragraphs, for finding
+		verbatim occurrences of a segment without scanning paragraphs.
+
+		each k-gram is hashed with a polynomial (rolling) hash over integer token ids.
+		the hashes are kept sorted in one array, so a lookup is a binary search
+		followed by a check of the few positions with that hash.
+
+		Arguments:
+
+			transcript_names: transcript filenames in chronological order
+				(i.e. QuoteMatcher.order)
+			transcript_collection: dict of transcript filename to transcript data,
+				as returned by load_transcript_collection
+			k (int, default=3): length of indexed word grams. segments shorter than
+				k+2 words can't be looked up.
+
+		Structures:
+
+			vocab: map of word to token id
+			words: list of words, indexed by token id
+			tokens: token ids of all paragraph['match'] arrays, concatenated
+				in chronological order
+			para_offsets: position in tokens of the start of each paragraph;
+				has an extra entry at the end.
+			transcript_offsets: number of first paragraph of each transcript;
+				has an extra entry at the end.
+			gram_hashes: sorted hashes of every k-gram that lies within a paragraph
+			gram_positions: position in tokens of the k-gram with the matching hash
+	'''
+
+	def __init__(self, transcript_names, transcript_collection, k=3):
+
+		self.k = k
+
+		self.vocab = {}
+		self.words = []
+
+		token_list = []
+		para_offsets = [0]
+		self.transcript_offsets = [0]
+		for name in transcript_names:
+			paragraphs = transcript_collection[name]['paragraphs']
+			for paragraph in paragraphs:
+				for word in paragraph['match']:
+					token_id = self.vocab.get(word, None)
+					if token_id is None:
+						token_id = self.vocab[word] = len(self.words)
+						self.words.append(word)
+					token_list.append(token_id)
+				para_offsets.append(len(token_list))
+			self.transcript_offsets.append(len(para_offsets) - 1)
+
+		self.tokens = np.array(token_list, dtype=np.int32)
+		self.para_offsets = np.array(para_offsets, dtype=np.int64)
+
+		self._build_hashes()
+
+	@classmethod
+	def from_corpus(cls, corpus):
+
+		'''
+			returns the index stored in a Corpus, without rebuilding it.
+		'''
+
+		index = cls.__new__(cls)
+		index.k = corpus.gram_k
+		index.vocab = corpus.vocab
+		index.words = corpus.words
+		index.tokens = corpus.match_tokens
+		index.para_offsets = corpus.para_offsets
+		index.transcript_offsets = corpus.transcript_offsets.tolist()
+		index.gram_hashes = corpus.gram_hashes
+		index.gram_positions = corpus.gram_positions
+		return index
+
+	def _hash_grams(self, token_ids):
+
+		# hash of every k-gram starting in token_ids; arithmetic wraps mod 2**64.
+
+		num_grams = len(token_ids) - self.k + 1
+		if num_grams <= 0:
+			return np.zeros(0, dtype=np.uint64)
+		shifted = token_ids.astype(np.uint64) + np.uint64(1)
+		hashes = np.zeros(num_grams, dtype=np.uint64)
+		for i in range(self.k):
+			hashes = hashes * HASH_BASE + shifted[i:i+num_grams]
+		return hashes
+
+	def _build_hashes(self):
+
+		hashes = self._hash_grams(self.tokens)
+
+		# keep only grams that don't run over the end of their paragraph
+		para_lengths = np.diff(self.para_offsets)
+		para_ends = np.repeat(self.para_offsets[1:], para_lengths)
+		positions = np.arange(len(hashes), dtype=np.int32)
+		positions = positions[positions + self.k <= para_ends[:len(hashes)]]
+
+		# stable sort keeps positions ascending within each hash
+		order = np.argsort(hashes[positions], kind='mergesort')
+		self.gram_positions = positions[order]
+		self.gram_hashes = hashes[self.gram_positions]
+
+	def _positions(self, gram_ids, start, end):
+
+		# positions in [start, end) where a gram with the same hash as gram_ids starts
+
+		gram_hash = self._hash_grams(np.array(gram_ids[:self.k], dtype=np.int32))[0]
+		lo = np.searchsorted(self.gram_hashes, gram_hash, 'left')
+		hi = np.searchsorted(self.gram_hashes, gram_hash, 'right')
+		positions = self.gram_positions[lo:hi]
+		return positions[np.searchsorted(positions, start):np.searchsorted(positions, end)]
+
+	def _locate(self, position):
+
+		# (transcript index, paragraph index, offset in paragraph) of a token position
+
+		para_num = np.searchsorted(self.para_offsets, position, 'right') - 1
+		transcript_idx = np.searchsorted(self.transcript_offsets, para_num, 'right') - 1
+		return (int(transcript_idx), int(para_num - self.transcript_offsets[transcript_idx]),
+				int(position - self.para_offsets[para_num]))
+
+	def lookup(self, segment_arr, earliest, latest, token_ids=None):
+
+		'''
+			finds verbatim occurrences of segment_arr in paragraphs of transcripts
+			earliest..latest (indices into the chronological order).
+
+			like align_verbatim, this also finds occurrences where the first and last
+			words of the segment are only the end and start of transcript words
+			(e.g. when a quote starts or stops mid-word).
+
+			token_ids are the segment's words as token ids (-1 for words not in
+			vocab), if the caller has them already (see tokenize_quotes).
+
+			Returns:
+
+				sorted list of (transcript index, paragraph index, offset, trimmed),
+					where offset is the position of the first segment word in
+					paragraph['match'] and trimmed is True for the case above.
+				None if the segment is too short to be looked up.
+
+		'''
+
+		seg_len = len(segment_arr)
+		if seg_len < self.k + 2:
+			return None
+
+		if token_ids is None:
+			seg_ids = [self.vocab.get(word, -1) for word in segment_arr]
+		else:
+			seg_ids = list(token_ids)
+		inner_ids = seg_ids[1:-1]
+
+		para_start = self.transcript_offsets[earliest]
+		para_end = self.transcript_offsets[latest + 1]
+		start = self.para_offsets[para_start]
+		end = self.para_offsets[para_end]
+
+		hits = []
+		exact_starts = set()
+
+		if -1 not in seg_ids:
+			seg_array = np.array(seg_ids, dtype=np.int32)
+			for position in self._positions(seg_ids, start, end):
+				if position + seg_len > end:
+					continue
+				if not np.array_equal(self.tokens[position:position+seg_len], seg_array):
+					continue
+				transcript_idx, para_idx, offset = self._locate(position)
+				para_num = self.transcript_offsets[transcript_idx] + para_idx
+				if position + seg_len <= self.para_offsets[para_num+1]:
+					hits.append((transcript_idx, para_idx, offset, False))
+					exact_starts.add(position)
+
+		if -1 not in inner_ids:
+			inner_len = seg_len - 2
+			inner_array = np.array(inner_ids, dtype=np.int32)
+			first_word = segment_arr[0]
+			last_word = segment_arr[-1]
+			for position in self._positions(inner_ids, start, end):
+				if position - 1 in exact_starts:
+					continue
+				if not np.array_equal(self.tokens[position:position+inner_len], inner_array):
+					continue
+				transcript_idx, para_idx, offset = self._locate(position)
+				para_num = self.transcript_offsets[transcript_idx] + para_idx
+				if offset == 0 or position + inner_len >= self.para_offsets[para_num+1]:
+					continue
+				if (self.words[self.tokens[position-1]].endswith(first_word)
+						and self.words[self.tokens[position+inner_len]].startswith(last_word)):
+					hits.append((transcript_idx, para_idx, offset - 1, True))
+
+		hits.sort()
+		return hits
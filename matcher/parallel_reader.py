@@ -0,0 +1,79 @@
+'''
+	reads spinn3r files with a pool of worker processes.
+
+	the QuoteMatcher (transcripts, indexes) is set up once in the parent; workers are
+	forked afterwards, so they share it copy-on-write instead of each loading their own.
+	each worker reads whole files into a fresh ArticleReader, and the parent merges
+	the results back in file order (see ArticleReader.merge), so the output is the
+	same as reading the files one after the other.
+'''
+
+import multiprocessing
+from article_reader import ArticleReader
+
+# set in the parent right before the pool is forked
+_worker_matcher = None
+_worker_verbose = False
+_worker_batch_size = None
+_worker_after_file = None
+
+
+def _read_file(filename):
+
+	reader = ArticleReader(_worker_matcher, verbose=_worker_verbose, 
+							batch_size=_worker_batch_size)
+	for _ in reader.read_spinn3r_files([filename]):
+		pass
+	_worker_matcher.flush_persistent_cache()
+	if _worker_after_file is not None:
+		_worker_after_file(filename)
+	return reader.matches, reader.idx_to_article, reader.errors
+
+
+def read_spinn3r_files(article_reader, filenames, num_workers=1, after_file=None):
+
+	'''
+		reads spinn3r files into article_reader.
+
+		Arguments:
+
+			article_reader: ArticleReader to collect matches, articles and errors
+			filenames: list of spinn3r data files, in the order they should be read
+			num_workers (int, default=1): number of worker processes. with 1, files
+				are read in this process.
+			after_file (function, default=None): if given, called with each filename
+				right after the file is read, in the process that read it (e.g.
+				ScoreRecorder.flush).
+
+		Returns:
+
+			generator yielding each filename once its results are in article_reader,
+				in the order of filenames.
+	'''
+
+	global _worker_matcher, _worker_verbose, _worker_batch_size, _worker_after_file
+
+	if num_workers <= 1:
+		for filename in article_reader.read_spinn3r_files(filenames):
+			if after_file is not None:
+				after_file(filename)
+			yield filename
+		return
+
+	_worker_matcher = article_reader.qm
+	_worker_verbose = article_reader.verbose
+	_worker_batch_size = article_reader.batch_size
+	_worker_after_file = after_file
+	pool = multiprocessing.Pool(num_workers)
+	try:
+		results = pool.imap(_read_file, filenames)
+		for filename in filenames:
+			matches, idx_to_article, errors = results.next()
+			article_reader.merge(matches, idx_to_article, errors)
+			yield filename
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+		_worker_matcher = None
+		_worker_after_file = None
@@ -0,0 +1,191 @@
+'''
+	on-disk cache of quote-to-transcript results, shared between runs.
+
+	results are what QuoteMatcher keeps in quote_transcript_cache:
+	{alignment, paragraph, similarity}, or {similarity: None} if the quote can't
+	match the transcript. they're stored in an SQLite database, keyed by
+
+		params: digest of the matcher settings that affect results (see params_digest)
+		quote: digest of the quote's segments (see quote_digest), so quotes that
+			only differ in formatting share entries
+		transcript: digest of the transcript's name and text, so entries of a
+			transcript that changed are never used
+
+	the database is in WAL mode, so any number of processes can read it while one
+	writes. writes are buffered and go in one transaction per flush. each process
+	opens its own connection, so a cache can be set up before forking workers.
+'''
+
+import os
+import hashlib
+import sqlite3
+import cPickle
+
+FLUSH_EVERY = 1000
+
+_SCHEMA = '''
+	CREATE TABLE IF NOT EXISTS quote_transcript (
+		params TEXT NOT NULL,
+		quote TEXT NOT NULL,
+		transcript TEXT NOT NULL,
+		result BLOB NOT NULL,
+		PRIMARY KEY (params, quote, transcript)
+	)
+'''
+
+
+def _utf8(text):
+	if isinstance(text, unicode):
+		return text.encode('utf-8')
+	return text
+
+
+def quote_digest(segment_arr):
+
+	'''
+		digest of a quote given as a list of segments (see segment_quote).
+	'''
+
+	return hashlib.md5('\n'.join(_utf8(' '.join(segment)) for segment in segment_arr)).hexdigest()
+
+
+def params_digest(params):
+
+	'''
+		digest of a dict of matcher settings. sets should be passed sorted.
+	'''
+
+	return hashlib.md5(repr(sorted(params.items()))).hexdigest()
+
+
+class PersistentCache(object):
+
+	'''
+		persistent quote_transcript_cache (see above) for one transcript
+		collection and one set of matcher settings.
+
+		Arguments:
+
+			path: SQLite database file; is created if needed
+			transcript_names: transcript filenames in chronological order
+				(i.e. QuoteMatcher.order)
+			transcript_collection: dict of transcript filename to transcript data
+			params: dict of matcher settings (see params_digest)
+			flush_every (int, default=FLUSH_EVERY): buffered writes are flushed
+				once there are this many
+
+		Structures:
+
+			hits, misses: number of lookups which did and didn't find a result
+	'''
+
+	def __init__(self, path, transcript_names, transcript_collection, params,
+		flush_every=FLUSH_EVERY):
+
+		self.path = path
+		self.transcript_names = transcript_names
+		self.transcripts = transcript_collection
+		self.params = params_digest(params)
+		self.flush_every = flush_every
+
+		self.hits = 0
+		self.misses = 0
+
+		# transcript index -> digest, computed when first needed
+		self._transcript_digests = {}
+		self._pending = []
+		self._conn = None
+		self._pid = None
+
+	def _connection(self):
+
+		# a connection can't be shared with forked processes, so each gets its own
+		if self._conn is None or self._pid != os.getpid():
+			self._conn = sqlite3.connect(self.path, timeout=600)
+			self._conn.text_factory = str
+			self._conn.execute('PRAGMA journal_mode=WAL')
+			self._conn.execute('PRAGMA synchronous=NORMAL')
+			self._conn.execute(_SCHEMA)
+			self._conn.commit()
+			self._pid = os.getpid()
+			self._pending = []
+		return self._conn
+
+	def _transcript_digest(self, transcript_idx):
+
+		digest = self._transcript_digests.get(transcript_idx, None)
+		if digest is None:
+			name = self.transcript_names[transcript_idx]
+			md5 = hashlib.md5(_utf8(name))
+			for paragraph in self.transcripts[name]['paragraphs']:
+				md5.update('\n')
+				md5.update(_utf8(paragraph['raw']))
+			digest = self._transcript_digests[transcript_idx] = md5.hexdigest()
+		return digest
+
+	def get(self, quote_key, transcript_idx):
+
+		'''
+			returns the stored result for a quote (see quote_digest) and a
+			transcript index, or None.
+		'''
+
+		row = self._connection().execute(
+				'SELECT result FROM quote_transcript WHERE params=? AND quote=? AND transcript=?',
+				(self.params, quote_key, self._transcript_digest(transcript_idx))).fetchone()
+		if row is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		return cPickle.loads(str(row[0]))
+
+	def put(self, quote_key, transcript_idx, result):
+
+		'''
+			stores a result. it's written with the next flush.
+		'''
+
+		self._connection()
+		self._pending.append((self.params, quote_key, self._transcript_digest(transcript_idx),
+				sqlite3.Binary(cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL))))
+		if len(self._pending) >= self.flush_every:
+			self.flush()
+
+	def flush(self):
+
+		'''
+			writes the buffered results.
+		'''
+
+		if len(self._pending) == 0:
+			return
+		conn = self._connection()
+		with conn:
+			conn.executemany('INSERT OR REPLACE INTO quote_transcript VALUES (?, ?, ?, ?)',
+							self._pending)
+		self._pending = []
+
+	def stats(self):
+
+		'''
+			returns dict of counters: {'hits', 'misses', 'hit_rate', 'pending'}
+		'''
+
+		lookups = self.hits + self.misses
+		return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'hit_rate': self.hits / float(lookups) if lookups > 0 else None,
+				'pending': len(self._pending)
+			}
+
+	def close(self):
+
+		'''
+			flushes and closes this process's connection.
+		'''
+
+		if self._conn is not None and self._pid == os.getpid():
+			self.flush()
+			self._conn.close()
+		self._conn = None
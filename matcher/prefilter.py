@@ -0,0 +1,292 @@
+from __future__ import division
+import math
+import numpy as np
+from ngram_index import HASH_BASE
+
+
+class BloomFilter(object):
+
+	'''
+		set of hashable items which can say an item is there when it isn't (with
+		probability about 0.6185**bits_per_item), but never the other way round.
+
+		items are looked up by their hash (see item_hash), so a hash computed once
+		can be checked against many filters.
+
+		Arguments:
+
+			num_items (int): number of items it'll hold (roughly)
+			bits_per_item (int, default=10): more means fewer false positives
+	'''
+
+	def __init__(self, num_items, bits_per_item=10):
+
+		self.num_bits = max(64, num_items * bits_per_item)
+		self.num_hashes = max(1, int(round(bits_per_item * math.log(2))))
+		self.bits = bytearray((self.num_bits + 7) // 8)
+
+	def add_hashes(self, item_hashes):
+
+		'''
+			adds many items at once, given their hashes.
+		'''
+
+		if len(item_hashes) == 0:
+			return
+		item_hashes = np.asarray(item_hashes, dtype=np.uint64)
+		# double hashing: bit positions h1 + i * h2
+		h1 = item_hashes & np.uint64(0xffffffff)
+		h2 = (item_hashes >> np.uint64(32)) | np.uint64(1)
+		bits = np.frombuffer(self.bits, dtype=np.uint8)
+		for i in range(self.num_hashes):
+			positions = (h1 + np.uint64(i) * h2) % np.uint64(self.num_bits)
+			np.bitwise_or.at(bits, positions >> np.uint64(3), 
+						np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+
+	def contains_hash(self, item_hash):
+
+		h1 = item_hash & 0xffffffff
+		h2 = (item_hash >> 32) | 1
+		bits = self.bits
+		num_bits = self.num_bits
+		for i in xrange(self.num_hashes):
+			pos = (h1 + i * h2) % num_bits
+			if not bits[pos >> 3] & (1 << (pos & 7)):
+				return False
+		return True
+
+	def add(self, item):
+		self.add_hashes([item_hash(item)])
+
+	def __contains__(self, item):
+		return self.contains_hash(item_hash(item))
+
+
+def item_hash(item):
+
+	# 64 bit, non-negative
+	return hash(item) & 0xffffffffffffffff
+
+
+MASK_64 = (1 << 64) - 1
+MIX_1 = 0xbf58476d1ce4e5b9
+MIX_2 = 0x94d049bb133111eb
+
+
+def _mix(x):
+
+	# spreads the bits of a 64 bit int (splitmix64's finalizer), so the two
+	# halves BloomFilter takes apart are both usable; the same on python ints
+	# and numpy uint64 arrays
+	if isinstance(x, np.ndarray):
+		x = (x ^ (x >> np.uint64(30))) * np.uint64(MIX_1)
+		x = (x ^ (x >> np.uint64(27))) * np.uint64(MIX_2)
+		return x ^ (x >> np.uint64(31))
+	x = ((x ^ (x >> 30)) * MIX_1) & MASK_64
+	x = ((x ^ (x >> 27)) * MIX_2) & MASK_64
+	return x ^ (x >> 31)
+
+
+class QuotePrefilter(object):
+
+	'''
+		rejects quotes that can't match any transcript in their window, without
+		searching it.
+
+		for each transcript there is a BloomFilter of the words and word k-grams of
+		its paragraphs ('match' arrays), and for each week one of the words and
+		k-grams of all that week's transcripts. they're read off the token arrays
+		of an NgramIndex (which a compiled Corpus has on disk), so no paragraph
+		is built to fill them; items are token ids and the index's k-gram hashes. a segment can only match a paragraph
+
+			- verbatim, if the paragraph contains the segment with its first and
+				last words possibly cut short (see align_verbatim), so it contains
+				every k-gram of the segment's interior (or every interior word, if
+				there are fewer than k), or
+			- fuzzily, if it is at least min_fuzz_len words long and the paragraph
+				contains a word_ratio share of its non-stopwords.
+
+		a quote only matches a transcript if all its segments do, so it's rejected
+		if for every transcript in its window, some segment fails both tests
+		against the transcript's filter. the week filters check the same thing
+		for all of a window's transcripts together first, which is usually enough
+		to reject a quote. since Bloom filters never miss an item, no quote that
+		could match is rejected.
+
+		Arguments:
+
+			transcript_dates: dates of the transcripts in chronological order
+				(i.e. QuoteMatcher.times)
+			ngram_index: NgramIndex of the transcripts, in the same order; its k is
+				the length of the k-grams
+			stopword_set: set of stopwords (should be the same as the matcher's)
+			min_fuzz_len, word_ratio: as in QuoteMatcher
+			bits_per_item (int, default=10): see BloomFilter
+
+		Structures:
+
+			transcript_filters: BloomFilter per transcript, in chronological order
+			week_filters: BloomFilter per week with transcripts
+			transcript_weeks: index into week_filters of each transcript's week
+			checked, rejected: number of quotes checked and rejected so far
+	'''
+
+	def __init__(self, transcript_dates, ngram_index, stopword_set, min_fuzz_len, word_ratio,
+		bits_per_item=10):
+
+		self.stopwords = stopword_set
+		self.min_fuzz_len = min_fuzz_len
+		self.word_ratio = word_ratio
+		self.k = ngram_index.k
+		self.vocab = ngram_index.vocab
+
+		self.transcript_filters = []
+		self.week_filters = []
+		self.transcript_weeks = []
+
+		tokens = ngram_index.tokens
+		para_offsets = ngram_index.para_offsets
+		transcript_offsets = ngram_index.transcript_offsets
+
+		week_hashes = []
+		last_week = None
+		for i, date in enumerate(transcript_dates):
+			week = date.toordinal() // 7
+			if week != last_week and last_week is not None:
+				self.week_filters.append(self._build_filter(week_hashes, bits_per_item))
+				week_hashes = []
+			last_week = week
+
+			offsets = para_offsets[transcript_offsets[i]:transcript_offsets[i + 1] + 1]
+			start = offsets[0]
+			token_ids = np.asarray(tokens[start:offsets[-1]])
+			gram_hashes = ngram_index._hash_grams(token_ids)
+
+			# only grams that don't run over the end of their paragraph
+			para_ends = np.repeat(offsets[1:] - start, np.diff(offsets))
+			positions = np.arange(len(gram_hashes))
+			gram_hashes = gram_hashes[positions + self.k <= para_ends[:len(gram_hashes)]]
+
+			hashes = np.unique(_mix(np.concatenate([
+					np.unique(token_ids).astype(np.uint64) + np.uint64(1), gram_hashes])))
+			self.transcript_filters.append(self._build_filter([hashes], bits_per_item))
+			self.transcript_weeks.append(len(self.week_filters))
+			week_hashes.append(hashes)
+		if last_week is not None:
+			self.week_filters.append(self._build_filter(week_hashes, bits_per_item))
+
+		self.checked = 0
+		self.rejected = 0
+
+	def _build_filter(self, hash_arrays, bits_per_item):
+
+		hashes = np.unique(np.concatenate(hash_arrays)) if len(hash_arrays) > 0 else []
+		bloom_filter = BloomFilter(len(hashes), bits_per_item)
+		bloom_filter.add_hashes(hashes)
+		return bloom_filter
+
+	def _word_hash(self, token_id):
+
+		# None for words that aren't in any transcript
+		if token_id < 0:
+			return None
+		return _mix(token_id + 1)
+
+	def _gram_hash(self, gram_ids):
+
+		# as NgramIndex hashes it, or None if a word isn't in any transcript
+		h = 0
+		for token_id in gram_ids:
+			if token_id < 0:
+				return None
+			h = (h * int(HASH_BASE) + token_id + 1) & MASK_64
+		return _mix(h)
+
+	def _segment_tests(self, segment, token_ids):
+
+		# (verbatim hashes, fuzzy hashes) for a segment; fuzzy hashes is None if
+		# it's too short or has no non-stopwords.
+
+		if token_ids is None:
+			token_ids = [self.vocab.get(word, -1) for word in segment]
+		interior = token_ids[1:-1]
+		if len(interior) >= self.k:
+			verbatim_hashes = [self._gram_hash(interior[i:i+self.k])
+								for i in range(len(interior) - self.k + 1)]
+		else:
+			verbatim_hashes = [self._word_hash(token_id) for token_id in interior]
+
+		if len(segment) < self.min_fuzz_len:
+			return verbatim_hashes, None
+		fuzzy_ids = dict((word, token_id) for word, token_id in zip(segment, token_ids)
+						if word not in self.stopwords)
+		if len(fuzzy_ids) == 0:
+			return verbatim_hashes, None
+		return verbatim_hashes, [self._word_hash(token_id) for token_id in fuzzy_ids.itervalues()]
+
+	def _plausible(self, tests, filters):
+
+		# whether every segment passes the verbatim or fuzzy test, counting an item
+		# as present if any of filters has it
+
+		def present(h):
+			if h is None:
+				return False
+			for bloom_filter in filters:
+				if bloom_filter.contains_hash(h):
+					return True
+			return False
+
+		for verbatim_hashes, fuzzy_hashes in tests:
+			for h in verbatim_hashes:
+				if not present(h):
+					break
+			else:
+				continue
+			if fuzzy_hashes is None:
+				return False
+			# give up once even the remaining words can't reach word_ratio
+			max_overlap = len(fuzzy_hashes)
+			for h in fuzzy_hashes:
+				if not present(h):
+					max_overlap -= 1
+					if max_overlap / len(fuzzy_hashes) < self.word_ratio:
+						return False
+		return True
+
+	def plausible(self, segment_arr, earliest, latest, token_arr=None):
+
+		'''
+			whether a quote (as a list of segments; see segment_quote) could match
+			one of transcripts earliest..latest (indices into the chronological order).
+			token_arr has the segments as token ids, if the caller has them already
+			(see tokenize_quotes).
+		'''
+
+		self.checked += 1
+		if token_arr is None:
+			token_arr = [None] * len(segment_arr)
+		tests = [self._segment_tests(segment, token_ids)
+					for segment, token_ids in zip(segment_arr, token_arr)]
+
+		weeks = self.week_filters[self.transcript_weeks[earliest]:self.transcript_weeks[latest] + 1]
+		if self._plausible(tests, weeks):
+			for i in range(latest, earliest - 1, -1):
+				if self._plausible(tests, [self.transcript_filters[i]]):
+					return True
+
+		self.rejected += 1
+		return False
+
+	def stats(self):
+
+		'''
+			returns dict with the number of quotes checked and rejected, and the
+			rejection rate.
+		'''
+
+		return {
+				'checked': self.checked,
+				'rejected': self.rejected,
+				'rejection_rate': self.rejected / self.checked if self.checked > 0 else 0.0
+			}
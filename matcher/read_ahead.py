@@ -0,0 +1,233 @@
+'''
+	read-ahead for spinn3r data files.
+
+	a background thread reads the files in large blocks, decompresses them, splits
+	them into lines and turns those into records, while the caller matches the
+	records it already has. records are handed over in batches through a bounded
+	queue, so the thread stays at most queue_size batches ahead.
+
+	the time spent in each stage is counted, which shows what a run is waiting on:
+
+		read, decompress: work done by the background thread
+		scan: turning lines into records, in the background thread. for
+			Spinn3rRecords that's only finding where the fields are.
+		decode: decoding record fields when the caller first reads them, which
+			the records count themselves (see Spinn3rRecord). done in the
+			caller's thread, and not counted in match.
+		match: time the caller spends between asking for batches, less decode
+		wait_full: time the background thread waited for room in the queue
+			(the run is limited by matching)
+		wait_empty: time the caller waited for a batch (the run is limited by
+			reading, decompressing or decoding)
+'''
+
+import sys
+import time
+import zlib
+import threading
+import Queue
+
+READ_BLOCK = 4 * 2**20
+BATCH_LINES = 1000
+QUEUE_SIZE = 16
+
+STAGES = ['read', 'decompress', 'scan', 'decode', 'match', 'wait_full', 'wait_empty']
+
+# queue items besides batches of records
+_END_OF_FILE = 'end of file'
+_END = 'end'
+_ERROR = 'error'
+
+
+def _gzip_blocks(f, block_size, stats):
+
+	# decompressed blocks of a gzip file. like gzip.open, reads files made of
+	# several gzip members one after the other.
+
+	decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	while True:
+		start = time.time()
+		block = f.read(block_size)
+		stats.add('read', time.time() - start, len(block))
+		if len(block) == 0:
+			break
+
+		start = time.time()
+		data = decompressor.decompress(block)
+		while decompressor.unused_data:
+			rest = decompressor.unused_data
+			decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+			data += decompressor.decompress(rest)
+		stats.add('decompress', time.time() - start, len(data))
+		yield data
+
+	data = decompressor.flush()
+	if len(data) > 0:
+		yield data
+
+
+class PipelineStats(object):
+
+	'''
+		seconds, items and bytes per stage (see above). updated from both threads.
+	'''
+
+	def __init__(self):
+
+		self._lock = threading.Lock()
+		self.seconds = dict((stage, 0.0) for stage in STAGES)
+		self.items = dict((stage, 0) for stage in STAGES)
+		self.bytes = dict((stage, 0) for stage in STAGES)
+
+	def add(self, stage, seconds, num_bytes=0, num_items=0):
+
+		with self._lock:
+			self.seconds[stage] += seconds
+			self.bytes[stage] += num_bytes
+			self.items[stage] += num_items
+
+	def summary(self):
+
+		'''
+			returns a line per stage with its time, and its throughput where that
+			makes sense.
+		'''
+
+		lines = []
+		for stage in STAGES:
+			seconds = self.seconds[stage]
+			line = '%-10s %9.2fs' % (stage, seconds)
+			if seconds > 0 and self.bytes[stage] > 0:
+				line += ' %9.1f MB/s' % (self.bytes[stage] / 2.0**20 / seconds)
+			if seconds > 0 and self.items[stage] > 0:
+				line += ' %9.0f records/s' % (self.items[stage] / seconds)
+			lines.append(line)
+		return '\n'.join(lines)
+
+
+class ReadAhead(object):
+
+	'''
+		reads files in a background thread (see above).
+
+		Arguments:
+
+			filenames: gzipped spinn3r data files, in the order they should be read
+			decode: function turning a line into a record (e.g. Spinn3rRecord)
+			block_size (int, default=READ_BLOCK): bytes read from disk at a time
+			batch_lines (int, default=BATCH_LINES): records per batch
+			queue_size (int, default=QUEUE_SIZE): batches the thread may get ahead by
+			stats (PipelineStats, default=None): where to count stage times; a new
+				one is made if not given.
+
+		iterating yields (filename, records) for each file in order, where records
+		is an iterator over the file's records. it has to be used up before the
+		next file is asked for.
+	'''
+
+	def __init__(self, filenames, decode, block_size=READ_BLOCK, batch_lines=BATCH_LINES,
+		queue_size=QUEUE_SIZE, stats=None):
+
+		self.filenames = list(filenames)
+		self.decode = decode
+		self.block_size = block_size
+		self.batch_lines = batch_lines
+		self.stats = stats if stats is not None else PipelineStats()
+
+		self._queue = Queue.Queue(queue_size)
+		self._stop = threading.Event()
+		self._thread = None
+
+	def _put(self, item):
+
+		# blocks while the queue is full, unless the reader was closed. returns
+		# False if it was.
+
+		start = time.time()
+		while not self._stop.is_set():
+			try:
+				self._queue.put(item, timeout=0.1)
+				self.stats.add('wait_full', time.time() - start)
+				return True
+			except Queue.Full:
+				pass
+		return False
+
+	def _decode_batch(self, lines):
+
+		start = time.time()
+		records = [self.decode(line) for line in lines]
+		self.stats.add('scan', time.time() - start, num_items=len(records))
+		return records
+
+	def _run(self):
+
+		try:
+			for filename in self.filenames:
+				with open(filename, 'rb') as f:
+					partial = ''
+					lines = []
+					for data in _gzip_blocks(f, self.block_size, self.stats):
+						block_lines = (partial + data).split('\n')
+						partial = block_lines.pop()
+						lines.extend(block_lines)
+						while len(lines) >= self.batch_lines:
+							if not self._put(self._decode_batch(lines[:self.batch_lines])):
+								return
+							lines = lines[self.batch_lines:]
+					# gzip.open also yields a last line without a newline
+					if partial:
+						lines.append(partial)
+					if len(lines) > 0 and not self._put(self._decode_batch(lines)):
+						return
+				if not self._put(_END_OF_FILE):
+					return
+			self._put(_END)
+		except:
+			self._put((_ERROR, sys.exc_info()))
+
+	def _get(self):
+
+		start = time.time()
+		item = self._queue.get()
+		self.stats.add('wait_empty', time.time() - start)
+		if isinstance(item, tuple) and item[0] == _ERROR:
+			exc_type, exc_value, exc_traceback = item[1]
+			raise exc_type, exc_value, exc_traceback
+		return item
+
+	def _file_records(self):
+
+		# records of the current file, up to its end of file marker
+		while True:
+			item = self._get()
+			if item is _END_OF_FILE:
+				return
+			start = time.time()
+			decode_start = self.stats.seconds['decode']
+			for record in item:
+				yield record
+			decode_seconds = self.stats.seconds['decode'] - decode_start
+			self.stats.add('match', time.time() - start - decode_seconds, num_items=len(item))
+
+	def __iter__(self):
+
+		self._thread = threading.Thread(target=self._run)
+		self._thread.daemon = True
+		self._thread.start()
+		try:
+			for filename in self.filenames:
+				yield filename, self._file_records()
+			self._get()
+		finally:
+			self.close()
+
+	def close(self):
+
+		'''
+			stops the background thread.
+		'''
+
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
@@ -1,62 +1,90 @@
 from matcher import QuoteMatcher
 from article_reader import ArticleReader
+from parallel_reader import read_spinn3r_files
+from match_sink import MatchSink, load_output
+from corpus import Corpus, build_corpus, corpus_is_current
+from threshold_sweep import ScoreRecorder
 import os
 import sys
 
-year = sys.argv[1]
+# with --record, the raw scores of every quote are written out as well, so stricter
+	# thresholds can be tried out afterwards (see threshold_sweep); matches are the same.
+record = '--record' in sys.argv
+args = [arg for arg in sys.argv[1:] if arg != '--record']
+year = args[0]
+num_workers = int(args[1]) if len(args) > 1 else 1
 import cPickle
 
 TRANSCRIPT_ORDER = '/NLP/creativity/work/pres_addrs/output_whitehouse/transcript_data/whitehouse_transcript_order.pk'
 TRANSCRIPTS = '/NLP/creativity/work/pres_addrs/output_whitehouse/transcript_data/whitehouse_transcripts.pk' 
+CORPUS_DIR = '/NLP/creativity/work/pres_addrs/output_whitehouse/transcript_data/whitehouse_corpus'
 spinn3r_dir = "/NLP/creativity/nobackup/results/"
 stopword_file = '/NLP/creativity/work/pres_addrs/src_new/matcher/mysql_stop.txt'
 OUTPUT_DIR = '/NLP/creativity/work/pres_addrs/output_whitehouse/match_data_'+year
+# quote-transcript results, shared by all runs and years
+MATCH_CACHE = '/NLP/creativity/work/pres_addrs/output_whitehouse/match_cache.db'
 
 print 'loading all'
-with open(TRANSCRIPT_ORDER, 'r') as f:
-	order = cPickle.load(f)
+# the compiled corpus loads in no time and is shared between workers; (re)build it
+	# the first time and whenever the transcripts are regenerated
+if not corpus_is_current(CORPUS_DIR, TRANSCRIPTS):
+	with open(TRANSCRIPT_ORDER, 'r') as f:
+		order = cPickle.load(f)
+	with open(TRANSCRIPTS, 'r') as f:
+		transcripts = cPickle.load(f)
+	build_corpus(order, transcripts, CORPUS_DIR, source_path=TRANSCRIPTS)
+	del order, transcripts
 
-with open(TRANSCRIPTS, 'r') as f:
-	transcripts = cPickle.load(f)
+corpus = Corpus(CORPUS_DIR)
+order = corpus.order()
+transcripts = corpus.transcripts
 
-qm = QuoteMatcher(order, transcripts, stopword_file=stopword_file)
-ar = ArticleReader(qm, verbose=True)
+qm = QuoteMatcher(order, transcripts, stopword_file=stopword_file, persistent_cache=MATCH_CACHE)
+recorder = None
+if record:
+	recorder = ScoreRecorder(qm, os.path.join(OUTPUT_DIR, 'scores'))
+# quotes of this many articles are matched together
+ar = ArticleReader(recorder or qm, verbose=True, batch_size=256)
 
-count = 0
+# results are appended to the sink after every file; picks up where a previous run stopped
+sink = MatchSink(os.path.join(OUTPUT_DIR, 'shards'))
+sink.restore(ar)
+
+count = len(sink.done)
+num_matches = 0
 
 filelist = [os.path.join(spinn3r_dir, f) for f in os.listdir(spinn3r_dir) if f.endswith('.gz') and year in f]
+filelist = [f for f in filelist if not sink.is_done(f)]
 
 print 'starting matching'
-for f in filelist:
-	cache = False
-	if count == 1 or count == 10 or count % 10000 == 0:
-		cache = True
+after_file = recorder.flush if recorder is not None else None
+for f in read_spinn3r_files(ar, filelist, num_workers, after_file):
 	count += 1
-	ar.read_spinn3r_file(f)
-	if cache:
-		print 'dumping all'
-		with open(os.path.join(OUTPUT_DIR, 'matches.pk'), 'wb') as f:
-			cPickle.dump(ar.matches, f)
-		with open(os.path.join(OUTPUT_DIR, 'article_to_idx.pk'), 'wb') as f:
-			cPickle.dump(ar.article_to_idx, f)
-		with open(os.path.join(OUTPUT_DIR, 'idx_to_article.pk'), 'wb') as f:
-			cPickle.dump(ar.idx_to_article, f)
-		with open(os.path.join(OUTPUT_DIR, 'errors.pk'), 'wb') as f:
-			cPickle.dump(ar.errors, f)
-		cache = False
-	num_matches = len(ar.matches)
+	num_matches += len(ar.matches)
+	qm.flush_persistent_cache()
+	sink.flush(ar, f)
 	print str(count) + ' files read'
 	print str(num_matches) + ' matches'
+	if num_workers <= 1:
+		# None until a quote falls in some transcript's window
+		print 'quote cache hit rate: %s' % qm.cache_stats()['quote_window']['hit_rate']
+		print 'prefilter rejection rate: %.3f' % qm.prefilter.stats()['rejection_rate']
+		print 'persistent cache hit rate: %s' % qm.persistent_cache.stats()['hit_rate']
+		print ar.pipeline_stats.summary()
+
+matches, idx_to_article, errors = load_output(os.path.join(OUTPUT_DIR, 'shards'))
 
-print str(len(ar.errors)) + ' errors'
+print str(len(errors)) + ' errors'
 
 print 'dumping all'
-with open(os.path.join(OUTPUT_DIR, 'matches.pk'), 'wb') as f:
-	cPickle.dump(ar.matches, f)
+# the list of match dicts, as before, for code that reads matches.pk
+matches.save_list(os.path.join(OUTPUT_DIR, 'matches.pk'))
+# and columnar, memory-mapped when read back with MatchStore.load
+matches.save(os.path.join(OUTPUT_DIR, 'matches'))
 with open(os.path.join(OUTPUT_DIR, 'article_to_idx.pk'), 'wb') as f:
 	cPickle.dump(ar.article_to_idx, f)
 with open(os.path.join(OUTPUT_DIR, 'idx_to_article.pk'), 'wb') as f:
-	cPickle.dump(ar.idx_to_article, f)
+	cPickle.dump(idx_to_article, f)
 with open(os.path.join(OUTPUT_DIR, 'errors.pk'), 'wb') as f:
-	cPickle.dump(ar.errors, f)
-print 'done'
\ No newline at end of file
+	cPickle.dump(errors, f)
+print 'done'
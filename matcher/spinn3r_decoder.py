@@ -0,0 +1,279 @@
+'''
+	decoder for lines of spinn3r data files.
+
+	each line is the repr of a dict of article fields. instead of eval-ing it, the line
+	is scanned once for the spans of the top-level fields, and each field is only
+	decoded (as a literal, never as code) when it is asked for. so an article
+	without quotes costs one scan, and its content is never built.
+'''
+
+import re
+import ast
+import time
+import datetime as dt
+
+NEWS_TIMEFORMAT = "%Y-%m-%d %H:%M:%S"
+
+# start of a string literal (with optional prefix), bracket/separator, or anything
+	# else (numbers, None, True, ...). the rest of a string literal is found with
+	# str.find, which skips long article contents much faster than a regex.
+_TOKEN_RE = re.compile(r'''\s*(?:
+		(?P<prefix>[uUbB]?[rR]?)(?P<quote>['"])
+		|(?P<punct>[\[\]{}(),:])
+		|(?P<other>[^\s\[\]{}(),:'"]+)
+	)''', re.X)
+
+# field names: plain str literals without escapes, followed by a colon
+_KEY_RE = re.compile(r"\s*'([^'\\]*)'\s*:\s*")
+
+_OPENERS = '[{('
+_CLOSERS = ']})'
+_CONSTANTS = {'None': None, 'True': True, 'False': False}
+
+_DATE_CACHE_SIZE = 100000
+_date_cache = {}
+
+
+def parse_date(strdate):
+
+	'''
+		parses a NEWS_TIMEFORMAT date. articles come roughly in time order,
+		so recent results are cached.
+	'''
+
+	date = _date_cache.get(strdate, None)
+	if date is None:
+		if len(_date_cache) >= _DATE_CACHE_SIZE:
+			_date_cache.clear()
+		date = dt.datetime.strptime(strdate, NEWS_TIMEFORMAT)
+		_date_cache[strdate] = date
+	return date
+
+
+def _string_end(line, pos):
+
+	# end of the string literal whose opening quote is at pos
+	quote = line[pos]
+	start = pos + 1
+	while True:
+		end = line.find(quote, start)
+		if end < 0:
+			raise ValueError('unterminated string in spinn3r record')
+		backslash = end - 1
+		while line[backslash] == '\\':
+			backslash -= 1
+		# an even number of backslashes means the quote isn't escaped
+		if (end - 1 - backslash) % 2 == 0:
+			return end + 1
+		start = end + 1
+
+
+def _next_token(line, pos):
+
+	# returns (punct, start, end); punct is None for anything but brackets and separators
+	match = _TOKEN_RE.match(line, pos)
+	if match is None or match.end() == pos:
+		raise ValueError('cannot parse spinn3r record at position %d' % pos)
+	if match.group('quote') is not None:
+		return None, match.start('prefix'), _string_end(line, match.start('quote'))
+	if match.group('punct') is not None:
+		return match.group('punct'), match.start('punct'), match.end()
+	return None, match.start('other'), match.end()
+
+
+def _skip_value(line, pos):
+
+	# returns position of the ',' or '}' that ends the value starting at pos
+	depth = 0
+	while True:
+		punct, start, pos = _next_token(line, pos)
+		if punct is not None:
+			if depth == 0 and punct in ',}':
+				return start
+			if punct in _OPENERS:
+				depth += 1
+			elif punct in _CLOSERS:
+				depth -= 1
+				if depth < 0:
+					raise ValueError('unbalanced spinn3r record')
+
+
+def _parse_value(line, pos):
+
+	# decodes the literal starting at pos; returns (value, end of literal)
+	punct, start, end = _next_token(line, pos)
+
+	if punct is None:
+		token = line[start:end]
+		if token[-1] in '\'"':
+			# plain str literals make up nearly everything, and string_escape
+				# undoes their repr much faster than the parser does.
+			if token[0] in '\'"':
+				return token[1:-1].decode('string_escape'), end
+			return ast.literal_eval(token), end
+		elif token in _CONSTANTS:
+			return _CONSTANTS[token], end
+		try:
+			return int(token), end
+		except ValueError:
+			pass
+		try:
+			return float(token), end
+		except ValueError:
+			return ast.literal_eval(token), end
+
+	elif punct in _OPENERS:
+		closer = _CLOSERS[_OPENERS.index(punct)]
+		elems = []
+		pos = end
+		while True:
+			next_punct, start, next_end = _next_token(line, pos)
+			if next_punct == closer:
+				break
+			if punct == '{':
+				key, pos = _parse_value(line, pos)
+				next_punct, start, pos = _next_token(line, pos)
+				if next_punct != ':':
+					raise ValueError('spinn3r record is missing a colon')
+				value, pos = _parse_value(line, pos)
+				elems.append((key, value))
+			else:
+				value, pos = _parse_value(line, pos)
+				elems.append(value)
+			next_punct, start, next_end = _next_token(line, pos)
+			if next_punct == closer:
+				break
+			elif next_punct != ',':
+				raise ValueError('spinn3r record is missing a comma')
+			pos = next_end
+		if punct == '{':
+			return dict(elems), next_end
+		elif punct == '(':
+			return tuple(elems), next_end
+		return elems, next_end
+
+	raise ValueError('unexpected %s in spinn3r record' % punct)
+
+
+def _decode_literal(text):
+
+	value, end = _parse_value(text, 0)
+	if text[end:].strip():
+		raise ValueError('trailing characters in spinn3r field')
+	return value
+
+
+def _scan_fields(line):
+
+	# returns dict of field name to (start, end) of its value in line.
+	# keys are plain strings and most values are strings, so those are handled
+		# without going through the tokenizer.
+	spans = {}
+	punct, start, pos = _next_token(line, 0)
+	if punct != '{':
+		raise ValueError('spinn3r record is not a dict')
+	if _next_token(line, pos)[0] == '}':
+		return spans
+
+	while True:
+		match = _KEY_RE.match(line, pos)
+		if match is None:
+			raise ValueError('spinn3r record has an unexpected key')
+		key = match.group(1)
+
+		value_start = match.end()
+		if line[value_start] in '\'"':
+			value_end = _string_end(line, value_start)
+		else:
+			value_end = _skip_value(line, value_start)
+		spans[key] = (value_start, value_end)
+
+		# repr separates items with ', ' 
+		if line.startswith(', ', value_end):
+			pos = value_end + 2
+			continue
+		punct, start, pos = _next_token(line, value_end)
+		if punct == '}':
+			return spans
+		elif punct != ',':
+			raise ValueError('spinn3r record is missing a comma')
+
+
+class Spinn3rRecord(object):
+
+	'''
+		one spinn3r article, decoded lazily. read like the article dict:
+
+			record['url'], record['content'], ... : fields as stored
+			record['date']: date as datetime
+			record['quotes']: tuple of quote texts
+			record['onsets']: tuple of quote onsets (idx of each quote in content)
+
+		Arguments:
+
+			line: line of a spinn3r data file
+			stats (PipelineStats, default=None): if given, the time spent decoding
+				fields as they're asked for is added to its 'decode' stage
+	'''
+
+	__slots__ = ('_line', '_spans', '_values', '_stats')
+
+	def __init__(self, line, stats=None):
+
+		self._line = line
+		self._values = {}
+		self._stats = stats
+		try:
+			self._spans = _scan_fields(line)
+		except (ValueError, IndexError):
+			# not what we expected; decode everything the slow (but still safe) way
+			self._spans = {}
+			self._values = ast.literal_eval(line.strip())
+			if not isinstance(self._values, dict):
+				raise ValueError('spinn3r record is not a dict')
+
+	def _field(self, key):
+
+		if key not in self._values:
+			start_time = time.time()
+			start, end = self._spans[key]
+			self._values[key] = _decode_literal(self._line[start:end])
+			if self._stats is not None:
+				self._stats.add('decode', time.time() - start_time)
+		return self._values[key]
+
+	def __getitem__(self, key):
+
+		if key == 'date':
+			return parse_date(self._field('date'))
+		elif key == 'quotes':
+			return tuple(elem['quote'] for elem in self._field('quotes'))
+		elif key == 'onsets':
+			return tuple(elem['onset'] for elem in self._field('quotes'))
+		return self._field(key)
+
+	def __contains__(self, key):
+		if key == 'onsets':
+			key = 'quotes'
+		return key in self._spans or key in self._values
+
+	def get(self, key, default=None):
+		if key in self:
+			return self[key]
+		return default
+
+	def keys(self):
+
+		keys = set(self._spans) | set(self._values)
+		if 'quotes' in keys:
+			keys.add('onsets')
+		return list(keys)
+
+	def materialize(self):
+
+		'''
+			returns the fully decoded article as a dict; see ArticleReader for its format.
+		'''
+
+		return dict((key, self[key]) for key in self.keys())
+
@@ -0,0 +1,564 @@
+'''
+	tests for the matcher and what's around it: batch matching, the indexes and
+	alignment engines that stand in for full scans, match storage and output.
+
+	run from this directory with
+
+		python -m unittest discover -p 'test_*.py'
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+import datetime as dt
+import numpy as np
+
+import transcript_utils as tu
+import match_utils as mu
+import lsh_index
+from word_index import WordIndex
+from ngram_index import NgramIndex
+from matcher import QuoteMatcher
+from corpus import build_corpus, Corpus
+from article_reader import ArticleReader, article_key
+from match_sink import MatchSink, load_output
+from match_store import MatchStore
+from spinn3r_decoder import Spinn3rRecord
+from read_ahead import PipelineStats
+import cPickle
+
+STOPWORD_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mysql_stop.txt')
+
+# filename -> (date, paragraphs)
+TRANSCRIPTS = {
+	'a': ('2014-01-01 12:00', [
+			'THE PRESIDENT: We are going to rebuild the roads and bridges of this country.',
+			'And every child deserves a great teacher in every single classroom.'
+		]),
+	'b': ('2014-01-05 12:00', [
+			'THE PRESIDENT: Every child deserves a great teacher in every classroom.',
+			'We will not stop until the job is done for the middle class.'
+		]),
+	'c': ('2014-01-10 12:00', [
+			'THE PRESIDENT: We are going to rebuild the roads and bridges of this country.',
+			'Health care is a right and not a privilege for the few.'
+		]),
+	'd': ('2014-06-01 12:00', [
+			'THE PRESIDENT: Health care is a right and not a privilege for the few.'
+		])
+}
+
+QUOTES = [
+	'We are going to rebuild the roads and bridges of this country',
+	'every child deserves a great teacher in every single classroom',
+	'We will not stop until the job is done for the middle class',
+	'Health care is a right and not a privilege',
+	'we are going to rebuild our roads and bridges in this country',
+	'nothing like anything that was said in any of these speeches at all',
+	'?? quote that spinn3r mangled',
+	'too short'
+]
+
+# quotes from these times have windows (see QuoteMatcher.MAX_INTERVAL) of transcripts:
+DATES = [
+	dt.datetime(2014, 1, 3),	# a
+	dt.datetime(2014, 1, 6),	# a, b
+	dt.datetime(2014, 1, 11),	# b, c
+	dt.datetime(2014, 1, 13),	# c
+	dt.datetime(2014, 3, 1),	# none: c is the latest before, but too long before
+	dt.datetime(2013, 12, 1),	# none: before every transcript
+	dt.datetime(2014, 6, 2)	# d
+]
+
+
+def load_transcripts(**kwargs):
+
+	# (order, transcripts) of TRANSCRIPTS
+	transcript_dir = tempfile.mkdtemp()
+	try:
+		for name, (date, paragraphs) in TRANSCRIPTS.items():
+			with open(os.path.join(transcript_dir, name), 'w') as f:
+				f.write('\n'.join(['Remarks ' + name, date] + paragraphs))
+		return tu.load_transcript_collection(transcript_dir, STOPWORD_FILE, **kwargs)
+	finally:
+		shutil.rmtree(transcript_dir)
+
+
+class MatchQuotesTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.order, cls.transcripts = load_transcripts()
+		cls.batch = [(quote, date) for date in DATES for quote in QUOTES]
+
+	def matcher(self, **kwargs):
+		return QuoteMatcher(self.order, self.transcripts, STOPWORD_FILE, **kwargs)
+
+	def check_batch(self, batch, **kwargs):
+
+		expected = [self.matcher(**kwargs).match_quote(quote, timestamp)
+					for quote, timestamp in batch]
+		qm = self.matcher(**kwargs)
+		self.assertEqual(qm.match_quotes(batch), expected)
+		# and nothing different was left in the caches
+		self.assertEqual([qm.match_quote(quote, timestamp) for quote, timestamp in batch],
+						expected)
+		return expected
+
+	def test_matches_found(self):
+
+		# so the comparisons below aren't all between Nones
+		results = self.check_batch(self.batch)
+		self.assertTrue(any(result is not None for result in results))
+		self.assertTrue(any(result is None for result in results))
+
+	def test_without_index_or_prefilter(self):
+		self.check_batch(self.batch, use_index=False, use_prefilter=False)
+
+	def test_empty_window(self):
+
+		# a quote with no transcripts in its window next to one whose window
+		# includes the transcript before it
+		quote = QUOTES[0]
+		batch = [(quote, dt.datetime(2014, 3, 1)), (quote, dt.datetime(2014, 1, 12))]
+		for kwargs in [{}, {'use_index': False, 'use_prefilter': False}]:
+			results = self.check_batch(batch, **kwargs)
+			self.assertEqual(results[0], None)
+			self.assertEqual(results[1]['transcript'], 'c')
+
+	def test_overlapping_windows(self):
+
+		quote = QUOTES[1]
+		batch = [(quote, date) for date in DATES[:4]]
+		for kwargs in [{}, {'use_index': False, 'use_prefilter': False}]:
+			results = self.check_batch(batch, **kwargs)
+			self.assertEqual([result['transcript'] if result else None for result in results],
+							['a', 'b', 'b', None])
+
+	def test_nw_backend(self):
+		self.check_batch(self.batch, align_backend='nw')
+
+
+class CompactTranscriptsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cache_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.cache_dir)
+
+	def test_same_as_dicts(self):
+
+		order, transcripts = load_transcripts()
+		cache_file = os.path.join(self.cache_dir, 'cache.pk')
+		compact_order, compact = load_transcripts(compact=True, cache_file=cache_file)
+		self.assertEqual(compact_order, order)
+		self.assertTrue(isinstance(compact['a'], tu.Transcript))
+		self.assertEqual(compact, transcripts)
+
+		paragraph = compact['a']['paragraphs'][1]
+		self.assertEqual(paragraph['raw'], ' '.join(paragraph['match']))
+		self.assertEqual(paragraph.match, transcripts['a']['paragraphs'][1]['match'])
+		self.assertEqual(sorted(paragraph.keys()), sorted(transcripts['a']['paragraphs'][1]))
+		self.assertEqual((paragraph.get('speaker'), paragraph.get('x')), ('THE PRESIDENT', None))
+		self.assertRaises(KeyError, paragraph.__getitem__, 'x')
+		# words are stored once for the whole collection
+		self.assertTrue(compact['a']['paragraphs'][0]['match'][0]
+						is compact['c']['paragraphs'][0]['match'][0])
+
+		for protocol in [0, 2]:
+			self.assertEqual(cPickle.loads(cPickle.dumps(compact, protocol)), transcripts)
+		self.assertEqual(dict((name, transcript.to_dict())
+							for name, transcript in compact.iteritems()), transcripts)
+
+		# from the cache, in either form
+		cached_order, cached = load_transcripts(cache_file=cache_file)
+		self.assertTrue(type(cached['a']) is dict)
+		self.assertEqual(cached, transcripts)
+		cached_order, cached = load_transcripts(compact=True, cache_file=cache_file)
+		self.assertEqual(cached, transcripts)
+
+	def test_matching(self):
+
+		order, transcripts = load_transcripts()
+		compact_order, compact = load_transcripts(compact=True)
+		batch = [(quote, date) for date in DATES for quote in QUOTES]
+		for kwargs in [{}, {'use_index': False, 'align_backend': 'nw'}]:
+			self.assertEqual(QuoteMatcher(compact_order, compact, STOPWORD_FILE,
+											**kwargs).match_quotes(batch),
+							QuoteMatcher(order, transcripts, STOPWORD_FILE,
+											**kwargs).match_quotes(batch))
+
+
+class PrefilterTest(unittest.TestCase):
+
+	def setUp(self):
+		self.corpus_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.corpus_dir)
+
+	def test_from_corpus(self):
+
+		order, transcripts = load_transcripts()
+		build_corpus(order, transcripts, self.corpus_dir)
+		corpus = Corpus(self.corpus_dir)
+
+		# the filters come from the corpus arrays, not from its paragraphs
+		def paragraph(self, para_num):
+			raise AssertionError('built paragraph %d' % para_num)
+		real_paragraph = Corpus.paragraph
+		Corpus.paragraph = paragraph
+		try:
+			qms = [QuoteMatcher(corpus.order(), corpus.transcripts, STOPWORD_FILE, **kwargs)
+					for kwargs in [{}, {'use_index': False}]]
+		finally:
+			Corpus.paragraph = real_paragraph
+
+		batch = [(quote, date) for date in DATES for quote in QUOTES]
+		expected = QuoteMatcher(order, transcripts, STOPWORD_FILE,
+								use_prefilter=False).match_quotes(batch)
+		for qm in qms:
+			self.assertEqual(qm.match_quotes(batch), expected)
+			self.assertTrue(qm.prefilter.stats()['rejected'] > 0)
+
+
+class TokenizeQuotesTest(unittest.TestCase):
+
+	def test_tokenize(self):
+
+		vocab = {'we': 0, 'are': 1, 'going': 2}
+		tokenized = mu.tokenize_quotes(QUOTES + QUOTES[:1], vocab)
+		self.assertEqual(sorted(tokenized), sorted(set(QUOTES)))
+		for quote in QUOTES:
+			segment_arr, token_arr = tokenized[quote]
+			self.assertEqual(segment_arr, mu.segment_quote(quote))
+			self.assertEqual(token_arr, [tuple(vocab.get(word, -1) for word in seg)
+										for seg in segment_arr])
+		self.assertEqual(tokenized[QUOTES[0]][1][0][:4], (0, 1, 2, -1))
+		self.assertEqual(mu.tokenize_quotes(QUOTES[:1])[QUOTES[0]][1], None)
+
+
+class CandidateIndexTest(unittest.TestCase):
+
+	# the indexes have to turn up exactly what a scan of every paragraph would
+
+	@classmethod
+	def setUpClass(cls):
+
+		order, cls.transcripts = load_transcripts()
+		cls.names = [name for name, date in order]
+		cls.stopwords = mu.load_stopword_set(STOPWORD_FILE)
+		cls.segments = [seg for quote in QUOTES for seg in mu.segment_quote(quote)]
+		for name in cls.names:
+			for paragraph in cls.transcripts[name]['paragraphs']:
+				match_array = paragraph['match']
+				for start in range(0, len(match_array) - 3, 2):
+					seg = tuple(match_array[start:start+6])
+					cls.segments.append(seg)
+					# starting and ending mid-word
+					cls.segments.append((seg[0][1:],) + seg[1:-1] + (seg[-1][:2],))
+
+	def windows(self):
+		num = len(self.names)
+		return [(earliest, latest) for earliest in range(num) for latest in range(earliest, num)]
+
+	def paragraphs(self, earliest, latest):
+		for transcript_idx in range(earliest, latest + 1):
+			paragraphs = self.transcripts[self.names[transcript_idx]]['paragraphs']
+			for para_idx, paragraph in enumerate(paragraphs):
+				yield transcript_idx, para_idx, paragraph
+
+	def test_word_index(self):
+
+		index = WordIndex(self.names, self.transcripts, self.stopwords)
+		for seg in self.segments:
+			segment_words = set(seg) - self.stopwords
+			interior_words = set(seg[1:-1]) - self.stopwords
+			for min_fuzz_len, word_ratio in [(7, .75), (3, .5)]:
+				for earliest, latest in self.windows():
+					result = index.candidates(seg, earliest, latest, min_fuzz_len, word_ratio)
+					if len(interior_words) == 0:
+						self.assertEqual(result, None)
+						continue
+					expected = {}
+					for transcript_idx, para_idx, paragraph in self.paragraphs(earliest, latest):
+						overlap = len(segment_words & paragraph['words'])
+						if (interior_words <= paragraph['words'] or (len(seg) >= min_fuzz_len
+								and overlap / float(len(segment_words)) >= word_ratio)):
+							expected.setdefault(transcript_idx, []).append((para_idx, overlap))
+					self.assertEqual(result, expected)
+
+	def test_ngram_index(self):
+
+		index = NgramIndex(self.names, self.transcripts)
+		trimmed_found = set()
+		for seg in self.segments:
+			seg_len = len(seg)
+			for earliest, latest in self.windows():
+				result = index.lookup(seg, earliest, latest)
+				if seg_len < index.k + 2:
+					self.assertEqual(result, None)
+					continue
+				expected = []
+				for transcript_idx, para_idx, paragraph in self.paragraphs(earliest, latest):
+					match_array = paragraph['match']
+					exact = [offset for offset in range(len(match_array) - seg_len + 1)
+							if tuple(match_array[offset:offset+seg_len]) == seg]
+					expected.extend((transcript_idx, para_idx, offset, False) for offset in exact)
+					for offset in range(len(match_array) - seg_len + 1):
+						if (offset not in exact
+								and tuple(match_array[offset+1:offset+seg_len-1]) == seg[1:-1]
+								and match_array[offset].endswith(seg[0])
+								and match_array[offset+seg_len-1].startswith(seg[-1])):
+							expected.append((transcript_idx, para_idx, offset, True))
+				self.assertEqual(result, sorted(expected))
+				trimmed_found.update(hit[3] for hit in result)
+		# so the comparisons above aren't all between empty lists
+		self.assertEqual(trimmed_found, set([False, True]))
+
+
+class AlignParaphraseTest(unittest.TestCase):
+
+	# the banded and bit-parallel scorers against the full NW matrix, on random
+		# word arrays, with thresholds at and around each pair's actual score
+
+	def pairs(self):
+		random_state = np.random.RandomState(0)
+		words = list('abcdef')
+		for trial in range(300):
+			quote = [words[k] for k in random_state.randint(0, 6, random_state.randint(1, 10))]
+			transcript = [words[k] for k in random_state.randint(0, 6, random_state.randint(0, 25))]
+			yield quote, transcript
+
+	def test_banded(self):
+
+		for quote, transcript in self.pairs():
+			quote_ids, transcript_ids = mu._encode_tokens(quote, transcript)
+			for sub_pen, gap_pen in [(-1, -1), (-2, -1), (-1, -2)]:
+				full_matrix = mu._nw_matrix(quote_ids, transcript_ids, sub_pen, gap_pen)
+				full = mu._nw_traceback(full_matrix, quote_ids, transcript_ids, sub_pen, gap_pen)
+				step = 1. / len(quote)
+				for min_score in [full[1] - step, full[1], full[1] + step]:
+					banded_matrix = mu._nw_matrix_banded(quote_ids, transcript_ids, sub_pen,
+										gap_pen, min_score)
+					if banded_matrix is not None:
+						kept = np.isfinite(banded_matrix)
+						self.assertTrue(np.array_equal(banded_matrix[kept], full_matrix[kept]))
+					result = mu.align_paraphrase(quote, transcript, sub_pen, gap_pen, min_score)
+					if full[1] >= min_score:
+						self.assertEqual(result, full)
+					else:
+						self.assertTrue(result[1] < min_score)
+
+	def test_score_paraphrase(self):
+
+		for quote, transcript in self.pairs():
+			self.assertAlmostEqual(mu.score_paraphrase(quote, transcript),
+								mu.align_paraphrase(quote, transcript)[1])
+
+
+class AlignVerbatimTest(unittest.TestCase):
+
+	def test_whole_words(self):
+		self.assertEqual(mu.align_verbatim(['b', 'c'], ['a', 'b', 'c', 'd']), (1, 2))
+
+	def test_cut_words(self):
+
+		# a quote starting and ending mid-word gets the same kind of alignment
+		self.assertEqual(mu.align_verbatim(['ig', 'b', 'c', 'mid'],
+						['a', 'big', 'b', 'c', 'middle', 'd']), (1, 2, 3, 4))
+
+	def test_not_found(self):
+		self.assertEqual(mu.align_verbatim(['x', 'y'], ['a', 'b', 'c']), None)
+
+
+class LSHIndexTest(unittest.TestCase):
+
+	def test_unicode_words(self):
+
+		self.assertEqual(lsh_index._word_hash(u'roads'), lsh_index._word_hash('roads'))
+		self.assertEqual(lsh_index._word_hash(u'caf\xe9'), lsh_index._word_hash('caf\xc3\xa9'))
+
+		order, transcripts = load_transcripts()
+		names = [name for name, date in order]
+		index = lsh_index.LSHIndex(names, transcripts, mu.load_stopword_set(STOPWORD_FILE))
+		segment = tuple(u'we are going to rebuild the roads and bridges of this caf\xe9'.split())
+		candidates = index.candidates(segment, 0, len(names) - 1, .75)
+		self.assertEqual(sorted(names[i] for i in candidates), ['a', 'c'])
+
+
+class MatchStoreTest(unittest.TestCase):
+
+	MATCHES = [
+		{'quote': 'q one', 'url': 'u1', 'article_idx': 0, 'transcript_name': 'a',
+			'paragraph': [0, 2], 'alignment': [(1, 2, 3), (0, 1)], 'similarity': 0.0},
+		{'quote': 'q two', 'url': 'u1', 'article_idx': 0, 'transcript_name': 'b',
+			'paragraph': [1], 'alignment': [()], 'similarity': -0.25},
+		{'quote': 'q one', 'url': 'u2', 'article_idx': 1, 'transcript_name': 'a',
+			'paragraph': [], 'alignment': [], 'similarity': -0.5}
+	]
+
+	def setUp(self):
+		self.output_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.output_dir)
+
+	def test_round_trip(self):
+
+		store = MatchStore()
+		store.extend(self.MATCHES)
+		self.assertEqual(list(store), self.MATCHES)
+		self.assertEqual((len(store), store[-1]), (3, self.MATCHES[-1]))
+		self.assertEqual(store.quotes, ['q one', 'q two'])
+
+		store_dir = os.path.join(self.output_dir, 'matches')
+		store.save(store_dir)
+		for mmap in [True, False]:
+			loaded = MatchStore.load(store_dir, mmap=mmap)
+			self.assertEqual(list(loaded), self.MATCHES)
+			# and can be added to
+			loaded.append(self.MATCHES[0])
+			self.assertEqual(list(loaded), self.MATCHES + self.MATCHES[:1])
+
+		path = os.path.join(self.output_dir, 'matches.pk')
+		store.save_list(path, batch_size=2)
+		with open(path, 'rb') as f:
+			self.assertEqual(cPickle.load(f), self.MATCHES)
+
+	def test_clear(self):
+
+		store = MatchStore()
+		store.extend(self.MATCHES)
+		store.clear()
+		self.assertEqual((len(store), list(store)), (0, []))
+		self.assertEqual((store.quotes, store.urls, store.transcript_names), ([], [], []))
+		store.append(self.MATCHES[1])
+		self.assertEqual(list(store), self.MATCHES[1:2])
+
+	def test_bad_match(self):
+
+		# leaves the store as it was
+		store = MatchStore()
+		store.append(self.MATCHES[0])
+		bad = dict(self.MATCHES[1], alignment=[((1, 2), 0)])
+		self.assertRaises(TypeError, store.append, bad)
+		self.assertEqual(list(store), self.MATCHES[:1])
+
+
+class Spinn3rRecordTest(unittest.TestCase):
+
+	def test_decode_stats(self):
+
+		# fields decoded as they're read are counted under 'decode', once each
+		line = repr({'url': 'http://example.com/1', 'content': 'x' * 10**6,
+					'quotes': [{'quote': 'a quote', 'onset': 3}]})
+		stats = PipelineStats()
+		record = Spinn3rRecord(line, stats)
+		self.assertEqual(stats.seconds['decode'], 0)
+		self.assertEqual(record['quotes'], ('a quote',))
+		self.assertEqual(len(record['content']), 10**6)
+		decode_seconds = stats.seconds['decode']
+		self.assertTrue(decode_seconds > 0)
+		record['content']
+		self.assertEqual(stats.seconds['decode'], decode_seconds)
+
+
+class ArticleKeyTest(unittest.TestCase):
+
+	def test_normalized(self):
+
+		key = article_key('http://example.com/news/story', 'some  content\n here')
+		for url, content in [
+				('HTTP://Example.COM/news/story/', 'some content here'),
+				(' http://example.com/news/story#comments', ' some content here '),
+				(u'http://example.com/news/story', u'some content\there')]:
+			self.assertEqual(article_key(url, content), key)
+		self.assertEqual(article_key(u'http://example.com/caf\xe9', u'caf\xe9'),
+						article_key('http://example.com/caf\xc3\xa9', 'caf\xc3\xa9'))
+
+		# paths and queries are case sensitive, and the fields stay apart
+		for url, content in [
+				('http://example.com/News/story', 'some content here'),
+				('http://example.com/news/story?page=2', 'some content here'),
+				('http://example.com/news/story', 'some content'),
+				('http://example.com/news/storysome', 'content here')]:
+			self.assertNotEqual(article_key(url, content), key)
+
+	def test_dedup(self):
+
+		# a re-crawled copy is the same article; the earliest version is kept
+		reader = ArticleReader(None)
+		article = _article(3)
+		copy = dict(article, url=article['url'].upper().replace('/EXAMPLE', '/example') + '/',
+					content=' ' + article['content'] + ' ', date=dt.datetime(2014, 1, 1))
+		result = {'transcript': 'a', 'paragraph': [0], 'alignment': [(0, 1)], 'similarity': 0.0}
+		reader._add_article(article, [result])
+		reader._add_article(copy, [result])
+		self.assertEqual(len(reader.matches), 1)
+		self.assertEqual(reader.idx_to_article, {0: copy})
+		self.assertEqual(reader.updated_articles, set([0]))
+
+
+def _article(k):
+	return {'url': 'http://example.com/%d' % k, 'title': 'title', 'content': 'content %d' % k,
+			'quotes': ('quote %d' % k,), 'onsets': (0,), 'date': dt.datetime(2014, 1, k + 1)}
+
+
+def _read_articles(reader, ks):
+
+	# leaves reader as if it had read a file of articles ks, with a match each
+	for k in ks:
+		article = _article(k)
+		reader.matches.append({'quote': article['quotes'][0], 'url': article['url'],
+							'article_idx': reader._next_article_idx, 'transcript_name': 'a',
+							'paragraph': [0], 'alignment': [(0, 1)], 'similarity': 0.0})
+		reader._store_article(reader._article_key(article), article)
+
+
+class MatchSinkTest(unittest.TestCase):
+
+	def setUp(self):
+		self.output_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.output_dir)
+
+	def test_resume_after_crash(self):
+
+		reader = ArticleReader(None)
+		sink = MatchSink(self.output_dir)
+		for filename, ks in [('f1', [0, 1]), ('f2', [2])]:
+			_read_articles(reader, ks)
+			sink.flush(reader, filename)
+		shard_path = sink._shard_path(0)
+		offset = os.path.getsize(shard_path)
+
+		# a run dies writing f3: half its record is in the shard, and the log line
+			# is cut off where its offset is still all digits
+		with open(shard_path, 'ab') as f:
+			f.write('half a record')
+		with open(os.path.join(self.output_dir, 'done.txt'), 'a') as f:
+			f.write('f3\t0\t12')
+
+		reader = ArticleReader(None)
+		sink = MatchSink(self.output_dir)
+		self.assertEqual(sink.done, set(['f1', 'f2']))
+		self.assertEqual(os.path.getsize(shard_path), offset)
+		sink.restore(reader)
+		self.assertEqual(reader._next_article_idx, 3)
+		self.assertTrue(reader._article_key(_article(1)) in reader.article_to_idx)
+
+		_read_articles(reader, [3])
+		sink.flush(reader, 'f3')
+		matches, idx_to_article, errors = load_output(self.output_dir)
+		self.assertEqual([match['quote'] for match in matches],
+						['quote %d' % k for k in range(4)])
+		self.assertEqual([match['article_idx'] for match in matches], range(4))
+		self.assertEqual(sorted(idx_to_article), range(4))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,99 @@
+'''
+	tests that scores recorded by a ScoreRecorder replay to what QuoteMatcher gives.
+
+	run from this directory with
+
+		python -m unittest discover -p 'test_*.py'
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+import threshold_sweep as ts
+from matcher import QuoteMatcher
+from test_matcher import load_transcripts, STOPWORD_FILE, QUOTES, DATES
+
+
+class _Strict(QuoteMatcher):
+	MIN_LEN = 8
+	MIN_FUZZ_LEN = 9
+	ACCEPT_THRESHOLD = 0
+
+
+def _record_file(recorder, batch, filename):
+
+	# what a worker of parallel_reader does with a file
+	recorder.match_quotes(batch)
+	recorder.flush(filename)
+
+
+class ScoreRecorderTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.order, cls.transcripts = load_transcripts()
+		cls.batch = [(quote, date) for date in DATES for quote in QUOTES]
+
+	def setUp(self):
+		self.output_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.output_dir)
+
+	def expected(self, matcher_class, **kwargs):
+		qm = matcher_class(self.order, self.transcripts, STOPWORD_FILE, **kwargs)
+		return [qm.match_quote(quote, timestamp) for quote, timestamp in self.batch]
+
+	def test_replay(self):
+
+		qm = QuoteMatcher(self.order, self.transcripts, STOPWORD_FILE, sim_tolerance=-.6,
+						word_ratio=.5)
+		recorder = ts.ScoreRecorder(qm, self.output_dir)
+		half = len(self.batch) // 2
+		_record_file(recorder, self.batch[:half], 'a')
+		_record_file(recorder, self.batch[half:], 'b')
+		self.assertEqual((recorder.records, recorder.calls), ({}, []))
+
+		recording = ts.load_recording(self.output_dir)
+		self.assertEqual(recording['filenames'], ['a', 'b'])
+		results, num_matches = ts.replay(recording, recording['floor'])
+		self.assertEqual(results, self.expected(QuoteMatcher, sim_tolerance=-.6, word_ratio=.5))
+
+		params = {'sim_tolerance': -.4, 'word_ratio': .75, 'accept_threshold': 0, 'min_len': 8,
+				'min_fuzz_len': 9}
+		results, num_matches = ts.replay(recording, params)
+		self.assertEqual(results, self.expected(_Strict))
+		with self.assertRaises(ValueError):
+			ts.replay(recording, dict(params, sim_tolerance=-1))
+
+	def test_workers(self):
+
+		# each process writes its own shard; a half-written block at the end of
+			# one, from a process that died, is ignored
+		qm = QuoteMatcher(self.order, self.transcripts, STOPWORD_FILE)
+		recorder = ts.ScoreRecorder(qm, self.output_dir)
+		half = len(self.batch) // 2
+		worker = multiprocessing.Process(target=_record_file,
+							args=(recorder, self.batch[half:], 'b'))
+		worker.start()
+		worker.join()
+		_record_file(recorder, self.batch[:half], 'a')
+
+		shards = [name for name in os.listdir(self.output_dir) if name.startswith('scores_')]
+		self.assertEqual(len(shards), 2)
+		shard_path = os.path.join(self.output_dir, shards[0])
+		with open(shard_path, 'rb') as f:
+			block = f.read()
+		with open(shard_path, 'ab') as f:
+			f.write(block[:len(block) // 2])
+
+		recording = ts.load_recording(self.output_dir)
+		self.assertEqual(recording['filenames'], ['a', 'b'])
+		self.assertEqual(ts.replay(recording, recording['floor'])[0], self.expected(QuoteMatcher))
+
+
+if __name__ == '__main__':
+	unittest.main()
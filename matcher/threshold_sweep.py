@@ -0,0 +1,427 @@
+'''
+	recording of raw match scores, so thresholds can be tried out offline.
+
+	a ScoreRecorder wraps a QuoteMatcher set up with loose thresholds (the floor).
+	for every quote it's asked to match, it records every paragraph each segment
+	matches in every transcript of the quote's window at the floor, with its
+	score, alignment and word overlap. replay then works out what match_quote
+	would have returned for any parameters at least as strict as the floor,
+	without aligning anything again:
+
+		sim_tolerance: segment matches scoring below it are dropped
+		word_ratio, min_fuzz_len: fuzzy (not verbatim) segment matches with less
+			word overlap, or of shorter segments, are dropped
+		accept_threshold: the search stops at the first transcript scoring this
+		min_len: quotes without a segment this long are skipped
+
+	MAX_INTERVAL (the window) can't be changed after recording. with an LSH index
+	(see lsh_index), candidate paragraphs depend on word_ratio, so replay can
+	find matches a real run with the tighter word_ratio would have missed.
+
+	scores are written out after every input file, like MatchSink does with
+	matches, so a recorder never holds more than one file's worth.
+
+	output_dir layout:
+
+		meta.pk: {'floor', 'transcript_names'}
+		scores_*.pk: one shard per process that recorded (the parent, or each
+			worker; see parallel_reader), holding pickled blocks, one after the
+			other, one per input file:
+			{
+				'filename': input file,
+				'records': records (see ScoreRecorder) of the quotes in the file,
+				'calls': window keys of the quotes in the file, in order
+			}
+
+	can also be run as a script:
+
+		python threshold_sweep.py output_dir name=value1,value2 ...
+
+	which prints the number of matches for every combination of the given values.
+	parameters that aren't given keep their recorded floor.
+'''
+
+from __future__ import division
+import os
+import sys
+import cPickle
+import tempfile
+import itertools
+import match_utils as mu
+from lru_cache import LRUCache
+
+# parameters whose recorded floor the replayed ones can't go below;
+# accept_threshold can be anything.
+FLOOR_NAMES = ['sim_tolerance', 'word_ratio', 'min_len', 'min_fuzz_len']
+
+META_FILENAME = 'meta.pk'
+SHARD_PREFIX = 'scores_'
+
+
+def matcher_params(quote_matcher):
+
+	'''
+		returns the parameters (see above) a QuoteMatcher is using, as a dict.
+	'''
+
+	return {
+			'sim_tolerance': quote_matcher.tol,
+			'word_ratio': quote_matcher.word_ratio,
+			'accept_threshold': quote_matcher.ACCEPT_THRESHOLD,
+			'min_len': quote_matcher.MIN_LEN,
+			'min_fuzz_len': quote_matcher.MIN_FUZZ_LEN
+		}
+
+
+class ScoreRecorder(object):
+
+	'''
+		records the raw scores of quotes (see above).
+
+		has match_quote, match_quotes and flush_persistent_cache like QuoteMatcher,
+		so it can stand in for one in an ArticleReader; match_quote and
+		match_quotes return what a QuoteMatcher with params would. call flush
+		after every input file to write out its scores (read_spinn3r_files does
+		this with after_file=recorder.flush). worker processes forked from the
+		process that made the recorder write their own shards.
+
+		calls include the quotes of articles the ArticleReader then drops as
+		duplicates: ones repeated within a batch, and, with parallel workers
+		(each reading its files with a fresh ArticleReader), ones repeated across
+		input files. so replay counts somewhat more matches than a run stores.
+
+		Arguments:
+
+			quote_matcher: QuoteMatcher whose thresholds are the floor. MIN_LEN
+				and MIN_FUZZ_LEN are class attributes and the prefilter is set up
+				with them, so lower ones need a subclass.
+			output_dir: directory for the scores (see above); is created if
+				needed. scores already there, recorded at the same floor, are kept.
+			params (dict, default=None): parameters for the results match_quote
+				returns (see above); defaults to the floor, i.e. what quote_matcher
+				itself would return.
+			cache_bytes (int, default=256MB): budget of the cache of segment results
+
+		Structures:
+
+			records: since the last flush, map of
+				(quote, earliest transcript idx, latest transcript idx) ->
+				{
+					'seg_lens': length of each segment,
+					'transcripts': map of transcript idx -> per segment, list of
+						(paragraph num, score, overlap ratio, verbatim, alignment),
+						sorted by paragraph num. only transcripts where every
+						segment matches some paragraph are kept.
+				}
+			calls: since the last flush, window key of each quote asked for, in
+				order (None for quotes with no transcripts in their window)
+	'''
+
+	def __init__(self, quote_matcher, output_dir, params=None, cache_bytes=256 * 2**20):
+
+		self.qm = quote_matcher
+		self.floor = matcher_params(quote_matcher)
+		if params is None:
+			params = self.floor
+		check_params(params, self.floor)
+		self.params = params
+
+		self.output_dir = output_dir
+		if not os.path.exists(output_dir):
+			os.makedirs(output_dir)
+		meta = {'floor': self.floor, 'transcript_names': self.qm.order}
+		meta_path = os.path.join(output_dir, META_FILENAME)
+		if os.path.exists(meta_path):
+			with open(meta_path, 'rb') as f:
+				if cPickle.load(f) != meta:
+					raise ValueError('%s holds scores recorded with another floor or transcripts'
+									% output_dir)
+		else:
+			with open(meta_path, 'wb') as f:
+				cPickle.dump(meta, f, cPickle.HIGHEST_PROTOCOL)
+
+		self.records = {}
+		self.calls = []
+
+		# shard of the process that last flushed; a forked worker starts its own
+		self._shard_path = None
+		self._shard_pid = None
+
+		# (segment, transcript idx) -> list of paragraph results
+		self._segment_cache = LRUCache(cache_bytes)
+
+	def _segment_results(self, segment, transcript_idx, candidates):
+
+		qm = self.qm
+		key = (segment, transcript_idx)
+		results = self._segment_cache.get(key, None)
+		if results is not None:
+			return results
+
+		paragraphs = qm.transcripts[qm.order[transcript_idx]]['paragraphs']
+		if candidates is None:
+			paragraph_nums = range(len(paragraphs))
+		else:
+			# these include every paragraph the segment occurs in verbatim
+			paragraph_nums = [k for k, overlap in candidates.get(transcript_idx, ())]
+
+		segment_arr = list(segment)
+		segment_words = set(segment) - qm.stopwords
+		raw_text = ' '.join(segment_arr)
+
+		results = []
+		for k in paragraph_nums:
+			paragraph = paragraphs[k]
+			align, score = mu.match_segment_to_paragraph(segment, paragraph, qm.stopwords,
+								qm.MIN_FUZZ_LEN, qm.word_ratio, qm.tol, qm.align_backend)
+			if align is None or score < qm.tol:
+				continue
+			if len(segment_words) > 0:
+				overlap = len(segment_words & paragraph['words']) / len(segment_words)
+			else:
+				overlap = 0.0
+			is_verbatim = (score == 0 and raw_text in paragraph['raw']
+							and bool(mu.align_verbatim(segment_arr, paragraph['match'])))
+			results.append((k, score, overlap, is_verbatim, align))
+
+		self._segment_cache[key] = results
+		return results
+
+	def record_quote(self, quote, timestamp):
+
+		'''
+			records a quote's scores, if they haven't been already.
+
+			Returns:
+
+				the window key of the quote in records, or None if there are no
+					transcripts in its window.
+		'''
+
+		qm = self.qm
+		if quote[0] == '?':
+			return None
+		window = qm._quote_window(timestamp)
+		if window is None:
+			return None
+		earliest, latest = window
+		window_key = (quote, earliest, latest)
+		if window_key in self.records:
+			return window_key
+
+		segment_arr = mu.segment_quote(quote)
+		record = {'seg_lens': [len(segment) for segment in segment_arr], 'transcripts': {}}
+		self.records[window_key] = record
+		if max(record['seg_lens']) < qm.MIN_LEN:
+			return window_key
+		if qm.prefilter is not None and not qm.prefilter.plausible(segment_arr, earliest, latest):
+			return window_key
+
+		seg_candidates = [qm._candidate_paragraphs(segment, earliest, latest)
+							for segment in segment_arr]
+		for i in range(latest, earliest - 1, -1):
+			transcript_results = []
+			for segment, (candidates, verbatim) in zip(segment_arr, seg_candidates):
+				results = self._segment_results(segment, i, candidates)
+				if len(results) == 0:
+					break
+				transcript_results.append(results)
+			else:
+				record['transcripts'][i] = transcript_results
+		return window_key
+
+	def match_quote(self, quote, timestamp):
+
+		window_key = self.record_quote(quote, timestamp)
+		self.calls.append(window_key)
+		if window_key is None:
+			return None
+		return replay_quote(self.records[window_key], window_key, self.params, self.qm.order)
+
+	def match_quotes(self, batch):
+		return [self.match_quote(quote, timestamp) for quote, timestamp in batch]
+
+	def flush_persistent_cache(self):
+		self.qm.flush_persistent_cache()
+
+	def flush(self, filename):
+
+		'''
+			appends the scores of the quotes asked for since the last flush to this
+			process's shard, as the block of input file filename, and clears them.
+		'''
+
+		if self._shard_pid != os.getpid():
+			fd, self._shard_path = tempfile.mkstemp(prefix=SHARD_PREFIX, suffix='.pk',
+										dir=self.output_dir)
+			os.close(fd)
+			self._shard_pid = os.getpid()
+
+		block = {'filename': filename, 'records': self.records, 'calls': self.calls}
+		with open(self._shard_path, 'ab') as f:
+			cPickle.dump(block, f, cPickle.HIGHEST_PROTOCOL)
+			f.flush()
+			os.fsync(f.fileno())
+
+		self.records = {}
+		self.calls = []
+
+
+def check_params(params, floor):
+
+	'''
+		raises ValueError unless params are at least as strict as floor.
+	'''
+
+	for name in FLOOR_NAMES:
+		if params[name] < floor[name]:
+			raise ValueError('%s=%s is below the recorded floor %s'
+							% (name, params[name], floor[name]))
+
+
+def _best_paragraph(results, seg_len, params):
+
+	# (paragraph num, score, alignment) that _match_segment_to_transcript would
+	# pick, or None: the first exact match, or else the last of the best scores.
+
+	best = None
+	for k, score, overlap, is_verbatim, align in results:
+		if score < params['sim_tolerance']:
+			continue
+		if not is_verbatim and (seg_len < params['min_fuzz_len']
+				or overlap < params['word_ratio']):
+			continue
+		if score == 0:
+			return k, score, align
+		if best is None or score >= best[1]:
+			best = (k, score, align)
+	return best
+
+
+def replay_quote(record, window_key, params, transcript_names):
+
+	'''
+		returns what match_quote would for a recorded quote with params.
+	'''
+
+	if max(record['seg_lens']) < params['min_len']:
+		return None
+
+	quote, earliest, latest = window_key
+	best_score = None
+	best = None
+	for i in sorted(record['transcripts'], reverse=True):
+		curr_align = []
+		curr_paras = []
+		min_seg_score = None
+		for results, seg_len in zip(record['transcripts'][i], record['seg_lens']):
+			choice = _best_paragraph(results, seg_len, params)
+			if choice is None:
+				break
+			k, score, align = choice
+			curr_paras.append(k)
+			curr_align.append(align)
+			if min_seg_score is None or score < min_seg_score:
+				min_seg_score = score
+		else:
+			result = {
+					'alignment': curr_align,
+					'paragraph': curr_paras,
+					'similarity': min_seg_score,
+					'transcript': transcript_names[i]
+				}
+			if min_seg_score >= params['accept_threshold']:
+				return result
+			if min_seg_score > best_score:
+				best_score = min_seg_score
+				best = result
+	return best
+
+
+def replay(recording, params):
+
+	'''
+		works out what match_quote would have returned with params for every quote
+		in a recording (see load_recording).
+
+		Returns:
+
+			(results, num_matches): result for each call, in order, and the number
+				that aren't None.
+	'''
+
+	check_params(params, recording['floor'])
+	names = recording['transcript_names']
+	by_key = {}
+	results = []
+	for window_key in recording['calls']:
+		if window_key is None:
+			results.append(None)
+			continue
+		if window_key not in by_key:
+			by_key[window_key] = replay_quote(recording['records'][window_key], window_key,
+									params, names)
+		results.append(by_key[window_key])
+	num_matches = sum(1 for result in results if result is not None)
+	return results, num_matches
+
+
+def _iter_blocks(shard_path):
+
+	with open(shard_path, 'rb') as f:
+		while True:
+			try:
+				yield cPickle.load(f)
+			except EOFError:
+				return
+			except cPickle.UnpicklingError:
+				# a process that died mid-write leaves half a block at the end
+				return
+
+
+def load_recording(output_dir):
+
+	'''
+		reads the scores ScoreRecorders wrote to output_dir.
+
+		Returns:
+
+			{'floor', 'transcript_names', 'records', 'calls', 'filenames'}: the calls
+				of all input files, one after the other in the order of filenames
+				(sorted). a file recorded more than once (read again after a crash)
+				counts once.
+	'''
+
+	with open(os.path.join(output_dir, META_FILENAME), 'rb') as f:
+		recording = cPickle.load(f)
+
+	blocks = {}
+	for name in sorted(os.listdir(output_dir)):
+		if name.startswith(SHARD_PREFIX) and name.endswith('.pk'):
+			for block in _iter_blocks(os.path.join(output_dir, name)):
+				blocks[block['filename']] = block
+
+	recording['records'] = {}
+	recording['calls'] = []
+	recording['filenames'] = sorted(blocks)
+	for filename in recording['filenames']:
+		recording['records'].update(blocks[filename]['records'])
+		recording['calls'].extend(blocks[filename]['calls'])
+	return recording
+
+
+if __name__ == '__main__':
+
+	recording = load_recording(sys.argv[1])
+
+	values = {}
+	for arg in sys.argv[2:]:
+		name, value_list = arg.split('=')
+		values[name] = [float(value) for value in value_list.split(',')]
+
+	names = sorted(values)
+	for combination in itertools.product(*[values[name] for name in names]):
+		params = dict(recording['floor'])
+		params.update(zip(names, combination))
+		results, num_matches = replay(recording, params)
+		print ' '.join('%s=%s' % (name, params[name]) for name in names), num_matches
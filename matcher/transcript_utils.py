@@ -5,13 +5,21 @@ import os
 import datetime as dt 
 import numpy as np
 import re
+import cPickle
+import sys
+import hashlib
+import multiprocessing
 
 import match_utils as mu
 
 TRANSCRIPT_TIMEFORMAT = "%Y-%m-%d %H:%M"
 
+PARAGRAPH_KEYS = ('raw', 'display', 'match', 'words', 'speaker')
+TRANSCRIPT_KEYS = ('title', 'date', 'paragraphs')
+
 def load_transcript_collection(transcript_directory, stopword_file = 'mysql_stop.txt',
-					default_speaker = 'THE PRESIDENT'):
+					default_speaker = 'THE PRESIDENT', num_workers = 1, cache_file = None,
+					compact = False):
 	'''
 		Loads a collection of transcripts, for quote matching.
 
@@ -20,6 +28,12 @@ def load_transcript_collection(transcript_directory, stopword_file = 'mysql_stop
 			stopword_file (default='mysql_stop.txt'): list of stop words
 			default_speaker (default='THE PRESIDENT'): identity of speaker 
 				if we cannot infer anyone else
+			num_workers (default=1): number of processes to read files with
+			cache_file (default=None): pickle of previously loaded transcripts.
+				only files that are new or changed since (by mtime/size, then
+				content hash) are read; the cache is then updated.
+			compact (default=False): return Transcript and Paragraph objects
+				(see compact_transcript_collection) rather than dicts.
 
 		Returns:
 
@@ -44,95 +58,403 @@ def load_transcript_collection(transcript_directory, stopword_file = 'mysql_stop
 						'words': set of words in paragraph.
 						'speaker': speaker of paragraph (inferred & hopefully correct!)
 					}
+
+				with compact, transcripts and paragraphs are Transcript and
+				Paragraph objects, which can be read the same way.
 	'''
 	stopword_set = set()
 	with open(stopword_file, 'r') as f:
 		for line in f.readlines():
 			stopword_set.add(line.strip())
 
+	filenames = os.listdir(transcript_directory)
+
+	# files whose cached transcripts are still good don't need reading again
+	cache = {}
+	params = (sorted(stopword_set), default_speaker)
+	if cache_file is not None and os.path.exists(cache_file):
+		with open(cache_file, 'rb') as f:
+			cache = cPickle.load(f)
+		if cache.get('params', None) != params:
+			cache = {}
+	cached_files = cache.get('files', {})
+
+	stats = {}
+	to_load = []
+	for filename in filenames:
+		path = os.path.join(transcript_directory, filename)
+		file_stat = os.stat(path)
+		stats[filename] = (file_stat.st_mtime, file_stat.st_size)
+		entry = cached_files.get(filename, None)
+		if entry is None:
+			to_load.append(filename)
+		elif entry['stat'] != stats[filename]:
+			# touched, but maybe not changed
+			if entry['hash'] == _file_hash(path):
+				entry['stat'] = stats[filename]
+			else:
+				to_load.append(filename)
+
+	# with compact, each transcript is compacted as soon as it's read, so the dicts
+		# of the whole collection are never in memory at once
+	strings = {}
+	def compacted(loaded):
+		for file_hash, date, tdict in loaded:
+			yield file_hash, date, _compact_transcript(tdict, strings)
+
+	print str(len(to_load)) + ' of ' + str(len(filenames)) + ' transcripts to load'
+	paths = [os.path.join(transcript_directory, filename) for filename in to_load]
+	if num_workers > 1 and len(paths) > 1:
+		pool = multiprocessing.Pool(num_workers, _init_loader, (stopword_set, default_speaker))
+		try:
+			loaded = pool.imap(_load_in_worker, paths, 16)
+			loaded = _report_progress(loaded)
+			if compact:
+				loaded = compacted(loaded)
+			new_entries = dict(zip(to_load, loaded))
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		loaded = (_load_transcript_file(path, stopword_set, default_speaker) for path in paths)
+		loaded = _report_progress(loaded)
+		if compact:
+			loaded = compacted(loaded)
+		new_entries = dict(zip(to_load, loaded))
+
+	files = {}
 	order = []
 	transcripts = {}
+	for filename in filenames:
+		if filename in new_entries:
+			file_hash, date, tdict = new_entries[filename]
+			files[filename] = {'stat': stats[filename], 'hash': file_hash, 'transcript': tdict}
+		else:
+			# the cache keeps transcripts in whichever form they were last loaded
+			files[filename] = cached_files[filename]
+			tdict = files[filename]['transcript']
+			if compact:
+				tdict = _compact_transcript(tdict, strings)
+			elif isinstance(tdict, Transcript):
+				tdict = tdict.to_dict()
+			files[filename]['transcript'] = tdict
+		tdict = files[filename]['transcript']
+		order.append((filename, tdict['date']))
+		transcripts[filename] = tdict
+
+	if cache_file is not None:
+		with open(cache_file, 'wb') as f:
+			cPickle.dump({'params': params, 'files': files}, f, cPickle.HIGHEST_PROTOCOL)
 
-	count = 0
+	order = sorted(order, key=lambda elem: elem[1])
+	return order, transcripts
+
+def _file_hash(path):
 
-	for filename in os.listdir(transcript_directory):
+	with open(path, 'rb') as f:
+		return hashlib.md5(f.read()).hexdigest()
 
+def _report_progress(loaded):
+
+	count = 0
+	for result in loaded:
 		if count % 250 == 0:
 			print count
 		count += 1
+		yield result
+
+# set in each worker process by _init_loader
+_loader_stopwords = None
+_loader_default_speaker = None
+
+def _init_loader(stopword_set, default_speaker):
+
+	global _loader_stopwords, _loader_default_speaker
+	_loader_stopwords = stopword_set
+	_loader_default_speaker = default_speaker
+
+def _load_in_worker(path):
+	return _load_transcript_file(path, _loader_stopwords, _loader_default_speaker)
+
+def _load_transcript_file(path, stopword_set, default_speaker):
+
+	'''
+		reads one transcript file.
+
+		Returns:
+
+			(md5 hex digest of file, date, transcript data); see
+				load_transcript_collection for the format of the transcript data.
+	'''
+
+	with open(path) as f:
+		contents = f.read()
+	file_hash = hashlib.md5(contents).hexdigest()
 
-		with open(os.path.join(transcript_directory, filename)) as f:
+	lines = contents.split('\n', 2)
+	title = lines[0].strip()
+	date = dt.datetime.strptime(lines[1].strip(), TRANSCRIPT_TIMEFORMAT)
+	speech = lines[2] if len(lines) > 2 else ''
+	paragraph_text = speech.split('\n')
 
-			title = f.readline()
-			title = title.strip()
-			date_raw = f.readline()
-			date = dt.datetime.strptime(date_raw.strip(), TRANSCRIPT_TIMEFORMAT)
-			order.append((filename, date))
+	paragraphs = []
 
-			speech = f.read()
-			paragraph_text = speech.split('\n')
+	curr_speaker = default_speaker
+	for paragraph in paragraph_text:
 
-			paragraphs = []
+		if 'Please see below for corrections' in paragraph:
+			continue
 
-			curr_speaker = default_speaker
-			for paragraph in paragraph_text:
+		if paragraph and not paragraph.isspace():
 
-				if 'Please see below for corrections' in paragraph:
+			#find speaker
+
+			split_for_speaker = paragraph.split(':')
+
+			if len(split_for_speaker) > 1:
+
+				potential_speaker = split_for_speaker[0]
+				if potential_speaker.isdigit():
 					continue
+				if potential_speaker.isupper():
+					curr_speaker = potential_speaker
+					speech_index = 1
+				else:
+					speech_index = 0
+			else:
+				speech_index = 0
+
+			#process text
+
+			speech_text = ' '.join(split_for_speaker[speech_index:])
 
-				if paragraph and not paragraph.isspace():
+			display_array = mu.convert_to_display_array(speech_text)
+			if len(display_array) == 0:
+				continue
 
-					#find speaker
 
-					split_for_speaker = paragraph.split(':')
 
-					if len(split_for_speaker) > 1:
+			match_array = mu.convert_to_match_array(speech_text)
+			if display_array[0] == 'Q':
+				curr_speaker = 'Q'
+				display_array = display_array[1:]
+				match_array = match_array[1:]
+			raw_text = ' '.join(match_array)
+			words = set(match_array) - stopword_set
 
-						potential_speaker = split_for_speaker[0]
-						if potential_speaker.isdigit():
-							continue
-						if potential_speaker.isupper():
-							curr_speaker = potential_speaker
-							speech_index = 1
-						else:
-							speech_index = 0
-					else:
-						speech_index = 0
+			pdict = {}
+			pdict['raw'] = raw_text
+			pdict['display'] = display_array
+			pdict['match'] = match_array
+			pdict['words'] = words
+			pdict['speaker'] = curr_speaker
+			
+			paragraphs.append(pdict)
 
-					#process text
+	tdict = {}
+	tdict['title'] = title
+	tdict['date'] = date
+	tdict['paragraphs'] = paragraphs
 
-					speech_text = ' '.join(split_for_speaker[speech_index:])
+	return file_hash, date, tdict
 
-					display_array = mu.convert_to_display_array(speech_text)
-					if len(display_array) == 0:
-						continue
 
+class Paragraph(object):
 
+	'''
+		compact paragraph. reads like a paragraph dict (see
+		load_transcript_collection): paragraph['raw'] and friends, get, keys,
+		items and in all work, as do paragraph.raw etc. 'match' and 'display'
+		are lists and 'words' a frozenset, so they compare equal to a dict's.
 
-					match_array = mu.convert_to_match_array(speech_text)
-					if display_array[0] == 'Q':
-						curr_speaker = 'Q'
-						display_array = display_array[1:]
-						match_array = match_array[1:]
-					raw_text = ' '.join(match_array)
-					words = set(match_array) - stopword_set
+		it saves the dict itself, and its words can be shared with every other
+		paragraph of the collection (see compact_transcript_collection).
+	'''
 
-					pdict = {}
-					pdict['raw'] = raw_text
-					pdict['display'] = display_array
-					pdict['match'] = match_array
-					pdict['words'] = words
-					pdict['speaker'] = curr_speaker
-					
-					paragraphs.append(pdict)
+	__slots__ = PARAGRAPH_KEYS
 
-			tdict = {}
-			tdict['title'] = title
-			tdict['date'] = date
-			tdict['paragraphs'] = paragraphs
+	def __init__(self, raw, display, match, words, speaker):
 
-			transcripts[filename] = tdict
+		self.raw = raw
+		self.display = display
+		self.match = match
+		self.words = words
+		self.speaker = speaker
 
-	order = sorted(order, key=lambda elem: elem[1])
-	return order, transcripts	 
+	def __getitem__(self, key):
+
+		if key not in PARAGRAPH_KEYS:
+			raise KeyError(key)
+		return getattr(self, key)
+
+	def get(self, key, default=None):
+		if key in PARAGRAPH_KEYS:
+			return getattr(self, key)
+		return default
+
+	def __contains__(self, key):
+		return key in PARAGRAPH_KEYS
+
+	def keys(self):
+		return list(PARAGRAPH_KEYS)
+
+	def items(self):
+		return [(key, getattr(self, key)) for key in PARAGRAPH_KEYS]
+
+	def to_dict(self):
+
+		'''
+			returns the paragraph as a plain dict, as load_transcript_collection
+			makes them without compact.
+		'''
+
+		return {
+				'raw': self.raw,
+				'display': list(self.display),
+				'match': list(self.match),
+				'words': set(self.words),
+				'speaker': self.speaker
+			}
+
+	# equal to the same paragraph as a dict, like two dicts would be
+	def __eq__(self, other):
+		if isinstance(other, Paragraph):
+			other = other.to_dict()
+		return self.to_dict() == other
+
+	def __ne__(self, other):
+		return not self == other
+
+	__hash__ = None
+
+	# objects with __slots__ and no __dict__ need these to be pickled
+	def __getstate__(self):
+		return tuple(getattr(self, key) for key in PARAGRAPH_KEYS)
+
+	def __setstate__(self, state):
+		self.raw, self.display, self.match, self.words, self.speaker = state
+
+
+class Transcript(object):
+
+	'''
+		compact transcript: reads like a transcript dict (see
+		load_transcript_collection) with Paragraph objects as its paragraphs.
+	'''
+
+	__slots__ = TRANSCRIPT_KEYS
+
+	def __init__(self, title, date, paragraphs):
+
+		self.title = title
+		self.date = date
+		self.paragraphs = paragraphs
+
+	def __getitem__(self, key):
+
+		if key not in TRANSCRIPT_KEYS:
+			raise KeyError(key)
+		return getattr(self, key)
+
+	def get(self, key, default=None):
+		if key in TRANSCRIPT_KEYS:
+			return getattr(self, key)
+		return default
+
+	def __contains__(self, key):
+		return key in TRANSCRIPT_KEYS
+
+	def keys(self):
+		return list(TRANSCRIPT_KEYS)
+
+	def items(self):
+		return [(key, getattr(self, key)) for key in TRANSCRIPT_KEYS]
+
+	def to_dict(self):
+		return {
+				'title': self.title,
+				'date': self.date,
+				'paragraphs': [paragraph.to_dict() for paragraph in self.paragraphs]
+			}
+
+	def __eq__(self, other):
+		if isinstance(other, Transcript):
+			other = other.to_dict()
+		return self.to_dict() == other
+
+	def __ne__(self, other):
+		return not self == other
+
+	__hash__ = None
+
+	def __getstate__(self):
+		return (self.title, self.date, self.paragraphs)
+
+	def __setstate__(self, state):
+		self.title, self.date, self.paragraphs = state
+
+
+def compact_transcript_collection(transcript_collection):
+
+	'''
+		turns a dict of transcript filename -> transcript dict (as loaded by
+		load_transcript_collection, e.g. from an old pickle) into one of
+		Transcript objects. every distinct word and speaker is stored once for
+		the whole collection. transcripts that are already compact are rebuilt
+		too, so they share words with the rest.
+
+		for pickles meant to be read without this module, convert back with
+		to_dict first.
+	'''
+
+	strings = {}
+	compacted = {}
+	for name, transcript in transcript_collection.iteritems():
+		compacted[name] = _compact_transcript(transcript, strings)
+	return compacted
+
+
+def _compact_transcript(transcript, strings):
+
+	# transcript as a Transcript, with its words and speakers taken from strings
+	# (a dict of each string to itself) if they're in it, and added otherwise
+
+	def shared(word):
+		return strings.setdefault(word, word)
+
+	paragraphs = []
+	for paragraph in transcript['paragraphs']:
+		paragraphs.append(Paragraph(
+				paragraph['raw'],
+				[shared(word) for word in paragraph['display']],
+				[shared(word) for word in paragraph['match']],
+				frozenset(shared(word) for word in paragraph['words']),
+				shared(paragraph['speaker'])))
+	return Transcript(transcript['title'], transcript['date'], paragraphs)
+
+
+def collection_size(transcript_collection):
+
+	'''
+		returns roughly how many bytes a transcript collection takes up: the
+		sizes of all the objects it's made of, each counted once (as
+		sys.getsizeof sees them).
+	'''
 
+	seen = set()
+	total = 0
+	stack = [transcript_collection]
+	while stack:
+		obj = stack.pop()
+		if id(obj) in seen:
+			continue
+		seen.add(id(obj))
+		total += sys.getsizeof(obj)
+		if isinstance(obj, dict):
+			stack.extend(obj.iterkeys())
+			stack.extend(obj.itervalues())
+		elif isinstance(obj, (list, tuple, set, frozenset)):
+			stack.extend(obj)
+		elif isinstance(obj, (Paragraph, Transcript)):
+			stack.extend(obj.__getstate__())
+	return total
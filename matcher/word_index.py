@@ -0,0 +1,141 @@
+from __future__ import division
+import bisect
+from array import array
+
+
+class WordIndex(object):
+
+	'''
+		inverted index from non-stopwords to the transcript paragraphs containing them.
+
+		used to pick out the few paragraphs in a time window that could possibly
+		match a segment, so that match_segment_to_paragraph doesn't have to be
+		called on all the others.
+
+		Arguments:
+
+			transcript_names: transcript filenames in chronological order
+				(i.e. QuoteMatcher.order)
+			transcript_collection: dict of transcript filename to transcript data,
+				as returned by load_transcript_collection
+			stopword_set: set of stopwords (should be the same as the matcher's)
+
+		Structures:
+
+			paragraphs are numbered consecutively over the whole collection, in
+				chronological order.
+			transcript_offsets: number of first paragraph of each transcript;
+				has an extra entry at the end.
+			postings: map of word to array of paragraph numbers containing word
+				(sorted ascending)
+	'''
+
+	def __init__(self, transcript_names, transcript_collection, stopword_set):
+
+		self.stopwords = stopword_set
+
+		self.transcript_offsets = [0]
+		self.postings = {}
+
+		para_num = 0
+		for name in transcript_names:
+			for paragraph in transcript_collection[name]['paragraphs']:
+				for word in paragraph['words']:
+					posting = self.postings.get(word, None)
+					if posting is None:
+						posting = self.postings[word] = array('i')
+					posting.append(para_num)
+				para_num += 1
+			self.transcript_offsets.append(para_num)
+
+	@classmethod
+	def from_corpus(cls, corpus, stopword_set):
+
+		'''
+			returns an index over the postings stored in a Corpus, without rebuilding them.
+		'''
+
+		index = cls.__new__(cls)
+		index.stopwords = stopword_set
+		index.transcript_offsets = corpus.transcript_offsets.tolist()
+		index.postings = _CorpusPostings(corpus)
+		return index
+
+	def candidates(self, segment_arr, earliest, latest, min_fuzz_len, word_ratio):
+
+		'''
+			finds paragraphs of transcripts earliest..latest (indices into the
+			chronological order) which match_segment_to_paragraph could possibly
+			match segment_arr to, i.e. those which
+
+				- contain every non-stopword strictly inside the segment
+					(needed for a verbatim match), or
+				- contain enough of the segment's non-stopwords to reach
+					word_ratio (needed for a fuzzy match).
+
+			Returns:
+
+				dict of transcript index to list of (paragraph index, overlap count),
+					sorted by paragraph index. transcripts with no candidates are left out.
+				None if the segment is too short for the index to rule anything
+					out, in which case all paragraphs have to be checked.
+		'''
+
+		segment_words = set(segment_arr) - self.stopwords
+		interior_words = set(segment_arr[1:-1]) - self.stopwords
+
+		if len(interior_words) == 0:
+			return None
+
+		try_fuzzy = len(segment_arr) >= min_fuzz_len
+
+		start = self.transcript_offsets[earliest]
+		end = self.transcript_offsets[latest + 1]
+
+		overlaps = {}
+		interior_overlaps = {}
+		for word in segment_words:
+			posting = self.postings.get(word, None)
+			if posting is None:
+				continue
+			lo = bisect.bisect_left(posting, start)
+			hi = bisect.bisect_left(posting, end, lo)
+			is_interior = word in interior_words
+			for para_num in posting[lo:hi]:
+				overlaps[para_num] = overlaps.get(para_num, 0) + 1
+				if is_interior:
+					interior_overlaps[para_num] = interior_overlaps.get(para_num, 0) + 1
+
+		num_words = len(segment_words)
+		num_interior = len(interior_words)
+
+		result = {}
+		transcript_idx = earliest
+		for para_num in sorted(overlaps):
+			overlap = overlaps[para_num]
+			if (interior_overlaps.get(para_num, 0) == num_interior
+					or (try_fuzzy and overlap / num_words >= word_ratio)):
+				while para_num >= self.transcript_offsets[transcript_idx + 1]:
+					transcript_idx += 1
+				para_idx = int(para_num) - self.transcript_offsets[transcript_idx]
+				result.setdefault(transcript_idx, []).append((para_idx, overlap))
+		return result
+
+
+class _CorpusPostings(object):
+
+	# read-only map of word to postings array, backed by a Corpus
+
+	def __init__(self, corpus):
+		self.corpus = corpus
+
+	def get(self, word, default=None):
+
+		word_id = self.corpus.vocab.get(word, None)
+		if word_id is None:
+			return default
+		start = self.corpus.posting_offsets[word_id]
+		end = self.corpus.posting_offsets[word_id + 1]
+		if start == end:
+			return default
+		return self.corpus.posting_paras[start:end].tolist()